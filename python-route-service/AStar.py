@@ -1,66 +1,868 @@
 # AStar.py - (Fixed Mesh Bug, Good Performance)
 
-import pandas as pd
+import numpy as np
 import math
 import heapq
+import hashlib
+import functools
+import multiprocessing
+import os
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor, wait
+from concurrent.futures.process import BrokenProcessPool
+from multiprocessing import shared_memory
+from terrain_cache import TerrainCache
+from metrics import log, stage_seconds, search_expanded, search_pushes, search_iterations, legs_total
 
 LAT_LON_THRESHOLD = 0.00028
 ELEVATION_THRESHOLD = 8
+HEURISTIC_CACHE_SIZE = 16
+HEURISTIC_CHUNK = 1024  # node ids whose lower bounds are computed together on first use
+EDGE_COST_CACHE_SIZE = 8  # per-alpha edge cost arrays kept on a TerrainGraph
+LANDMARK_COUNT = 8
+EXACT_ORDER_LIMIT = 10
+DEFAULT_SEARCH = 'bidirectional'
+DEFAULT_ALPHA = 25  # metres of distance one metre of climb or descent is worth
+# `alpha: "pareto"` sweeps these weights; more than MAX_ALPHAS per request are refused
+PARETO_ALPHAS = (0, 1, 2.5, 5, 10, 25, 50, 100, 250)
+MAX_ALPHAS = 16
+COARSE_FACTOR = 8
+CORRIDOR_WIDTH = 2
+DEADLINE_CHECK_INTERVAL = 1024
+DENSITY = 7
+PATH_FORMATS = ('coordinates', 'columns', 'polyline')
+TERRAIN_CACHE_BYTES = 256 * 1024 * 1024
+SEGMENT_CACHE_BYTES = 32 * 1024 * 1024
 
-class Point:
-    def __init__(self, id, lat, lon, elevation, point_type):
-        self.id = id
-        self.lat = lat
-        self.lon = lon
-        self.elevation = elevation
-        self.point_type = point_type
-        self.neighbors = []
+# Built terrains shared across requests, keyed by a content hash of the grid rows
+terrain_cache = TerrainCache(TERRAIN_CACHE_BYTES)
+# Interior terrain nodes of solved legs, keyed by (terrain key, start, end, alpha)
+segment_cache = TerrainCache(SEGMENT_CACHE_BYTES, sizeof=lambda interior: interior.nbytes + 100)
 
-def load_points_from_csv(file_path):
-    df = pd.read_csv(file_path)
-    points = {}
-    for idx, row in df.iterrows():
-        points[idx] = Point(idx, row['lat'], row['lng'], row['elevation'], row['point_type'])
-    return points
+class TerrainGraph:
+    """Array-backed terrain graph.
+    
+    Node attributes live in contiguous NumPy arrays indexed by node id (the row
+    position in the input), and adjacency is stored in CSR form: the neighbors
+    of node `i` are `neighbor_ids[offsets[i]:offsets[i + 1]]`, with the matching
+    precomputed edge distances and elevation differences alongside.
+    """
+    
+    def __init__(self, lat, lon, elevation):
+        self.lat = np.ascontiguousarray(lat, dtype=np.float64)
+        self.lon = np.ascontiguousarray(lon, dtype=np.float64)
+        self.elevation = np.ascontiguousarray(elevation, dtype=np.float64)
+        self.offsets = np.zeros(len(self.lat) + 1, dtype=np.int64)
+        self.neighbor_ids = np.empty(0, dtype=np.int32)
+        self.edge_distance = np.empty(0, dtype=np.float64)
+        self.edge_elev_diff = np.empty(0, dtype=np.float64)
+        self._edge_cost_cache = {}
+        self._landmark_cache = {}
+    
+    def __len__(self):
+        return len(self.lat)
+    
+    def nbytes(self):
+        arrays = [self.lat, self.lon, self.elevation, self.offsets, self.neighbor_ids,
+                  self.edge_distance, self.edge_elev_diff, *self._edge_cost_cache.values(),
+                  *self._landmark_cache.values()]
+        return sum(array.nbytes for array in arrays)
+    
+    def degree(self, node):
+        return int(self.offsets[node + 1] - self.offsets[node])
+    
+    def neighbors(self, node):
+        """Yield (neighbor_id, distance, elev_diff) for every edge leaving `node`"""
+        start, end = self.offsets[node], self.offsets[node + 1]
+        return zip(self.neighbor_ids[start:end].tolist(),
+                   self.edge_distance[start:end].tolist(),
+                   self.edge_elev_diff[start:end].tolist())
+    
+    def expand(self, node, alpha):
+        """(neighbor_id, cost) for every edge leaving `node`, using cached edge costs"""
+        costs = self.edge_costs(alpha)
+        start, end = self.offsets[node], self.offsets[node + 1]
+        return zip(self.neighbor_ids[start:end].tolist(), costs[start:end].tolist())
+    
+    def edge_costs(self, alpha):
+        """Per-edge search cost `distance + alpha * elev_diff`, kept for the EDGE_COST_CACHE_SIZE latest alphas.
+        
+        Each alpha costs an array as long as the edges on a terrain that can
+        stay cached for a long time, so the least recently used is dropped
+        once a request brings in one alpha too many.
+        """
+        cache = self._edge_cost_cache
+        costs = cache.pop(alpha, None)
+        if costs is None:
+            costs = self.edge_distance + alpha * self.edge_elev_diff
+            while len(cache) >= EDGE_COST_CACHE_SIZE:
+                cache.pop(next(iter(cache), None), None)
+        cache[alpha] = costs
+        return costs
+    
+    def landmark_distances(self, alpha):
+        """Landmark cost table for `alpha` (see `prepare_landmarks`), or None"""
+        return self._landmark_cache.get(alpha)
+    
+    def nodes_near(self, lat, lon):
+        """Ids of the nodes within LAT_LON_THRESHOLD of (lat, lon), in id order"""
+        return np.flatnonzero((np.abs(self.lat - lat) <= LAT_LON_THRESHOLD) &
+                              (np.abs(self.lon - lon) <= LAT_LON_THRESHOLD)).tolist()
+    
+    def vertex(self, node):
+        """(lat, lon, elevation, point_type) of a single node"""
+        return (float(self.lat[node]), float(self.lon[node]),
+                float(self.elevation[node]), 'grid')
+    
+    def coordinates(self, nodes):
+        """(lat, lon, elevation) arrays for an array of node ids"""
+        return self.lat[nodes], self.lon[nodes], self.elevation[nodes]
+    
+    def shared_state(self):
+        """Split the graph into large arrays (for shared memory) and small picklable state"""
+        arrays = {name: getattr(self, name) for name in
+                  ('lat', 'lon', 'elevation', 'offsets', 'neighbor_ids', 'edge_distance', 'edge_elev_diff')}
+        for alpha, costs in self._edge_cost_cache.items():
+            arrays[f'edge_costs:{alpha!r}'] = costs
+        for alpha, table in self._landmark_cache.items():
+            arrays[f'landmarks:{alpha!r}'] = table
+        return arrays, {}
+    
+    @classmethod
+    def from_shared(cls, arrays, state):
+        """Rebuild a read-only graph around arrays that live in shared memory"""
+        graph = cls.__new__(cls)
+        for name, array in arrays.items():
+            if ':' not in name:
+                setattr(graph, name, array)
+        graph._edge_cost_cache = _tables_by_alpha(arrays, 'edge_costs')
+        graph._landmark_cache = _tables_by_alpha(arrays, 'landmarks')
+        return graph
+
+def _tables_by_alpha(arrays, prefix):
+    """Per-alpha tables published as `<prefix>:<alpha>` arrays by `shared_state`"""
+    return {float(name.split(':', 1)[1]): array
+            for name, array in arrays.items() if name.startswith(prefix + ':')}
+
+class _PointTypes:
+    """Read-only point_type lookup for a RoutingGraph without a per-node array"""
+    
+    def __init__(self, graph):
+        self._graph = graph
+    
+    def __len__(self):
+        return len(self._graph)
+    
+    def __getitem__(self, node):
+        extra = node - self._graph.terrain_size
+        return 'grid' if extra < 0 else self._graph.extra_point_type[extra]
+
+class LowerBounds:
+    """Lower bound on the search cost from every node of a RoutingGraph to `goal`, indexed by node id.
+    
+    This is the haversine distance, raised to the landmark (ALT) bound
+    `max |d(L, v) - d(L, goal)|` where the graph has landmark tables for
+    `alpha`. Unlike the distance alone, the landmark bound accounts for the
+    `alpha * elev` part of the cost. Bounds are computed with NumPy for
+    HEURISTIC_CHUNK consecutive ids at a time, the first time a search asks
+    for one of them, so a leg only pays for the part of the graph it touches.
+    """
+    
+    def __init__(self, graph, goal, alpha):
+        self.graph = graph
+        self.goal_lat, self.goal_lon, _, _ = graph.vertex(goal)
+        self.landmarks = graph.landmark_distances(alpha)
+        self.goal_landmarks = self.landmarks[:, goal:goal + 1] if self.landmarks is not None else None
+        self._chunks = {}
+    
+    def __len__(self):
+        return len(self.graph)
+    
+    def __getitem__(self, node):
+        chunk = self._chunks.get(node // HEURISTIC_CHUNK)
+        if chunk is None:
+            chunk = self._compute(node // HEURISTIC_CHUNK)
+        return chunk[node % HEURISTIC_CHUNK]
+    
+    def _compute(self, index):
+        lo = index * HEURISTIC_CHUNK
+        hi = min(lo + HEURISTIC_CHUNK, len(self.graph))
+        lat, lon, _ = self.graph.coordinates(np.arange(lo, hi))
+        h = haversine_distance(lat, lon, self.goal_lat, self.goal_lon)
+        if self.landmarks is not None:
+            # A landmark that cannot reach the node or the goal gives no bound (inf - inf is NaN)
+            with np.errstate(invalid='ignore'):
+                bounds = np.abs(self.landmarks[:, lo:hi] - self.goal_landmarks)
+            bounds = np.where(np.isfinite(bounds), bounds, 0.0)
+            h = np.maximum(h, bounds.max(axis=0))
+        chunk = self._chunks[index] = h.tolist()
+        return chunk
+
+class RoutingGraph:
+    """A terrain plus the per-request points that are not part of it.
+    
+    The terrain (a TerrainGraph or LatticeTerrain built from the grid rows) is
+    shared and may come from `terrain_cache`; the start/end/wN rows are
+    appended as extra nodes with ids from `len(terrain)` upward and joined to
+    the terrain and to each other with the usual LAT_LON_THRESHOLD rule. This
+    is the graph the search functions operate on.
+    """
+    
+    def __init__(self, terrain, extra_lat=(), extra_lon=(), extra_elevation=(), extra_point_type=(), terrain_key=None):
+        self.terrain = terrain
+        self.terrain_key = terrain_key
+        self.terrain_size = len(terrain)
+        self.extra_lat = np.asarray(extra_lat, dtype=np.float64)
+        self.extra_lon = np.asarray(extra_lon, dtype=np.float64)
+        self.extra_elevation = np.asarray(extra_elevation, dtype=np.float64)
+        self.extra_point_type = list(extra_point_type)
+        self.point_type = _PointTypes(self)
+        self.waypoint_ids = self.terrain_size + np.flatnonzero(key_point_mask(self.extra_point_type))
+        self._extra_edges = self._attach_extra_nodes()
+        self._heuristic_cache = {}
+        self._landmark_cache = {}
+    
+    def __len__(self):
+        return self.terrain_size + len(self.extra_lat)
+    
+    def _attach_extra_nodes(self):
+        """Adjacency lists (neighbor_id, distance, elev_diff) touching the extra nodes"""
+        edges = {}
+        
+        def add_edge(a, b):
+            lat1, lon1, elev1, _ = self.vertex(a)
+            lat2, lon2, elev2, _ = self.vertex(b)
+            distance = float(haversine_distance(lat1, lon1, lat2, lon2))
+            edges.setdefault(a, []).append((b, distance, abs(elev1 - elev2)))
+        
+        extra_ids = range(self.terrain_size, len(self))
+        terrain_links = [self.terrain.nodes_near(self.extra_lat[i], self.extra_lon[i])
+                         for i in range(len(extra_ids))]
+        
+        # Extra nodes list their terrain neighbors before each other, and terrain
+        # nodes list extra nodes after their own neighbors, all in id order - the
+        # same order a full graph over the grid rows followed by the key rows gives
+        for node, linked in zip(extra_ids, terrain_links):
+            for neighbor in linked:
+                add_edge(node, neighbor)
+            for other in extra_ids:
+                if other != node and are_adjacent(self, node, other):
+                    add_edge(node, other)
+        for node, linked in zip(extra_ids, terrain_links):
+            for neighbor in linked:
+                add_edge(neighbor, node)
+        return edges
+    
+    def degree(self, node):
+        return len(list(self.expand(node, 0)))
+    
+    def expand(self, node, alpha):
+        """(neighbor_id, cost) for every edge leaving `node`"""
+        extra_edges = self._extra_edges.get(node)
+        if node < self.terrain_size:
+            edges = self.terrain.expand(node, alpha)
+            if not extra_edges:
+                return edges
+            edges = list(edges)
+        else:
+            edges = []
+        if extra_edges:
+            edges.extend((neighbor, distance + alpha * elev_diff) for neighbor, distance, elev_diff in extra_edges)
+        return edges
+    
+    def heuristic(self, goal, alpha=None):
+        """Lower bound on the search cost from every node to `goal` (a LowerBounds), cached for recently used goals"""
+        h = self._heuristic_cache.get((goal, alpha))
+        if h is None:
+            h = LowerBounds(self, goal, alpha)
+            if len(self._heuristic_cache) >= HEURISTIC_CACHE_SIZE:
+                self._heuristic_cache.pop(next(iter(self._heuristic_cache)))
+            self._heuristic_cache[(goal, alpha)] = h
+        return h
+    
+    def landmark_distances(self, alpha):
+        """Landmark cost table over the whole graph, or None if the terrain has none.
+        
+        The terrain's table is extended to the extra nodes and corrected for
+        the paths through them. Extra nodes can only make costs cheaper, so a
+        Dijkstra seeded at the terrain nodes they touch lowers exactly the
+        entries that change, keeping the landmark bounds admissible.
+        """
+        terrain_table = self.terrain.landmark_distances(alpha) if alpha is not None else None
+        if terrain_table is None or len(self) == self.terrain_size:
+            return terrain_table
+        table = self._landmark_cache.get(alpha)
+        if table is None:
+            seeds = sorted({neighbor for node in range(self.terrain_size, len(self))
+                            for neighbor, _ in self.expand(node, alpha) if neighbor < self.terrain_size})
+            rows = []
+            for costs in terrain_table:
+                dist = costs.tolist() + [math.inf] * (len(self) - self.terrain_size)
+                lower_costs(self, dist, [(dist[node], node) for node in seeds if dist[node] < math.inf], alpha)
+                rows.append(dist)
+            table = np.array(rows)
+            self._landmark_cache[alpha] = table
+        return table
+    
+    def vertex(self, node):
+        """(lat, lon, elevation, point_type) of a single node"""
+        extra = node - self.terrain_size
+        if extra < 0:
+            return self.terrain.vertex(node)
+        return (float(self.extra_lat[extra]), float(self.extra_lon[extra]),
+                float(self.extra_elevation[extra]), self.extra_point_type[extra])
+    
+    def coordinates(self, nodes):
+        """(lat, lon, elevation) arrays for an array of node ids"""
+        nodes = np.asarray(nodes, dtype=np.int64)
+        extra = nodes - self.terrain_size
+        on_terrain = extra < 0
+        coordinates = tuple(np.empty(len(nodes)) for _ in range(3))
+        terrain_values = self.terrain.coordinates(nodes[on_terrain])
+        extra_values = (self.extra_lat, self.extra_lon, self.extra_elevation)
+        for out, from_terrain, from_extras in zip(coordinates, terrain_values, extra_values):
+            out[on_terrain] = from_terrain
+            out[~on_terrain] = from_extras[extra[~on_terrain]]
+        return coordinates
+    
+    def shared_state(self):
+        """Split the graph into large arrays (for shared memory) and small picklable state"""
+        arrays, terrain_state = self.terrain.shared_state()
+        state = {
+            'terrain_kind': type(self.terrain).__name__,
+            'terrain_state': terrain_state,
+            'extras': (self.extra_lat.tolist(), self.extra_lon.tolist(),
+                       self.extra_elevation.tolist(), list(self.extra_point_type)),
+        }
+        return arrays, state
+    
+    @classmethod
+    def from_shared(cls, arrays, state):
+        """Rebuild a read-only routing graph around terrain arrays that live in shared memory"""
+        terrain_type = {'TerrainGraph': TerrainGraph, 'LatticeTerrain': LatticeTerrain}[state['terrain_kind']]
+        return cls(terrain_type.from_shared(arrays, state['terrain_state']), *state['extras'])
 
-def are_adjacent(p1, p2):
-    return (abs(p1.lat - p2.lat) <= LAT_LON_THRESHOLD and 
-            abs(p1.lon - p2.lon) <= LAT_LON_THRESHOLD)
+def key_point_mask(point_type):
+    """Boolean mask of the 'start', 'end' and 'wN' rows in a point_type column"""
+    types = np.ascontiguousarray(point_type, dtype=str)
+    if types.size == 0 or types.itemsize == 0:
+        return np.zeros(types.shape, dtype=bool)
+    # Compare the first character of each fixed-width string without a Python loop
+    first_char = types.view(np.uint32).reshape(len(types), -1)[:, 0]
+    return (types == 'start') | (types == 'end') | (first_char == ord('w'))
 
-def elevation_difference(p1, p2):
-    return abs(p1.elevation - p2.elevation)
+def split_key_rows(df):
+    """Read the lat/lng/elevation/point_type columns as whole arrays and split them.
+    
+    `df` is a DataFrame or a dict of column arrays (see `ingest.read_points`).
+    Returns `(grid, key_points)`: the (lat, lon, elevation) arrays of the grid
+    rows and the (lat, lon, elevation, point_type) arrays of the start/end/wN rows.
+    """
+    lat = np.asarray(df['lat'], dtype=np.float64)
+    lon = np.asarray(df['lng'], dtype=np.float64)
+    elevation = np.asarray(df['elevation'], dtype=np.float64)
+    point_type = np.asarray(df['point_type'])
+    key_mask = key_point_mask(point_type)
+    key_rows = np.flatnonzero(key_mask)
+    if len(key_rows) == 0 or key_rows[0] == len(lat) - len(key_rows):
+        # Key rows appended after the grid (the usual layout): the grid is a view
+        grid_mask = slice(0, len(lat) - len(key_rows))
+    else:
+        grid_mask = ~key_mask
+    return ((lat[grid_mask], lon[grid_mask], elevation[grid_mask]),
+            (lat[key_mask], lon[key_mask], elevation[key_mask], point_type[key_mask]))
 
-def build_graph(points):
-    print(f"🔗 Building graph with {len(points)} points...")
-    connection_count = 0
+def terrain_key(lat, lon, elevation, grid=None):
+    """Content hash of the grid rows (and of how they should be interpreted)"""
+    digest = hashlib.blake2b(digest_size=16)
+    for array in (lat, lon, elevation):
+        digest.update(np.ascontiguousarray(array, dtype=np.float64).tobytes())
+    digest.update(repr(grid).encode())
+    return digest.hexdigest()
+
+@stage_seconds.time(stage='build')
+def build_terrain(lat, lon, elevation, grid=None):
+    """LatticeTerrain for regular grids (detected, or described by `grid`), else a built TerrainGraph.
     
-    for i, p1 in points.items():
-        for j, p2 in points.items():
-            if i != j and are_adjacent(p1, p2):
-                elev_diff = elevation_difference(p1, p2)
-                p1.neighbors.append((j, elev_diff))
-                connection_count += 1
+    `grid` may describe the lattice explicitly as a dict with `origin`
+    (lat, lng), `step` (one value or a (lat_step, lng_step) pair), `rows` and
+    `cols`, in which case the elevations are taken in row-major order.
+    `grid=False` always builds the explicit graph.
+    """
+    if grid is False:
+        layout = None
+    elif grid is None:
+        layout = detect_lattice(lat, lon)
+    else:
+        step = grid['step']
+        lat_step, lon_step = (step, step) if np.isscalar(step) else step
+        layout = (grid['origin'][0], grid['origin'][1], lat_step, lon_step, int(grid['rows']), int(grid['cols']))
+        if layout[4] * layout[5] != len(elevation):
+            raise ValueError(f"Grid of {layout[4]}x{layout[5]} does not match {len(elevation)} elevation points")
     
-    print(f"🔗 Graph built with {connection_count} total connections")
+    if layout is not None:
+        origin_lat, origin_lon, lat_step, lon_step, rows, cols = layout
+        log(f"🧮 Regular grid: routing on a {rows}x{cols} implicit lattice")
+        return LatticeTerrain(origin_lat, origin_lon, lat_step, lon_step, np.reshape(elevation, (rows, cols)))
+    return build_graph(TerrainGraph(lat, lon, elevation))
+
+def routing_graph_from_dataframe(df, grid=None, cache=terrain_cache):
+    """Build the routing graph for a request, reusing a cached terrain when possible"""
+    (lat, lon, elevation), key_points = split_key_rows(df)
+    terrain, key = cached_terrain(lat, lon, elevation, grid, cache)
+    return attach_key_points(terrain, key_points, key)
+
+def cached_terrain(lat, lon, elevation, grid=None, cache=terrain_cache):
+    """`(terrain, key)` for the grid rows, built once and kept in `cache` (key is None without one)"""
+    if cache is None:
+        return build_terrain(lat, lon, elevation, grid), None
+    key = terrain_key(lat, lon, elevation, grid)
+    return cache.get_or_build(key, lambda: build_terrain(lat, lon, elevation, grid)), key
+
+def preload_terrain(df, grid=None, landmarks=False, alpha=25, cache=terrain_cache):
+    """Build the terrain of a request-shaped DataFrame before any request and pin it in `cache`.
+    
+    Meant for the parent process of a pre-fork server: the edge costs for
+    `alpha` (and, with `landmarks`, the landmark tables) are filled in up
+    front, so forked workers read the same pages copy-on-write instead of
+    each building their own. Key rows in `df` are ignored. Returns the
+    terrain key, usable as the `terrainId` of a reroute.
+    """
+    (lat, lon, elevation), _ = split_key_rows(df)
+    key = terrain_key(lat, lon, elevation, grid)
+    terrain = build_terrain(lat, lon, elevation, grid)
+    if isinstance(terrain, TerrainGraph):
+        terrain.edge_costs(alpha)
+    if landmarks:
+        prepare_landmarks(terrain, alpha)
+    cache.pin(key, terrain)
+    return key
+
+def warm_up(terrains=()):
+    """Route once over a small synthetic lattice so the first request does not pay first-call costs.
+    
+    Every search, path format and option is exercised, which imports the
+    NumPy modules loaded on first use. For each of `terrains` (e.g. the
+    preloaded ones) the structures a first request would otherwise build
+    are built now: the edge costs of a TerrainGraph, or the coarse lattice
+    hierarchical search uses on a large LatticeTerrain. Returns the seconds
+    spent.
+    """
+    started = time.perf_counter()
+    rows, cols = np.mgrid[0:4 * COARSE_FACTOR + 8, 0:4 * COARSE_FACTOR + 8]
+    lattice = LatticeTerrain(0.0, 0.0, 0.00027, 0.00027, 100 + 20 * np.sin(rows / 5) * np.cos(cols / 7))
+    corner = 0.00027 * (4 * COARSE_FACTOR + 6)
+    key_points = ([0.0003, corner / 2, corner], [0.0003, corner, corner / 2], [100.0] * 3, ['start', 'w1', 'end'])
+    graph = attach_key_points(lattice, key_points)
+    for search, path_format in zip(SEARCH_METHODS, PATH_FORMATS):
+        route_graph(graph, search=search, path_format=path_format)
+    route_graph(graph, landmarks=True, optimize_order=True, simplify=5.0)
+    for terrain in terrains:
+        if isinstance(terrain, TerrainGraph):
+            terrain.edge_costs(25)
+        elif min(terrain.rows, terrain.cols) >= 4 * COARSE_FACTOR:
+            terrain.coarsened(COARSE_FACTOR)
+    return time.perf_counter() - started
+
+def waypoint_key_points(waypoints):
+    """Key point arrays for an ordered list of waypoint dicts (lat, lng, elevation[, point_type])"""
+    if len(waypoints) < 2:
+        raise ValueError("At least 2 waypoints required")
+    last = len(waypoints) - 1
+    return (
+        [float(wp['lat']) for wp in waypoints],
+        [float(wp['lng']) for wp in waypoints],
+        [float(wp['elevation']) for wp in waypoints],
+        [wp.get('point_type') or ('start' if i == 0 else 'end' if i == last else f'w{i}')
+         for i, wp in enumerate(waypoints)],
+    )
+
+@stage_seconds.time(stage='attach')
+def attach_key_points(terrain, key_points, key=None):
+    """RoutingGraph over `terrain` for (lat, lon, elevation, point_type) key point arrays"""
+    graph = RoutingGraph(terrain, *key_points, terrain_key=key)
     
     # Check connectivity of key points
-    key_points = [p for p in points.values() if p.point_type in ['start', 'end'] or p.point_type.startswith('w')]
-    for kp in key_points:
-        neighbor_count = len(kp.neighbors)
-        print(f"🔑 Key point {kp.point_type} at ({kp.lat:.4f}, {kp.lon:.4f}) has {neighbor_count} neighbors")
+    for kp in graph.waypoint_ids.tolist():
+        lat_kp, lon_kp, _, point_type = graph.vertex(kp)
+        log(f"🔑 Key point {point_type} at ({lat_kp:.4f}, {lon_kp:.4f}) has {graph.degree(kp)} neighbors")
+    return graph
+
+def load_points_from_csv(file_path):
+    import pandas as pd  # only needed by this CSV helper, kept off the routing import path
+    return routing_graph_from_dataframe(pd.read_csv(file_path, float_precision='round_trip'), cache=None)
+
+def are_adjacent(graph, a, b):
+    lat1, lon1, _, _ = graph.vertex(a)
+    lat2, lon2, _, _ = graph.vertex(b)
+    return (abs(lat1 - lat2) <= LAT_LON_THRESHOLD and
+            abs(lon1 - lon2) <= LAT_LON_THRESHOLD)
+
+def elevation_difference(graph, a, b):
+    return abs(graph.vertex(a)[2] - graph.vertex(b)[2])
+
+def grid_cells(lat, lon):
+    """Bucket coordinates into LAT_LON_THRESHOLD-sized cells of the spatial hash"""
+    # Cells are a hair wider than the threshold so float rounding can never push
+    # two adjacent points more than one cell apart.
+    cell_size = LAT_LON_THRESHOLD * (1 + 1e-9)
+    return (np.floor(lat / cell_size).astype(np.int64),
+            np.floor(lon / cell_size).astype(np.int64))
+
+def adjacent_pairs(lat, lon):
+    """All ordered pairs (i, j), i != j, of points within LAT_LON_THRESHOLD of each other.
+
+    Points are sorted by spatial-hash cell and each point is joined against the
+    3x3 block of cells around it, so the work is linear in the number of
+    candidate pairs rather than quadratic in the number of points. Pairs are
+    returned sorted by (i, j).
+    """
+    n = len(lat)
+    if n == 0:
+        empty = np.empty(0, dtype=np.int64)
+        return empty, empty
+    
+    cx, cy = grid_cells(lat, lon)
+    cx -= cx.min() - 1
+    cy -= cy.min() - 1
+    width = int(cy.max()) + 2
+    keys = cx * width + cy
+    order = np.argsort(keys, kind='stable')
+    sorted_keys = keys[order]
+    node_ids = np.arange(n)
     
-    return points
+    sources, targets = [], []
+    for dx in (-1, 0, 1):
+        for dy in (-1, 0, 1):
+            wanted = keys + dx * width + dy
+            lo = np.searchsorted(sorted_keys, wanted, side='left')
+            hi = np.searchsorted(sorted_keys, wanted, side='right')
+            counts = hi - lo
+            total = int(counts.sum())
+            if total == 0:
+                continue
+            src = np.repeat(node_ids, counts)
+            run_starts = np.cumsum(counts) - counts
+            dst = order[np.repeat(lo - run_starts, counts) + np.arange(total)]
+            keep = ((src != dst) &
+                    (np.abs(lat[src] - lat[dst]) <= LAT_LON_THRESHOLD) &
+                    (np.abs(lon[src] - lon[dst]) <= LAT_LON_THRESHOLD))
+            sources.append(src[keep])
+            targets.append(dst[keep])
+    
+    if not sources:
+        empty = np.empty(0, dtype=np.int64)
+        return empty, empty
+    src = np.concatenate(sources)
+    dst = np.concatenate(targets)
+    pair_order = np.lexsort((dst, src))
+    return src[pair_order], dst[pair_order]
 
-def haversine_distance(p1, p2):
+def build_graph(graph):
+    log(f"🔗 Building graph with {len(graph)} points...")
+    
+    src, dst = adjacent_pairs(graph.lat, graph.lon)
+    # Neighbors are kept in input order, matching the original full pairwise scan
+    graph.offsets = np.concatenate(([0], np.cumsum(np.bincount(src, minlength=len(graph))))).astype(np.int64)
+    graph.neighbor_ids = dst.astype(np.int32)
+    graph.edge_distance = haversine_distance(graph.lat[src], graph.lon[src], graph.lat[dst], graph.lon[dst])
+    graph.edge_elev_diff = np.abs(graph.elevation[src] - graph.elevation[dst])
+    
+    log(f"🔗 Graph built with {len(dst)} total connections")
+    
+    return graph
+
+def haversine_distance(lat1, lon1, lat2, lon2):
+    """Great-circle distance in metres; accepts scalars or NumPy arrays"""
     R = 6371000
-    phi1 = math.radians(p1.lat)
-    phi2 = math.radians(p2.lat)
-    d_phi = math.radians(p2.lat - p1.lat)
-    d_lambda = math.radians(p2.lon - p1.lon)
-    a = math.sin(d_phi/2)**2 + math.cos(phi1) * math.cos(phi2) * math.sin(d_lambda/2)**2
-    c = 2 * math.atan2(math.sqrt(a), math.sqrt(1-a))
+    phi1 = np.radians(lat1)
+    phi2 = np.radians(lat2)
+    d_phi = np.radians(lat2 - lat1)
+    d_lambda = np.radians(lon2 - lon1)
+    a = np.sin(d_phi/2)**2 + np.cos(phi1) * np.cos(phi2) * np.sin(d_lambda/2)**2
+    c = 2 * np.arctan2(np.sqrt(a), np.sqrt(1-a))
     return R * c
 
+class LatticeTerrain:
+    """Regular lat/lng grid routed as an implicit 8-connected lattice.
+    
+    Node `r * cols + c` sits at `origin + (r * lat_step, c * lon_step)` and its
+    neighbors come from index arithmetic, so no adjacency is stored.
+    Elevations live in a `rows x cols` array.
+    """
+    
+    # (d_row, d_col) in ascending node-id order, matching row-major input order
+    DIRECTIONS = [(-1, -1), (-1, 0), (-1, 1), (0, -1), (0, 1), (1, -1), (1, 0), (1, 1)]
+    
+    def __init__(self, origin_lat, origin_lon, lat_step, lon_step, elevation):
+        self.elevation_grid = np.ascontiguousarray(elevation, dtype=np.float64)
+        self.rows, self.cols = self.elevation_grid.shape
+        self.origin_lat = float(origin_lat)
+        self.origin_lon = float(origin_lon)
+        self.lat_step = float(lat_step)
+        self.lon_step = float(lon_step)
+        self._flat_elevation = self.elevation_grid.reshape(-1)
+        # memoryview indexing yields plain floats, which is much cheaper per edge
+        self._elevation_view = memoryview(self._flat_elevation)
+        self._deltas = [d_row * self.cols + d_col for d_row, d_col in self.DIRECTIONS]
+        self._landmark_cache = {}
+        self._coarse_cache = {}
+        
+        # Edge length depends only on the row and the direction of the step
+        row_lat = self.row_lats()
+        self._step_distance = [[float(haversine_distance(row_lat[r], 0.0, row_lat[r] + d_row * self.lat_step, d_col * self.lon_step))
+                                for d_row, d_col in self.DIRECTIONS] for r in range(self.rows)]
+    
+    def __len__(self):
+        return self.rows * self.cols
+    
+    def nbytes(self):
+        return (self.elevation_grid.nbytes + sum(table.nbytes for table in self._landmark_cache.values()) +
+                sum(coarse.nbytes() for coarse in self._coarse_cache.values()))
+    
+    def row_lats(self):
+        return self.origin_lat + np.arange(self.rows) * self.lat_step
+    
+    def col_lons(self):
+        return self.origin_lon + np.arange(self.cols) * self.lon_step
+    
+    @staticmethod
+    def _axis_window(value, origin, step, size):
+        """Lattice indices along one axis within LAT_LON_THRESHOLD of `value`"""
+        center = (value - origin) / step
+        reach = int(math.ceil(LAT_LON_THRESHOLD / abs(step))) + 1
+        lo = max(int(math.floor(center)) - reach, 0)
+        hi = min(int(math.ceil(center)) + reach, size - 1)
+        return [i for i in range(lo, hi + 1) if abs(origin + i * step - value) <= LAT_LON_THRESHOLD]
+    
+    def nodes_near(self, lat, lon):
+        """Ids of the nodes within LAT_LON_THRESHOLD of (lat, lon), in id order"""
+        rows = self._axis_window(lat, self.origin_lat, self.lat_step, self.rows)
+        cols = self._axis_window(lon, self.origin_lon, self.lon_step, self.cols)
+        return sorted(r * self.cols + c for r in rows for c in cols)
+    
+    def expand(self, node, alpha):
+        """(neighbor_id, cost) for every edge leaving `node`, from index arithmetic"""
+        r, c = divmod(node, self.cols)
+        elevation = self._elevation_view
+        here = elevation[node]
+        step_distance = self._step_distance[r]
+        if 0 < r < self.rows - 1 and 0 < c < self.cols - 1:
+            return [(node + delta, distance + alpha * abs(here - elevation[node + delta]))
+                    for delta, distance in zip(self._deltas, step_distance)]
+        result = []
+        for k, (d_row, d_col) in enumerate(self.DIRECTIONS):
+            if 0 <= r + d_row < self.rows and 0 <= c + d_col < self.cols:
+                neighbor = node + self._deltas[k]
+                result.append((neighbor, step_distance[k] + alpha * abs(here - elevation[neighbor])))
+        return result
+    
+    def landmark_distances(self, alpha):
+        """Landmark cost table for `alpha` (see `prepare_landmarks`), or None"""
+        return self._landmark_cache.get(alpha)
+    
+    def coarsened(self, factor):
+        """This lattice with every `factor x factor` block merged into one node, cached per factor.
+        
+        A coarse node sits at the centre of its block and carries the block's
+        mean elevation; blocks cut off by the grid edge average what they hold.
+        """
+        coarse = self._coarse_cache.get(factor)
+        if coarse is None:
+            rows, cols = -(-self.rows // factor), -(-self.cols // factor)
+            padded = np.full((rows * factor, cols * factor), np.nan)
+            padded[:self.rows, :self.cols] = self.elevation_grid
+            elevation = np.nanmean(padded.reshape(rows, factor, cols, factor), axis=(1, 3))
+            offset = (factor - 1) / 2
+            coarse = LatticeTerrain(self.origin_lat + offset * self.lat_step, self.origin_lon + offset * self.lon_step,
+                                    factor * self.lat_step, factor * self.lon_step, elevation)
+            self._coarse_cache[factor] = coarse
+        return coarse
+    
+    def cell_of(self, lat, lon):
+        """(row, col) of the lattice node nearest to (lat, lon)"""
+        row = min(max(round((lat - self.origin_lat) / self.lat_step), 0), self.rows - 1)
+        col = min(max(round((lon - self.origin_lon) / self.lon_step), 0), self.cols - 1)
+        return row, col
+    
+    def vertex(self, node):
+        """(lat, lon, elevation, point_type) of a single node"""
+        r, c = divmod(node, self.cols)
+        return (self.origin_lat + r * self.lat_step, self.origin_lon + c * self.lon_step,
+                float(self._flat_elevation[node]), 'grid')
+    
+    def coordinates(self, nodes):
+        """(lat, lon, elevation) arrays for an array of node ids"""
+        r, c = np.divmod(nodes, self.cols)
+        return (self.origin_lat + r * self.lat_step, self.origin_lon + c * self.lon_step,
+                self._flat_elevation[nodes])
+    
+    def shared_state(self):
+        """Split the lattice into large arrays (for shared memory) and small picklable state"""
+        state = {'origin': (self.origin_lat, self.origin_lon), 'step': (self.lat_step, self.lon_step)}
+        arrays = {'elevation_grid': self.elevation_grid}
+        for alpha, table in self._landmark_cache.items():
+            arrays[f'landmarks:{alpha!r}'] = table
+        return arrays, state
+    
+    @classmethod
+    def from_shared(cls, arrays, state):
+        """Rebuild a lattice around an elevation grid that lives in shared memory"""
+        lattice = cls(*state['origin'], *state['step'], arrays['elevation_grid'])
+        lattice._landmark_cache = _tables_by_alpha(arrays, 'landmarks')
+        return lattice
+
+def detect_lattice(lat, lon):
+    """Recognise points laid out as a regular row-major lat/lng grid.
+    
+    Returns `(origin_lat, origin_lon, lat_step, lon_step, rows, cols)` when every
+    row shares one latitude, every column one longitude, and the spacing is
+    uniform with steps in (LAT_LON_THRESHOLD / 2, LAT_LON_THRESHOLD] - exactly
+    the case where threshold adjacency is the 8-connected lattice. Otherwise None.
+    """
+    n = len(lat)
+    if n < 4:
+        return None
+    different = np.flatnonzero(lat != lat[0])
+    cols = int(different[0]) if len(different) else n
+    rows = n // cols
+    if rows < 2 or cols < 2 or rows * cols != n:
+        return None
+    lat_grid = lat.reshape(rows, cols)
+    lon_grid = lon.reshape(rows, cols)
+    if not ((lat_grid == lat_grid[:, :1]).all() and (lon_grid == lon_grid[:1, :]).all()):
+        return None
+    
+    axes = []
+    for values in (lat_grid[:, 0], lon_grid[0, :]):
+        step = (values[-1] - values[0]) / (len(values) - 1)
+        if not (LAT_LON_THRESHOLD / 2 < abs(step) <= LAT_LON_THRESHOLD):
+            return None
+        # Accumulated float error from the frontend's `lat += step` loops is tiny;
+        # anything bigger means the spacing is genuinely irregular
+        model = values[0] + np.arange(len(values)) * step
+        if np.abs(values - model).max() > abs(step) * 1e-6:
+            return None
+        axes.append((float(values[0]), float(step)))
+    (origin_lat, lat_step), (origin_lon, lon_step) = axes
+    return origin_lat, origin_lon, lat_step, lon_step, rows, cols
+
+def lower_costs(graph, dist, heap, alpha=25):
+    """Dijkstra that lowers the costs in `dist` from the (cost, node) entries in `heap`.
+    
+    `dist` must hold upper bounds on the true costs; entries are only ever
+    decreased, so seeding it with known costs corrects just the nodes that
+    have cheaper paths.
+    """
+    heapq.heapify(heap)
+    while heap:
+        cost, node = heapq.heappop(heap)
+        if cost > dist[node]:
+            continue  # stale entry
+        for neighbor, edge_cost in graph.expand(node, alpha):
+            new_cost = cost + edge_cost
+            if new_cost < dist[neighbor]:
+                dist[neighbor] = new_cost
+                heapq.heappush(heap, (new_cost, neighbor))
+    return dist
+
+def dijkstra_costs(graph, source, alpha=25):
+    """Cheapest search cost from `source` to every node of `graph` (inf if unreachable)"""
+    dist = [math.inf] * len(graph)
+    dist[source] = 0.0
+    return np.array(lower_costs(graph, dist, [(0.0, source)], alpha))
+
+@stage_seconds.time(stage='landmarks')
+def prepare_landmarks(terrain, alpha=25, count=LANDMARK_COUNT):
+    """Precompute the landmark (ALT) cost tables of a terrain for `alpha`.
+    
+    Landmarks are chosen by farthest-point selection: each new one is the node
+    with the highest cost to the landmarks chosen so far, which pushes them to
+    the edges of the terrain where the bounds are tightest. Edge costs are
+    symmetric, so a single Dijkstra per landmark gives both the cost to and
+    from it. The `count x len(terrain)` table is stored on the terrain, so it
+    stays cached with it in `terrain_cache` and is published to segment
+    workers with the rest of the graph.
+    """
+    table = terrain.landmark_distances(alpha)
+    if table is not None:
+        return table
+    
+    log(f"🧭 Precomputing {count} landmarks for alpha={alpha} over {len(terrain)} nodes")
+    nearest = dijkstra_costs(terrain, 0, alpha)
+    landmarks, rows = [], []
+    for _ in range(count):
+        # inf (a part not reached yet) sorts above every finite cost
+        landmark = int(np.argmax(nearest))
+        if landmarks and nearest[landmark] == 0:
+            break  # every node already is a landmark
+        costs = dijkstra_costs(terrain, landmark, alpha)
+        nearest = costs if not landmarks else np.minimum(nearest, costs)
+        landmarks.append(landmark)
+        rows.append(costs)
+    
+    table = np.array(rows)
+    terrain._landmark_cache[alpha] = table
+    log(f"🧭 Landmarks at nodes {landmarks} ({table.nbytes // 1024} KiB)")
+    return table
+
+class SearchCancelled(Exception):
+    """Raised inside a search when the request that started it has gone away"""
+
+class DeadlineExceeded(TimeoutError):
+    """Raised when a search runs out of time and a partial route was not wanted"""
+
+class Deadline:
+    """Time budget shared by the searches of one request.
+    
+    Searches call `check` every DEADLINE_CHECK_INTERVAL iterations. Once
+    `seconds` have passed it returns True and the search stops, returning an
+    approximate route if `partial` is set (see `partial_path`) or raising
+    DeadlineExceeded otherwise. `cancelled` is an optional callable polled at
+    the same points; when it returns True, SearchCancelled is raised. It is
+    dropped when the deadline is sent to worker processes, which share the
+    monotonic clock but not the request.
+    """
+    
+    def __init__(self, seconds=None, partial=True, cancelled=None):
+        self.expires = None if seconds is None else time.monotonic() + seconds
+        self.partial = partial
+        self.cancelled = cancelled
+        self.exceeded = False
+    
+    def __getstate__(self):
+        return dict(self.__dict__, cancelled=None)
+    
+    def check(self):
+        if self.cancelled is not None and self.cancelled():
+            raise SearchCancelled("The client disconnected")
+        if self.expires is not None and time.monotonic() >= self.expires:
+            self.exceeded = True
+        return self.exceeded
+
+def expired(deadline, iterations):
+    """Whether a search at `iterations` should stop for `deadline` (checked every DEADLINE_CHECK_INTERVAL)"""
+    return deadline is not None and iterations % DEADLINE_CHECK_INTERVAL == 0 and deadline.check()
+
+def closest_reached(reached, closeness, origin):
+    """The node in `reached` with the smallest `closeness`, the lowest id on ties (`origin` if `reached` is empty)"""
+    return min(reached, key=lambda node: (closeness[node], node), default=origin)
+
+def partial_path(deadline, path, stats):
+    """The route a search stopped by `deadline` returns, flagged in `stats` as approximate.
+    
+    `path` runs from the start to the reached node closest to the goal and
+    then straight on to the goal, so the route is complete but the final
+    jump does not follow the terrain.
+    """
+    if not deadline.partial:
+        raise DeadlineExceeded("The search ran out of time")
+    log(f"⏱️ Deadline reached, returning an approximate path of {len(path)} points")
+    if stats is not None:
+        stats['approximate'] = True
+    return path
+
 def reconstruct_path(came_from, start_id, goal_id):
     path = [goal_id]
     current = goal_id
@@ -70,130 +872,529 @@ def reconstruct_path(came_from, start_id, goal_id):
     path.reverse()
     return path
 
-def astar(points, start_id, goal_id, alpha=25):
-    print(f"🎯 Finding path from {points[start_id].point_type} to {points[goal_id].point_type}")
+def astar(graph, start_id, goal_id, alpha=25, stats=None, deadline=None):
+    """A* over `graph` with cost `distance + alpha * elevation difference`.
+    
+    Edge costs come precomputed from the graph and the heuristic (haversine,
+    tightened by landmarks when the terrain has them) is computed in vectorised
+    chunks as the search reaches them, so the search loop does no trigonometry.
+    Search state is kept in dicts over the nodes reached, so a short leg costs
+    the same on a small terrain as on a huge one. If `stats` is a dict it is filled
+    with the number of expanded nodes, heap pushes and heap pops.
+    When `deadline` (a Deadline) expires first, the path runs to the expanded
+    node closest to the goal and then straight on (see `partial_path`).
+    """
+    log(f"🎯 Finding path from {graph.point_type[start_id]} to {graph.point_type[goal_id]}")
     
-    open_set = []
-    heapq.heappush(open_set, (0, start_id))
+    h = graph.heuristic(goal_id, alpha)
+    open_set = [(float(h[start_id]), start_id)]
     came_from = {}
-    g_score = {start_id: 0}
-    f_score = {start_id: haversine_distance(points[start_id], points[goal_id])}
-    closed_set = set()
+    g_score = {start_id: 0.0}
+    closed = set()
     
     iterations = 0
-    max_iterations = len(points) * 5
+    expanded = 0
+    pushes = 1
+    max_iterations = len(graph) * 5
+    path = None
+    timed_out = False
 
     while open_set and iterations < max_iterations:
+        if expired(deadline, iterations):
+            timed_out = True
+            break
         iterations += 1
         _, current = heapq.heappop(open_set)
+        if current in closed:
+            continue  # stale entry left behind by a later, cheaper push
         if current == goal_id:
             path = reconstruct_path(came_from, start_id, goal_id)
-            print(f"✅ Path found in {iterations} iterations with {len(path)} points")
-            return path
-        closed_set.add(current)
+            break
+        closed.add(current)
+        expanded += 1
 
-        for neighbor_id, _ in points[current].neighbors:
-            if neighbor_id in closed_set:
+        current_g = g_score[current]
+        for neighbor_id, cost in graph.expand(current, alpha):
+            if neighbor_id in closed:
                 continue
+            tentative_g = current_g + cost
+            if tentative_g < g_score.get(neighbor_id, math.inf):
+                came_from[neighbor_id] = current
+                g_score[neighbor_id] = tentative_g
+                heapq.heappush(open_set, (tentative_g + h[neighbor_id], neighbor_id))
+                pushes += 1
 
-            dist = haversine_distance(points[current], points[neighbor_id])
-            elev = elevation_difference(points[current], points[neighbor_id])
-            cost = dist + alpha * elev
+    if stats is not None:
+        stats.update(expanded=expanded, pushes=pushes, iterations=iterations)
+    if timed_out:
+        closest = closest_reached(closed, h, start_id)
+        path = reconstruct_path(came_from, start_id, closest) + ([goal_id] if closest != goal_id else [])
+        return partial_path(deadline, path, stats)
+    if path is None:
+        log(f"❌ No path found after {iterations} iterations")
+        return None
+    log(f"✅ Path found in {iterations} iterations ({expanded} nodes expanded) with {len(path)} points")
+    return path
 
-            tentative_g = g_score[current] + cost
-            if neighbor_id not in g_score or tentative_g < g_score[neighbor_id]:
+def bidirectional_astar(graph, start_id, goal_id, alpha=25, stats=None, deadline=None):
+    """Bidirectional A* returning a path of the same cost as `astar`.
+    
+    Both searches use the average potential p(v) = (h_goal(v) - h_start(v)) / 2
+    (negated for the backward search), which keeps them consistent with each
+    other on the symmetric `dist + alpha * elev` edge costs. `best` tracks the
+    cheapest start→goal path seen where the searches touch, and the search
+    stops once the two smallest keys sum to at least `best`: no unexpanded
+    node can then lie on a cheaper path. The side with the smaller frontier
+    is expanded next. There is no iteration cap; every node is expanded at
+    most once per direction. If `deadline` expires first, the route through
+    the best meeting point so far is returned, or, before the searches have
+    met, the two partial paths joined by a straight jump (see `partial_path`).
+    As in `astar`, the heuristics are computed lazily and the search state
+    (scores, closed sets and the potentials themselves) only holds the nodes
+    the searches reach.
+    """
+    log(f"🎯 Finding path from {graph.point_type[start_id]} to {graph.point_type[goal_id]} (bidirectional)")
+    
+    h_goal, h_start = graph.heuristic(goal_id, alpha), graph.heuristic(start_id, alpha)
+    potentials = {}
+    
+    def potential(node):
+        p = potentials.get(node)
+        if p is None:
+            p = potentials[node] = (h_goal[node] - h_start[node]) / 2
+        return p
+    
+    forward = {'open': [(potential(start_id), start_id)], 'g': {start_id: 0.0}, 'sign': 1.0,
+               'came_from': {}, 'closed': set()}
+    backward = {'open': [(-potential(goal_id), goal_id)], 'g': {goal_id: 0.0}, 'sign': -1.0,
+                'came_from': {}, 'closed': set()}
+    
+    best = 0.0 if start_id == goal_id else math.inf
+    meeting = start_id if start_id == goal_id else None
+    expanded = 0
+    pushes = 2
+    iterations = 0
+    timed_out = False
+    
+    while forward['open'] and backward['open']:
+        if forward['open'][0][0] + backward['open'][0][0] >= best:
+            break  # no path through an unexpanded node can beat `best`
+        if expired(deadline, iterations):
+            timed_out = True
+            break
+        side, other = (forward, backward) if len(forward['open']) <= len(backward['open']) else (backward, forward)
+        iterations += 1
+        _, current = heapq.heappop(side['open'])
+        g_score, sign, came_from, closed = side['g'], side['sign'], side['came_from'], side['closed']
+        if current in closed:
+            continue  # stale entry left behind by a later, cheaper push
+        closed.add(current)
+        expanded += 1
+        
+        other_g = other['g']
+        current_g = g_score[current]
+        for neighbor_id, cost in graph.expand(current, alpha):
+            if neighbor_id in closed:
+                continue
+            tentative_g = current_g + cost
+            if tentative_g < g_score.get(neighbor_id, math.inf):
                 came_from[neighbor_id] = current
                 g_score[neighbor_id] = tentative_g
-                f_score[neighbor_id] = tentative_g + haversine_distance(points[neighbor_id], points[goal_id])
-                heapq.heappush(open_set, (f_score[neighbor_id], neighbor_id))
+                heapq.heappush(side['open'], (tentative_g + sign * potential(neighbor_id), neighbor_id))
+                pushes += 1
+                through = tentative_g + other_g.get(neighbor_id, math.inf)
+                if through < best:
+                    best = through
+                    meeting = neighbor_id
+    
+    if stats is not None:
+        stats.update(expanded=expanded, pushes=pushes, iterations=iterations)
+    if meeting is None and timed_out:
+        near_goal = closest_reached(forward['closed'], h_goal, start_id)
+        near_start = closest_reached(backward['closed'], h_start, goal_id)
+        path = reconstruct_path(forward['came_from'], start_id, near_goal)
+        path.extend(reversed(reconstruct_path(backward['came_from'], goal_id, near_start)))
+        return partial_path(deadline, path, stats)
+    if meeting is None:
+        log(f"❌ No path found after {iterations} iterations")
+        return None
+    path = reconstruct_path(forward['came_from'], start_id, meeting)
+    path.extend(reversed(reconstruct_path(backward['came_from'], goal_id, meeting)[:-1]))
+    if timed_out:
+        return partial_path(deadline, path, stats)  # complete, but not proven cheapest
+    log(f"✅ Path found in {iterations} iterations ({expanded} nodes expanded) with {len(path)} points")
+    return path
 
-    print(f"❌ No path found after {iterations} iterations")
-    return None
+class CorridorGraph:
+    """View of a graph that only lets searches enter the nodes in the set `allowed`"""
+    
+    def __init__(self, graph, allowed):
+        self.graph = graph
+        self.allowed = allowed
+        self.point_type = graph.point_type
+    
+    def __len__(self):
+        return len(self.graph)
+    
+    def expand(self, node, alpha):
+        allowed = self.allowed
+        return [(neighbor, cost) for neighbor, cost in self.graph.expand(node, alpha) if neighbor in allowed]
+    
+    def heuristic(self, goal, alpha=None):
+        return self.graph.heuristic(goal, alpha)
 
-def is_direct_connection(p1, p2):
-    return are_adjacent(p1, p2) and elevation_difference(p1, p2) <= ELEVATION_THRESHOLD
+def corridor_cells(coarse, path, width):
+    """Ids of the cells of lattice `coarse` within `width` cells of `path`, diagonals included"""
+    rows, cols = np.divmod(np.asarray(path), coarse.cols)
+    offsets = np.arange(-width, width + 1)
+    rows = (rows[:, None, None] + offsets[None, :, None]).repeat(len(offsets), axis=2).ravel()
+    cols = (cols[:, None, None] + offsets[None, None, :]).repeat(len(offsets), axis=1).ravel()
+    inside = (rows >= 0) & (rows < coarse.rows) & (cols >= 0) & (cols < coarse.cols)
+    return np.unique(rows[inside] * coarse.cols + cols[inside])
 
-def smooth_path(path, points):
+def corridor_nodes(graph, coarse, cells, factor):
+    """`(allowed, count)`: the set of ids of the `count` terrain nodes in the blocks of `cells`, plus the extra nodes.
+    
+    Extra nodes only link to terrain nodes right next to them, so they can
+    always be entered. The set only holds the corridor, so building it costs
+    the same on any size of terrain.
+    """
+    terrain = graph.terrain
+    offsets = np.arange(factor)
+    block_rows, block_cols = np.divmod(cells, coarse.cols)
+    rows = block_rows[:, None, None] * factor + offsets[None, :, None]
+    cols = block_cols[:, None, None] * factor + offsets[None, None, :]
+    # Blocks on the last row or column may be cut off by the grid edge
+    inside = (rows < terrain.rows) & (cols < terrain.cols)
+    nodes = (rows * terrain.cols + cols)[inside]
+    allowed = set(nodes.tolist())
+    allowed.update(range(graph.terrain_size, len(graph)))
+    return allowed, len(nodes)
+
+def hierarchical_astar(graph, start_id, goal_id, alpha=25, stats=None, deadline=None, corridor=CORRIDOR_WIDTH,
+                       factor=COARSE_FACTOR):
+    """Coarse-to-fine search for large regular grids.
+    
+    The leg is first routed on the lattice coarsened by `factor` (see
+    `LatticeTerrain.coarsened`) and then refined at full resolution, but
+    only inside a corridor `corridor` coarse cells wide around the coarse
+    route. The refined path is the cheapest one inside the corridor, which
+    can cost slightly more than an unrestricted search. If the corridor
+    holds no path at all it was too tight: the leg is searched again over
+    the whole graph and `stats['fallback']` is set; the leg's counts then
+    include both searches, with those of the corridor search alone kept
+    under `stats['corridor']`. Terrains that are not lattices, or are too
+    small to coarsen, go straight to `bidirectional_astar`.
+    `deadline` covers both levels; a leg that runs out of time is not searched
+    again over the whole graph.
+    """
+    if stats is None:
+        stats = {}
+    stats['fallback'] = False
+    terrain = graph.terrain
+    if not isinstance(terrain, LatticeTerrain) or min(terrain.rows, terrain.cols) < 4 * factor:
+        return bidirectional_astar(graph, start_id, goal_id, alpha, stats, deadline)
+    
+    coarse = terrain.coarsened(factor)
+    
+    def coarse_node(node):
+        row, col = terrain.cell_of(*graph.vertex(node)[:2])
+        return (row // factor) * coarse.cols + col // factor
+    
+    log(f"🧭 Hierarchical search on a {coarse.rows}x{coarse.cols} coarse lattice, corridor {corridor}")
+    coarse_path = bidirectional_astar(RoutingGraph(coarse), coarse_node(start_id), coarse_node(goal_id), alpha,
+                                      deadline=deadline)
+    corridor_stats = {}
+    if coarse_path is not None:
+        allowed, stats['corridorNodes'] = corridor_nodes(graph, coarse, corridor_cells(coarse, coarse_path, corridor),
+                                                         factor)
+        path = bidirectional_astar(CorridorGraph(graph, allowed), start_id, goal_id, alpha, corridor_stats, deadline)
+        if path is not None:
+            stats.update(corridor_stats)
+            return path
+        stats['corridor'] = dict(corridor_stats)
+    
+    log("↩️ No path inside the corridor, searching the whole graph")
+    stats['fallback'] = True
+    path = bidirectional_astar(graph, start_id, goal_id, alpha, stats, deadline)
+    for name, count in corridor_stats.items():
+        stats[name] += count  # the leg also did the work of the failed corridor search
+    return path
+
+# Search functions selectable per request
+SEARCH_METHODS = {
+    'astar': astar,
+    'bidirectional': bidirectional_astar,
+    'hierarchical': hierarchical_astar,
+}
+# Searches that always return a cheapest path
+EXACT_SEARCHES = ('astar', 'bidirectional')
+# Integer options each search accepts, with their minimum value
+SEARCH_OPTIONS = {
+    'hierarchical': {'corridor': 0, 'factor': 2},
+}
+
+def search_name(search):
+    return search.get('method', DEFAULT_SEARCH) if isinstance(search, dict) else search
+
+def search_function(search):
+    """The search function for `search`.
+    
+    `search` is a name from SEARCH_METHODS, or a dict with the name under
+    'method' plus options for it, e.g. {'method': 'hierarchical', 'corridor': 4}.
+    """
+    name = search_name(search)
+    if name not in SEARCH_METHODS:
+        raise ValueError(f"Unknown search '{name}', expected one of {sorted(SEARCH_METHODS)}")
+    if not isinstance(search, dict):
+        return SEARCH_METHODS[name]
+    
+    accepted = SEARCH_OPTIONS.get(name, {})
+    options = {option: value for option, value in search.items() if option != 'method'}
+    for option, value in options.items():
+        if option not in accepted:
+            raise ValueError(f"Unknown option '{option}' for search '{name}'")
+        if not isinstance(value, int) or isinstance(value, bool) or value < accepted[option]:
+            raise ValueError(f"Search option '{option}' must be an integer >= {accepted[option]}")
+    return functools.partial(SEARCH_METHODS[name], **options)
+
+def is_direct_connection(graph, a, b):
+    return are_adjacent(graph, a, b) and elevation_difference(graph, a, b) <= ELEVATION_THRESHOLD
+
+def farthest_shortcuts(path, graph):
+    """For every index i, the largest j > i + 1 with a direct connection from path[i] to path[j], or -1.
+    
+    Only points within LAT_LON_THRESHOLD of each other can connect, so the
+    candidate pairs come from the same spatial-hash join used to build the
+    graph and are checked against ELEVATION_THRESHOLD in one batch.
+    """
+    lat, lon, elevation = graph.coordinates(path)
+    src, dst = adjacent_pairs(lat, lon)
+    keep = (dst > src + 1) & (np.abs(elevation[src] - elevation[dst]) <= ELEVATION_THRESHOLD)
+    farthest = np.full(len(path), -1, dtype=np.int64)
+    np.maximum.at(farthest, src[keep], dst[keep])
+    return farthest
+
+@stage_seconds.time(stage='smooth')
+def smooth_path(path, graph):
+    """Greedy line-of-sight smoothing: from each kept point, jump to the last
+    point of the path it connects to directly, or step to the next one."""
     if len(path) < 3:
         return path
+    farthest = farthest_shortcuts(path, graph).tolist()
     smoothed = [path[0]]
     i = 0
     while i < len(path) - 1:
-        j = len(path) - 1
-        while j > i + 1:
-            if is_direct_connection(points[path[i]], points[path[j]]):
-                smoothed.append(path[j])
-                i = j
-                break
-            j -= 1
-        else:
-            smoothed.append(path[i+1])
-            i += 1
+        i = farthest[i] if farthest[i] >= 0 else i + 1
+        smoothed.append(path[i])
     
-    print(f"🔄 Smoothed path from {len(path)} to {len(smoothed)} points")
+    log(f"🔄 Smoothed path from {len(path)} to {len(smoothed)} points")
     return smoothed
 
-def add_intermediate_points(path, points, density=7):
-    """Add intermediate points between path segments for smoother curves"""
-    if len(path) < 2:
-        return path
+class Route:
+    """Route vertices as parallel arrays of lat, lon, elevation and point_type"""
     
-    enhanced_path = [path[0]]
+    FIELDS = ('lat', 'lon', 'elevation', 'point_type')
     
-    for i in range(len(path) - 1):
-        current_id = path[i]
-        next_id = path[i + 1]
-        current_point = points[current_id]
-        next_point = points[next_id]
-        
-        # Add intermediate points between current and next
-        for j in range(1, density):
-            ratio = j / density
-            
-            # Simple linear interpolation
-            lat = current_point.lat + (next_point.lat - current_point.lat) * ratio
-            lon = current_point.lon + (next_point.lon - current_point.lon) * ratio
-            elevation = current_point.elevation + (next_point.elevation - current_point.elevation) * ratio
-            
-            interp_id = f"interp_{i}_{j}"
-            enhanced_path.append(interp_id)
-            points[interp_id] = Point(interp_id, lat, lon, elevation, 'interpolated')
-        
-        enhanced_path.append(next_id)
+    def __init__(self, lat, lon, elevation, point_type):
+        self.lat = np.asarray(lat, dtype=np.float64)
+        self.lon = np.asarray(lon, dtype=np.float64)
+        self.elevation = np.asarray(elevation, dtype=np.float64)
+        self.point_type = np.asarray(point_type, dtype=object)
+    
+    def __len__(self):
+        return len(self.lat)
+    
+    def __iter__(self):
+        """(lat, lon, elevation, point_type) tuples, one per vertex"""
+        return zip(self.lat.tolist(), self.lon.tolist(), self.elevation.tolist(), self.point_type.tolist())
+    
+    def __getitem__(self, index):
+        """The vertices selected by a slice or index array, as a new Route"""
+        return Route(*(getattr(self, field)[index] for field in self.FIELDS))
+    
+    @classmethod
+    def concatenate(cls, routes):
+        return cls(*(np.concatenate([getattr(route, field) for route in routes]) for field in cls.FIELDS))
+
+def path_vertices(path, graph):
+    """Turn a path of node ids into a Route of its vertices"""
+    return Route(*graph.coordinates(path), [graph.point_type[pid] for pid in path])
+
+@stage_seconds.time(stage='densify')
+def add_intermediate_points(path, graph, density=DENSITY):
+    """Add intermediate points between path segments for smoother curves.
     
-    print(f"🎨 Enhanced path: {len(path)} → {len(enhanced_path)} points")
+    Every segment gets `density - 1` linearly interpolated vertices, computed
+    for all segments at once as a (segments x density) block.
+    """
+    vertices = path_vertices(path, graph)
+    if len(path) < 2:
+        return vertices
+    
+    ratios = np.arange(density) / density
+    columns = []
+    for values in (vertices.lat, vertices.lon, vertices.elevation):
+        # Row i holds path[i] (ratio 0) followed by its interpolated points
+        block = values[:-1, None] + (values[1:] - values[:-1])[:, None] * ratios
+        columns.append(np.append(block.ravel(), values[-1]))
+    point_type = np.full(len(columns[0]), 'interpolated', dtype=object)
+    point_type[::density] = vertices.point_type
+    enhanced_path = Route(*columns, point_type)
+    
+    log(f"🎨 Enhanced path: {len(path)} → {len(enhanced_path)} points")
     return enhanced_path
 
-def get_sequential_waypoints(points):
+def get_sequential_waypoints(graph):
     """Get waypoints in the order they were clicked (1, 2, 3, etc.)"""
     start_point = None
     end_point = None
     waypoints = []
     
-    # Find start and end points
-    for p in points.values():
-        if p.point_type == 'start':
-            start_point = p
-        elif p.point_type == 'end':
-            end_point = p
-        elif p.point_type.startswith('w'):
-            waypoints.append(p)
+    # Find start and end points among the pre-masked key points only
+    for pid in graph.waypoint_ids.tolist():
+        point_type = graph.point_type[pid]
+        if point_type == 'start':
+            start_point = pid
+        elif point_type == 'end':
+            end_point = pid
+        else:
+            waypoints.append(pid)
     
-    if not start_point or not end_point:
+    if start_point is None or end_point is None:
         raise ValueError("Missing start or end point")
     
     # Sort waypoints by their number (w1, w2, w3, etc.)
-    waypoints_sorted = sorted(waypoints, key=lambda p: int(p.point_type[1:]) if p.point_type[1:].isdigit() else 0)
+    waypoint_number = lambda pid: int(graph.point_type[pid][1:]) if graph.point_type[pid][1:].isdigit() else 0
+    waypoints_sorted = sorted(waypoints, key=waypoint_number)
     
     # Create sequential route: start → w1 → w2 → w3 → end
     sequential_route = [start_point] + waypoints_sorted + [end_point]
     
-    print(f"🗺️ Sequential route: {' → '.join([p.point_type for p in sequential_route])}")
+    log(f"🗺️ Sequential route: {' → '.join([graph.point_type[pid] for pid in sequential_route])}")
     return sequential_route
 
-def calculate_route_stats(path, points):
-    """Calculate comprehensive route statistics"""
-    if not path or len(path) < 2:
+def one_to_many_costs(graph, source, targets, alpha=25):
+    """Search cost from `source` to each of `targets` (inf if unreachable).
+    
+    A single Dijkstra that stops as soon as every target is settled.
+    """
+    remaining = set(targets)
+    remaining.discard(source)
+    dist = [math.inf] * len(graph)
+    dist[source] = 0.0
+    closed = bytearray(len(graph))
+    heap = [(0.0, source)]
+    while heap and remaining:
+        cost, node = heapq.heappop(heap)
+        if closed[node]:
+            continue
+        closed[node] = 1
+        remaining.discard(node)
+        for neighbor, edge_cost in graph.expand(node, alpha):
+            new_cost = cost + edge_cost
+            if new_cost < dist[neighbor]:
+                dist[neighbor] = new_cost
+                heapq.heappush(heap, (new_cost, neighbor))
+    return [dist[target] for target in targets]
+
+def waypoint_cost_matrix(graph, waypoints, alpha=25):
+    """Symmetric matrix of search costs between waypoints.
+    
+    Edge costs are symmetric, so waypoint i only searches for the waypoints
+    after it: k - 1 one-to-many searches with shrinking target sets instead
+    of k^2 point-to-point ones.
+    """
+    k = len(waypoints)
+    costs = [[0.0] * k for _ in range(k)]
+    for i in range(k - 1):
+        for j, cost in enumerate(one_to_many_costs(graph, waypoints[i], waypoints[i + 1:], alpha), i + 1):
+            costs[i][j] = costs[j][i] = cost
+    return costs
+
+def _held_karp_order(costs, middle, start, end):
+    """Cheapest start → (all of middle) → end order, exactly, by dynamic programming over subsets"""
+    m = len(middle)
+    best = {(1 << j, j): (costs[start][middle[j]], None) for j in range(m)}
+    for mask in range(1, 1 << m):
+        for j in range(m):
+            if (mask, j) not in best:
+                continue
+            cost_so_far = best[mask, j][0]
+            for nxt in range(m):
+                if mask & (1 << nxt):
+                    continue
+                key = (mask | (1 << nxt), nxt)
+                cost = cost_so_far + costs[middle[j]][middle[nxt]]
+                if key not in best or cost < best[key][0]:
+                    best[key] = (cost, j)
+    full = (1 << m) - 1
+    last = min(range(m), key=lambda j: best[full, j][0] + costs[middle[j]][end])
+    order = []
+    mask = full
+    while last is not None:
+        order.append(middle[last])
+        mask, last = mask & ~(1 << last), best[mask, last][1]
+    order.reverse()
+    return order
+
+def _two_opt_order(costs, middle, start, end):
+    """Nearest-neighbour order of middle from start, improved by 2-opt moves with both ends fixed"""
+    unvisited = set(middle)
+    order = []
+    current = start
+    while unvisited:
+        current = min(unvisited, key=lambda w: (costs[current][w], w))
+        unvisited.remove(current)
+        order.append(current)
+    
+    tour = [start] + order + [end]
+    improved = True
+    while improved:
+        improved = False
+        for i in range(1, len(tour) - 2):
+            for j in range(i + 1, len(tour) - 1):
+                a, b, c, d = tour[i - 1], tour[i], tour[j], tour[j + 1]
+                if costs[a][c] + costs[b][d] < costs[a][b] + costs[c][d] - 1e-9:
+                    tour[i:j + 1] = reversed(tour[i:j + 1])
+                    improved = True
+    return tour[1:-1]
+
+@stage_seconds.time(stage='order')
+def optimize_waypoint_order(graph, alpha=25):
+    """Waypoint node ids from start to end in the cheapest visiting order.
+    
+    Start and end stay fixed; the intermediate waypoints are ordered exactly
+    (Held-Karp) when there are at most EXACT_ORDER_LIMIT of them, and by
+    nearest neighbour plus 2-opt otherwise. Costs come from
+    `waypoint_cost_matrix`, so they are the same costs the legs are routed with.
+    """
+    sequence = get_sequential_waypoints(graph)
+    if len(sequence) < 4:
+        return sequence  # at most one intermediate waypoint: nothing to reorder
+    
+    log(f"🧮 Optimizing the order of {len(sequence) - 2} intermediate waypoints")
+    costs = waypoint_cost_matrix(graph, sequence, alpha)
+    start, end, middle = 0, len(sequence) - 1, list(range(1, len(sequence) - 1))
+    if len(middle) <= EXACT_ORDER_LIMIT:
+        order = _held_karp_order(costs, middle, start, end)
+    else:
+        order = _two_opt_order(costs, middle, start, end)
+    
+    tour = [start] + order + [end]
+    if any(math.isinf(costs[a][b]) for a, b in zip(tour, tour[1:])):
+        raise ValueError("No path found between some of the waypoints")
+    clicked_cost = sum(costs[a][a + 1] for a in range(end))
+    optimized_cost = sum(costs[a][b] for a, b in zip(tour, tour[1:]))
+    log(f"🧮 Visiting order cost {optimized_cost:.0f} (clicked order {clicked_cost:.0f})")
+    if clicked_cost <= optimized_cost:
+        return sequence  # the heuristic never returns a worse order than the clicked one
+    return [sequence[i] for i in tour]
+
+@stage_seconds.time(stage='stats')
+def calculate_route_stats(route):
+    """Calculate comprehensive route statistics from a Route"""
+    if len(route) < 2:
         return {
             'distance': 0,
             'elevationGain': 0,
@@ -203,87 +1404,329 @@ def calculate_route_stats(path, points):
             'lowestPoint': 0
         }
     
-    total_distance = 0
-    elevation_gain = 0
-    elevation_loss = 0
-    elevations = [points[pid].elevation for pid in path]
-    
-    # Calculate distance and elevation changes
-    for i in range(len(path) - 1):
-        p1 = points[path[i]]
-        p2 = points[path[i + 1]]
-        
-        # Add distance
-        total_distance += haversine_distance(p1, p2)
-        
-        # Calculate elevation changes
-        elev_diff = p2.elevation - p1.elevation
-        if elev_diff > 0:
-            elevation_gain += elev_diff
-        else:
-            elevation_loss += abs(elev_diff)
+    # Distance and elevation change of every leg at once
+    total_distance = float(haversine_distance(route.lat[:-1], route.lon[:-1], route.lat[1:], route.lon[1:]).sum())
+    elev_diff = np.diff(route.elevation)
+    elevation_gain = float(elev_diff[elev_diff > 0].sum())
+    elevation_loss = float(-elev_diff[elev_diff < 0].sum()) + 0.0  # + 0.0: no descent gives 0.0, not -0.0
     
     stats = {
         'distance': total_distance,
         'elevationGain': elevation_gain,
         'elevationLoss': elevation_loss,
         'netElevationChange': elevation_gain - elevation_loss,
-        'highestPoint': max(elevations),
-        'lowestPoint': min(elevations)
+        'highestPoint': float(route.elevation.max()),
+        'lowestPoint': float(route.elevation.min())
     }
     
-    print(f"📊 Route stats: {total_distance:.0f}m distance, {elevation_gain:.1f}m gain, {elevation_loss:.1f}m loss")
+    log(f"📊 Route stats: {total_distance:.0f}m distance, {elevation_gain:.1f}m gain, {elevation_loss:.1f}m loss")
     return stats
 
-def smooth_path_preserve_keys(path, points, key_points):
-    final_route = []
+@stage_seconds.time(stage='simplify')
+def simplify_indices(route, tolerance, keep=()):
+    """Indices of the vertices a Douglas-Peucker simplification keeps.
+    
+    A vertex is dropped when it lies within `tolerance` metres (horizontally)
+    of the line between the vertices kept around it. The first and last
+    vertices and those in `keep` always stay. Each split measures the whole
+    span at once, on an equirectangular projection around the route.
+    """
+    keep_mask = np.zeros(len(route), dtype=bool)
+    if len(route) == 0:
+        return np.flatnonzero(keep_mask)
+    keep_mask[[0, -1]] = True
+    keep_mask[list(keep)] = True
+    
+    metres_per_degree = np.pi / 180 * 6371000
+    x = route.lon * metres_per_degree * np.cos(np.radians(route.lat.mean()))
+    y = route.lat * metres_per_degree
+    
+    anchors = np.flatnonzero(keep_mask)
+    spans = list(zip(anchors[:-1].tolist(), anchors[1:].tolist()))
+    while spans:
+        first, last = spans.pop()
+        if last - first < 2:
+            continue
+        # Distance of the inner vertices to the segment first -> last
+        dx, dy = x[last] - x[first], y[last] - y[first]
+        px, py = x[first + 1:last] - x[first], y[first + 1:last] - y[first]
+        length_sq = dx * dx + dy * dy
+        t = np.clip((px * dx + py * dy) / length_sq, 0, 1) if length_sq else 0
+        distance = np.hypot(px - t * dx, py - t * dy)
+        farthest = int(distance.argmax())
+        if distance[farthest] > tolerance:
+            split = first + 1 + farthest
+            keep_mask[split] = True
+            spans.append((first, split))
+            spans.append((split, last))
+    return np.flatnonzero(keep_mask)
+
+def smooth_path_preserve_keys(path, graph, key_points):
+    # First position of every node, as path.index would find it
+    position = {}
+    for index, node in enumerate(path):
+        position.setdefault(node, index)
+    
+    parts = []
     for i in range(len(key_points) - 1):
-        try:
-            start_index = path.index(key_points[i])
-            end_index = path.index(key_points[i+1])
-        except ValueError:
+        if key_points[i] not in position or key_points[i+1] not in position:
             continue
+        start_index = position[key_points[i]]
+        end_index = position[key_points[i+1]]
         segment = path[start_index:end_index+1]
         
         # Apply your original smoothing
-        smoothed_segment = smooth_path(segment, points)
+        smoothed_segment = smooth_path(segment, graph)
         
         # Add more intermediate points for smoother curves
-        enhanced_segment = add_intermediate_points(smoothed_segment, points, density=7)
+        enhanced_segment = add_intermediate_points(smoothed_segment, graph)
         
         if i == 0:
-            final_route.extend(enhanced_segment)
+            parts.append(enhanced_segment)
         else:
-            final_route.extend(enhanced_segment[1:])
+            parts.append(enhanced_segment[1:])
     
-    return final_route
+    return Route.concatenate(parts) if parts else path_vertices([], graph)
+
+def publish_graph(graph):
+    """Copy a graph's arrays into shared memory blocks.
+    
+    Returns a small picklable descriptor for `attach_graph` and the blocks
+    themselves, which the caller must close and unlink when done.
+    """
+    arrays, state = graph.shared_state()
+    specs = {}
+    blocks = []
+    try:
+        for name, array in arrays.items():
+            block = shared_memory.SharedMemory(create=True, size=max(array.nbytes, 1))
+            blocks.append(block)
+            np.ndarray(array.shape, dtype=array.dtype, buffer=block.buf)[...] = array
+            specs[name] = (block.name, array.dtype.str, array.shape)
+    except BaseException:
+        release_shared_blocks(blocks, unlink=True)
+        raise
+    return {'arrays': specs, 'state': state}, blocks
+
+def attach_graph(descriptor):
+    """Rebuild a graph published by `publish_graph` without copying its arrays"""
+    blocks = []
+    arrays = {}
+    for name, (block_name, dtype, shape) in descriptor['arrays'].items():
+        block = shared_memory.SharedMemory(name=block_name)
+        blocks.append(block)
+        arrays[name] = np.ndarray(shape, dtype=dtype, buffer=block.buf)
+    return RoutingGraph.from_shared(arrays, descriptor['state']), blocks
+
+def release_shared_blocks(blocks, unlink=False):
+    for block in blocks:
+        block.close()
+        if unlink:
+            block.unlink()
+
+# The segment pool of this process, created on first use and shared by all its requests.
+# Workers come from a forkserver: forking the threaded server itself could copy a lock
+# that another thread holds at that moment and hang the child.
+_pool = None
+_pool_pid = None
+_pool_lock = threading.Lock()
+
+# Per-process state of segment workers: the graph last attached, its descriptor and the
+# blocks backing it
+_worker_descriptor = None
+_worker_graph = None
+_worker_blocks = []
+
+def segment_pool(workers):
+    """This process's pool of `workers` segment processes (sized by the first call)"""
+    global _pool, _pool_pid
+    with _pool_lock:
+        # A pool inherited from a parent process (e.g. created while preloading) has no workers here
+        if _pool is None or _pool_pid != os.getpid():
+            context = multiprocessing.get_context('forkserver')
+            # Only this module: workers read their graphs from shared memory, and preloading
+            # __main__ would run the server's startup (terrain preloads, warm-up) once more
+            context.set_forkserver_preload([__name__])
+            _pool = ProcessPoolExecutor(max_workers=workers, mp_context=context)
+            _pool_pid = os.getpid()
+        return _pool
+
+def pool_map(workers, function, tasks, done=None):
+    """`[function(task) for task in tasks]` on the segment pool.
+    
+    `done(count)` is called as results come in, in task order. When a task
+    fails, the others are cancelled or waited for before the error is raised,
+    so the caller may release the shared memory they read. A pool broken by a
+    dead worker is dropped, and the next call starts a new one.
+    """
+    global _pool
+    pool = segment_pool(workers)
+    futures = [pool.submit(function, task) for task in tasks]
+    results = []
+    try:
+        for future in futures:
+            results.append(future.result())
+            if done is not None:
+                done(len(results))
+    except BrokenProcessPool:
+        with _pool_lock:
+            if _pool is pool:
+                _pool = None
+        raise
+    finally:
+        for future in futures:
+            future.cancel()
+        wait(futures)
+    return results
+
+def _worker_attach(descriptor):
+    """The graph published under `descriptor`, attached once and kept until another is needed"""
+    global _worker_descriptor, _worker_graph, _worker_blocks
+    if descriptor != _worker_descriptor:
+        release_shared_blocks(_worker_blocks)
+        _worker_descriptor, _worker_graph, _worker_blocks = None, None, []
+        _worker_graph, _worker_blocks = attach_graph(descriptor)
+        _worker_descriptor = descriptor
+    return _worker_graph
+
+def _solve_segment(task):
+    descriptor, start_id, goal_id, alpha, search, deadline = task
+    return timed_search(search_function(search), _worker_attach(descriptor), start_id, goal_id, alpha, deadline)
+
+def timed_search(find_path, graph, start_id, goal_id, alpha, deadline):
+    """`(path, stats)` of one leg, with the search time under stats['seconds']"""
+    stats = {}
+    started = time.perf_counter()
+    path = find_path(graph, start_id, goal_id, alpha=alpha, stats=stats, deadline=deadline)
+    stats['seconds'] = time.perf_counter() - started
+    return path, stats
+
+def record_leg(stats, method):
+    """Add the stats of one leg (see `solve_segments`) to the search metrics"""
+    if stats.get('cached'):
+        legs_total.inc(outcome='cached')
+        return
+    legs_total.inc(outcome='searched')
+    if stats.get('approximate'):
+        legs_total.inc(outcome='approximate')
+    if stats.get('fallback'):
+        legs_total.inc(outcome='fallback')
+    stage_seconds.observe(stats['seconds'], stage='search')
+    search_expanded.observe(stats.get('expanded', 0), method=method)
+    search_pushes.observe(stats.get('pushes', 0), method=method)
+    search_iterations.observe(stats.get('iterations', 0), method=method)
+
+def segment_key(graph, start_id, goal_id, alpha):
+    """Cache key of a leg: the terrain plus the exact endpoints and alpha"""
+    return (graph.terrain_key, graph.vertex(start_id)[:3], graph.vertex(goal_id)[:3], alpha)
+
+def solve_segments(graph, legs, alpha=25, workers=None, cache=segment_cache, search=DEFAULT_SEARCH, leg_stats=None,
+                   deadline=None, progress=None):
+    """Run A* for every (start_id, goal_id) leg, returning the paths in order.
+    
+    `search` selects the search function (see `search_function`). If
+    `leg_stats` is a list, the search stats of every leg are appended to it
+    in leg order, with {'cached': True} for reused legs. `deadline` (a
+    Deadline) is shared by all the legs; legs that run out of it come back
+    approximate. `progress(done, total)`, if given, is called with the number
+    of finished legs once the cache has been checked and after every solved leg.
+    
+    With `workers` > 1 the legs are solved concurrently on the process pool
+    (see `segment_pool`). The graph is published to shared memory once, so
+    workers read the same arrays instead of receiving a pickled copy with
+    every task.
+    
+    When the graph's terrain came from `terrain_cache`, solved legs are kept in
+    `cache` and a leg whose endpoints and alpha are unchanged is reused instead
+    of searched again, e.g. when only one waypoint of a long route moved. Only
+    complete legs from EXACT_SEARCHES are stored, but any search reuses them.
+    """
+    find_path = search_function(search)
+    use_cache = cache is not None and graph.terrain_key is not None
+    store = use_cache and search_name(search) in EXACT_SEARCHES
+    paths = [None] * len(legs)
+    if use_cache:
+        for i, (start_id, goal_id) in enumerate(legs):
+            interior = cache.get(segment_key(graph, start_id, goal_id, alpha))
+            if interior is not None:
+                paths[i] = [start_id] + interior.tolist() + [goal_id]
+        reused = sum(path is not None for path in paths)
+        if reused:
+            log(f"♻️ Reusing {reused} of {len(legs)} cached segments")
+    
+    pending = [i for i, path in enumerate(paths) if path is None]
+    pending_legs = [legs[i] for i in pending]
+    solved = []
+    report = progress or (lambda done, total: None)
+    report(len(legs) - len(pending_legs), len(legs))
+    if not workers or workers <= 1 or len(pending_legs) < 2:
+        for start_id, goal_id in pending_legs:
+            solved.append(timed_search(find_path, graph, start_id, goal_id, alpha, deadline))
+            report(len(legs) - len(pending_legs) + len(solved), len(legs))
+    else:
+        log(f"⚡ Solving {len(pending_legs)} segments on the pool of {workers} worker processes")
+        if isinstance(graph.terrain, TerrainGraph):
+            graph.terrain.edge_costs(alpha)  # warm the cost cache so it is published with the graph
+        descriptor, blocks = publish_graph(graph)
+        try:
+            tasks = [(descriptor, start_id, goal_id, alpha, search, deadline) for start_id, goal_id in pending_legs]
+            solved = pool_map(workers, _solve_segment, tasks,
+                              done=lambda count: report(len(legs) - len(pending_legs) + count, len(legs)))
+        finally:
+            release_shared_blocks(blocks, unlink=True)
+    
+    all_stats = [{'cached': True} for _ in legs]
+    for i, (path, stats) in zip(pending, solved):
+        paths[i] = path
+        all_stats[i] = stats
+        # Only legs that stay on the terrain between their endpoints can be reused
+        # with a different set of waypoints
+        if store and path and not stats.get('approximate') and all(node < graph.terrain_size for node in path[1:-1]):
+            start_id, goal_id = legs[i]
+            cache.put(segment_key(graph, start_id, goal_id, alpha), np.array(path[1:-1], dtype=np.int64))
+    for stats in all_stats:
+        record_leg(stats, search_name(search))
+    if leg_stats is not None:
+        leg_stats.extend(all_stats)
+    return paths
 
 # FIXED: Sequential routing for 3+ waypoints
-def astar_sequential_segments(points):
-    """Process waypoints in sequential order like GPS navigation (A→B→C→D)"""
-    print("🎯 Starting SEQUENTIAL waypoint routing (like GPS)...")
+def astar_sequential_segments(graph, workers=None, search=DEFAULT_SEARCH, order=None, leg_stats=None, deadline=None,
+                              progress=None, alpha=DEFAULT_ALPHA, cache=segment_cache):
+    """Process waypoints in sequential order like GPS navigation (A→B→C→D)
+    
+    Legs are independent once the graph exists, so with `workers` > 1 they are
+    solved in parallel (see `solve_segments`) and stitched in order afterwards.
+    `order` overrides the clicked order (see `optimize_waypoint_order`).
+    `deadline` bounds the time spent on all the legs together, and
+    `progress(done, total)` follows the finished legs. `alpha` weighs climb
+    against distance and `cache` holds solved legs (see `solve_segments`).
+    """
+    log("🎯 Starting SEQUENTIAL waypoint routing (like GPS)...")
     
     # Get waypoints in clicked order
-    waypoints_sequence = get_sequential_waypoints(points)
-    print(f"🗺️ Route sequence: {' → '.join([p.point_type for p in waypoints_sequence])}")
+    waypoints_sequence = order or get_sequential_waypoints(graph)
+    log(f"🗺️ Route sequence: {' → '.join([graph.point_type[pid] for pid in waypoints_sequence])}")
+    
+    # Run A* for every segment: A→B, B→C, C→D, etc.
+    legs = list(zip(waypoints_sequence[:-1], waypoints_sequence[1:]))
+    segment_paths = solve_segments(graph, legs, alpha=alpha, workers=workers, cache=cache, search=search,
+                                   leg_stats=leg_stats, deadline=deadline, progress=progress)
     
     full_path = []
     route_ids = []
     
-    # Process each segment: A→B, B→C, C→D, etc.
-    for i in range(len(waypoints_sequence) - 1):
-        start_point = waypoints_sequence[i]
-        end_point = waypoints_sequence[i + 1]
-        
-        print(f"🔄 Processing segment: {start_point.point_type} → {end_point.point_type}")
+    # Stitch the segments together in route order
+    for i, segment_path in enumerate(segment_paths):
+        start_point, end_point = legs[i]
+        start_type, end_type = graph.point_type[start_point], graph.point_type[end_point]
         
-        # Run A* for this specific segment
-        segment_path = astar(points, start_point.id, end_point.id, alpha=25)
+        log(f"🔄 Processing segment: {start_type} → {end_type}")
         
         if not segment_path:
-            raise ValueError(f"No path found for segment {start_point.point_type} → {end_point.point_type}")
+            raise ValueError(f"No path found for segment {start_type} → {end_type}")
         
-        print(f"✅ Segment path found: {len(segment_path)} points")
+        log(f"✅ Segment path found: {len(segment_path)} points")
         
         # Add to full path (avoid duplicating waypoints between segments)
         if i == 0:
@@ -298,119 +1741,446 @@ def astar_sequential_segments(points):
         if i == len(waypoints_sequence) - 2:
             route_ids.append(len(full_path) - 1)  # End point index
     
-    print(f"🎯 SEQUENTIAL ROUTING COMPLETE: {len(full_path)} total points")
-    return full_path, route_ids
+    log(f"🎯 SEQUENTIAL ROUTING COMPLETE: {len(full_path)} total points")
+    return path_vertices(full_path, graph), route_ids
 
 # FIXED: Main function that chooses algorithm based on waypoint count
-def astar_full_path(points):
+def astar_full_path(graph, workers=None, search=DEFAULT_SEARCH, order=None, leg_stats=None, density=DENSITY,
+                    deadline=None, progress=None, alpha=DEFAULT_ALPHA, cache=segment_cache):
     """Choose between simple A* (2 points) or sequential A* (3+ points)"""
     # Count waypoint types
-    waypoint_types = [p.point_type for p in points.values()]
-    waypoint_count = len([t for t in waypoint_types if t in ['start', 'end'] or t.startswith('w')])
+    waypoint_count = len(graph.waypoint_ids)
     
     if waypoint_count == 2:
-        print("📍 2-waypoint route: Using simple A*")
-        return astar_simple_two_points(points)
+        log("📍 2-waypoint route: Using simple A*")
+        return astar_simple_two_points(graph, search=search, leg_stats=leg_stats, density=density, deadline=deadline,
+                                       progress=progress, alpha=alpha, cache=cache)
     else:
-        print(f"📍 {waypoint_count}-waypoint route: Using SEQUENTIAL A*")
-        return astar_sequential_segments(points)
+        log(f"📍 {waypoint_count}-waypoint route: Using SEQUENTIAL A*")
+        return astar_sequential_segments(graph, workers=workers, search=search, order=order, leg_stats=leg_stats,
+                                         deadline=deadline, progress=progress, alpha=alpha, cache=cache)
 
-def astar_simple_two_points(points):
+def astar_simple_two_points(graph, search=DEFAULT_SEARCH, leg_stats=None, density=DENSITY, deadline=None,
+                            progress=None, alpha=DEFAULT_ALPHA, cache=segment_cache):
     """Simple A* for 2 waypoints (start→end) - existing working logic"""
     start_point = None
     end_point = None
     
-    for p in points.values():
-        if p.point_type == 'start':
-            start_point = p
-        elif p.point_type == 'end':
-            end_point = p
+    for pid in graph.waypoint_ids.tolist():
+        point_type = graph.point_type[pid]
+        if point_type == 'start':
+            start_point = pid
+        elif point_type == 'end':
+            end_point = pid
     
-    if not start_point or not end_point:
+    if start_point is None or end_point is None:
         raise ValueError("Missing start or end point")
     
-    print(f"🎯 Simple 2-point route: {start_point.point_type} → {end_point.point_type}")
+    log(f"🎯 Simple 2-point route: {graph.point_type[start_point]} → {graph.point_type[end_point]}")
     
-    # Run A* 
-    path = astar(points, start_point.id, end_point.id, alpha=25)
+    # Run A*
+    path = solve_segments(graph, [(start_point, end_point)], alpha=alpha, cache=cache, search=search,
+                          leg_stats=leg_stats, deadline=deadline, progress=progress)[0]
     if not path:
         raise ValueError("No path found")
     
     # Apply smoothing and enhancement
-    smoothed_path = smooth_path(path, points)
-    final_path = add_intermediate_points(smoothed_path, points, density=7)
+    smoothed_path = smooth_path(path, graph)
+    final_path = add_intermediate_points(smoothed_path, graph, density=density)
     
     route_ids = [0, len(final_path) - 1]  # Start and end indices
     
-    print(f"✅ Simple route complete: {len(final_path)} points")
+    log(f"✅ Simple route complete: {len(final_path)} points")
     return final_path, route_ids
 
-def run_astar(input_df):
-    """Main function called by Flask server"""
-    print(f"🔄 Processing dataframe with {len(input_df)} points")
-    
-    points = {}
-    for idx, row in input_df.iterrows():
-        points[idx] = Point(
-            id=idx,
-            lat=row['lat'],
-            lon=row['lng'],
-            elevation=row['elevation'],
-            point_type=row['point_type']
-        )
-
-    build_graph(points)
-    result = astar_full_path(points)
+def run_astar(input_df, grid=None, workers=None, search=DEFAULT_SEARCH, landmarks=False, optimize_order=False,
+              simplify=None, path_format='coordinates', deadline=None, progress=None,
+              alpha=DEFAULT_ALPHA):
+    """Main function called by Flask server.
+    
+    Regular grids (detected, or described by `grid` - see `build_terrain`)
+    are routed on an implicit lattice without building a graph; pass
+    `grid=False` to always build the explicit graph. The terrain built from
+    the grid rows is cached across calls in `terrain_cache`.
+    `workers` > 1 solves the legs of multi-waypoint routes in parallel.
+    `search` picks the search function (see `search_function`): 'bidirectional'
+    by default, 'astar' for the one-sided search, or 'hierarchical' for
+    coarse-to-fine search on large grids. `landmarks=True` precomputes
+    landmark tables for the terrain (kept in the cache with it) so this and
+    later routes over it get a heuristic that accounts for elevation.
+    `optimize_order=True` visits the intermediate waypoints in the cheapest
+    order (see `optimize_waypoint_order`). `simplify` and `path_format`
+    control the returned path (see `route_graph`). `deadline` (a Deadline)
+    bounds the time spent searching, and `progress(done, total)` is called
+    as route legs finish (see `solve_segments`). `alpha` (default
+    DEFAULT_ALPHA) weighs climb against distance; a list of alphas or
+    'pareto' returns a set of routes (see `route_alpha_set`).
+    """
+    log(f"🔄 Processing dataframe with {len(input_df['lat'])} points")
+    
+    search_function(search)  # reject an unknown search before building anything
+    check_alpha(alpha)
+    graph = routing_graph_from_dataframe(input_df, grid)
+    return route_graph(graph, workers=workers, search=search, landmarks=landmarks,
+                       optimize_order=optimize_order, simplify=simplify, path_format=path_format,
+                       deadline=deadline, progress=progress, alpha=alpha)
+
+def run_astar_grid(grid, elevation, waypoints, workers=None, search=DEFAULT_SEARCH, landmarks=False,
+                   optimize_order=False, simplify=None, path_format='coordinates', deadline=None, progress=None,
+                   alpha=DEFAULT_ALPHA):
+    """Route over a lattice given only by its descriptor, without per-cell coordinates.
+    
+    `grid` is the {origin, step, rows, cols} layout and `elevation` the
+    row-major elevations, as returned by `ingest.read_grid`; `waypoints` is
+    an ordered list as accepted by `reroute`, except that a missing elevation
+    is taken from the nearest grid cell. The terrain is cached like the ones
+    built by `run_astar`. Options are those of `run_astar`.
+    """
+    log(f"🔄 Processing {grid['rows']}x{grid['cols']} grid descriptor with {len(waypoints)} waypoints")
+    
+    search_function(search)  # reject an unknown search before building anything
+    check_alpha(alpha)
+    # The lattice comes from `grid` alone, so there are no coordinate columns to hash
+    terrain, key = cached_terrain((), (), elevation, grid)
+    waypoints = [wp if 'elevation' in wp else
+                 dict(wp, elevation=terrain.elevation_grid[terrain.cell_of(float(wp['lat']), float(wp['lng']))])
+                 for wp in waypoints]
+    graph = attach_key_points(terrain, waypoint_key_points(waypoints), key)
+    return route_graph(graph, workers=workers, search=search, landmarks=landmarks,
+                       optimize_order=optimize_order, simplify=simplify, path_format=path_format,
+                       deadline=deadline, progress=progress, alpha=alpha)
+
+def reroute(terrain_id, waypoints, workers=None, search=DEFAULT_SEARCH, landmarks=False, optimize_order=False,
+            simplify=None, path_format='coordinates', deadline=None, progress=None,
+            alpha=DEFAULT_ALPHA):
+    """Re-run routing for an edited waypoint list over an already cached terrain.
+    
+    `waypoints` is the full ordered list of dicts with lat, lng, elevation and
+    optionally point_type (defaulting to start, w1, w2, ..., end). Legs whose
+    endpoints did not change are taken from `segment_cache`, so moving one
+    waypoint only searches the two legs that touch it. Raises LookupError if
+    the terrain is no longer cached and has to be sent again.
+    """
+    terrain = terrain_cache.get(terrain_id)
+    if terrain is None:
+        raise LookupError(f"Terrain {terrain_id} is not cached")
+    key_points = waypoint_key_points(waypoints)
+    log(f"🔁 Re-routing {len(waypoints)} waypoints over cached terrain {terrain_id}")
+    graph = attach_key_points(terrain, key_points, terrain_id)
+    return route_graph(graph, workers=workers, search=search, landmarks=landmarks,
+                       optimize_order=optimize_order, simplify=simplify, path_format=path_format,
+                       deadline=deadline, progress=progress, alpha=alpha)
+
+def route_batch(input_df, routes, grid=None, workers=None, search=DEFAULT_SEARCH, landmarks=False,
+                optimize_order=False, simplify=None, path_format='coordinates', deadline=None, alpha=DEFAULT_ALPHA):
+    """Route many waypoint lists over one elevation grid.
+    
+    The terrain is built from the grid rows of `input_df` once (or taken from
+    `terrain_cache`) and every entry of `routes`, a dict of route id to a
+    waypoint list as accepted by `reroute`, is routed over it. With
+    `workers` > 1 the routes are solved on the segment pool, which reads the
+    terrain from shared memory.
+    
+    Returns `(terrain_id, results)` where `results` maps each route id to the
+    `route_graph` data, or to `{'error': message}` if that route could not be
+    solved, plus its 'timeMs'. `simplify`, `path_format`, `alpha` and
+    `deadline` apply to every route (see `route_graph`); the deadline is
+    shared by the whole batch.
+    """
+    search_function(search)  # reject an unknown search before building anything
+    check_path_options(simplify, path_format)
+    alphas = check_alpha(alpha)
+    options = {'search': search, 'optimize_order': optimize_order, 'simplify': simplify, 'path_format': path_format,
+               'deadline': deadline, 'alpha': alpha}
+    (lat, lon, elevation), _ = split_key_rows(input_df)
+    terrain, key = cached_terrain(lat, lon, elevation, grid)
+    if landmarks:
+        for value in alphas:
+            prepare_landmarks(terrain, value)
+        terrain_cache.put(key, terrain)  # re-measure it with the new tables
+    log(f"📦 Routing a batch of {len(routes)} routes over {len(terrain)} terrain points")
+    
+    if not workers or workers <= 1 or len(routes) < 2:
+        results = [_timed_route(terrain, key, waypoints, options) for waypoints in routes.values()]
+    else:
+        log(f"⚡ Solving {len(routes)} routes on the pool of {workers} worker processes")
+        if isinstance(terrain, TerrainGraph):
+            for value in alphas:
+                terrain.edge_costs(value)  # warm the cost cache so it is published with the terrain
+        # Stage metrics of routes solved on the pool stay in the workers; the request itself is still timed
+        descriptor, blocks = publish_graph(RoutingGraph(terrain))
+        try:
+            tasks = [(descriptor, key, waypoints, options) for waypoints in routes.values()]
+            results = pool_map(workers, _solve_route, tasks)
+        finally:
+            release_shared_blocks(blocks, unlink=True)
+    return key, dict(zip(routes, results))
+
+def _timed_route(terrain, key, waypoints, options):
+    """`route_graph(**options)` data for one waypoint list (or the error that stopped it) with its time"""
+    started = time.perf_counter()
+    try:
+        graph = attach_key_points(terrain, waypoint_key_points(waypoints), key)
+        result = route_graph(graph, **options)
+    except (ValueError, DeadlineExceeded) as e:
+        result = {'error': str(e)}
+    result['timeMs'] = round((time.perf_counter() - started) * 1000, 1)
+    return result
+
+def _solve_route(task):
+    descriptor, key, waypoints, options = task
+    return _timed_route(_worker_attach(descriptor).terrain, key, waypoints, options)
+
+def check_path_options(simplify, path_format):
+    """Reject a `simplify` tolerance or `path_format` that `route_graph` cannot use"""
+    if path_format not in PATH_FORMATS:
+        raise ValueError(f"Unknown path format {path_format!r}; expected one of {', '.join(PATH_FORMATS)}")
+    if simplify is not None and (isinstance(simplify, bool) or not isinstance(simplify, (int, float)) or not simplify > 0):
+        raise ValueError("simplify must be a positive tolerance in metres")
+
+def check_alpha(alpha):
+    """The alphas asked for by `alpha`: one number, a list of numbers, or 'pareto' for PARETO_ALPHAS.
+    
+    Returns them sorted and without repeats; raises ValueError for anything
+    but finite, non-negative numbers or for more than MAX_ALPHAS of them.
+    """
+    if alpha == 'pareto':
+        return list(PARETO_ALPHAS)
+    alphas = alpha if isinstance(alpha, (list, tuple)) else [alpha]
+    if not alphas or len(alphas) > MAX_ALPHAS:
+        raise ValueError(f"alpha must list between 1 and {MAX_ALPHAS} values")
+    for value in alphas:
+        if isinstance(value, bool) or not isinstance(value, (int, float)) or not 0 <= value < math.inf:
+            raise ValueError(f"alpha must be a non-negative number, a list of them or 'pareto', got {value!r}")
+    return sorted(set(alphas))
+
+class AlphaBracketCache:
+    """Segment cache that answers legs from the alphas already solved around them.
+    
+    The cost of a path, distance + alpha * climb, is linear in alpha, so a
+    path that is cheapest at two alphas is cheapest at every alpha between
+    them. A leg whose paths at the nearest solved alphas below and above are
+    the same is answered with that path instead of being searched; the rest
+    go to `cache`. Only complete legs of exact searches are ever stored (see
+    `solve_segments`), which keeps the reasoning sound.
+    """
+    
+    def __init__(self, cache=None):
+        self.cache = cache
+        self.reused = 0
+        self._solved = {}  # leg -> {alpha: interior}
+    
+    def get(self, key):
+        leg, alpha = key[:-1], key[-1]
+        solved = self._solved.get(leg, {})
+        below = [value for value in solved if value < alpha]
+        above = [value for value in solved if value > alpha]
+        if below and above and np.array_equal(solved[max(below)], solved[min(above)]):
+            self.reused += 1
+            return solved[max(below)]
+        interior = self.cache.get(key) if self.cache is not None else None
+        if interior is not None:
+            solved[alpha] = interior
+            self._solved[leg] = solved
+        return interior
+    
+    def put(self, key, interior):
+        self._solved.setdefault(key[:-1], {})[key[-1]] = interior
+        if self.cache is not None:
+            self.cache.put(key, interior)
+
+def alpha_order(count):
+    """Indices 0..count-1 with both ends first, then the midpoints of every gap left, level by level"""
+    order = [0, count - 1][:count]
+    gaps = [(0, count - 1)]
+    while gaps:
+        narrower = []
+        for low, high in gaps:
+            if high - low > 1:
+                middle = (low + high) // 2
+                order.append(middle)
+                narrower += [(low, middle), (middle, high)]
+        gaps = narrower
+    return order
+
+def pareto_optimal(routes):
+    """For each route data, whether no other route is both no longer and climbs no more, and better in one"""
+    points = [(route['stats']['distance'], route['stats']['elevationGain']) for route in routes]
+    return [not any(d <= distance and g <= gain and (d, g) != (distance, gain) for d, g in points)
+            for distance, gain in points]
+
+def route_alpha_set(graph, alphas, pareto=False, progress=None, cache=segment_cache, **options):
+    """Routes over one graph for several alphas, each with its own stats.
+    
+    The graph (and terrain) is shared, and the alphas are routed extremes
+    first and then bisecting (see `alpha_order`) through an
+    AlphaBracketCache, so legs whose path does not change between solved
+    alphas are not searched again. Each route is flagged 'paretoOptimal'
+    unless another of the set is no longer and climbs no more. With
+    `pareto` only those are returned, one per distinct path with every
+    alpha that gave it under 'alphas': the points of the distance/climb
+    Pareto frontier that a weighted sum of the two can reach. The totals
+    under 'search' count the legs of every alpha routed, whether or not its
+    route is returned. Other `options` are those of `route_graph`.
+    """
+    bracket = AlphaBracketCache(cache)
+    routes = [None] * len(alphas)
+    for done, i in enumerate(alpha_order(len(alphas))):
+        report = None if progress is None else \
+            (lambda legs, total, done=done: progress(done * total + legs, len(alphas) * total))
+        routes[i] = route_graph(graph, alpha=alphas[i], cache=bracket, progress=report, **options)
+    for route, optimal in zip(routes, pareto_optimal(routes)):
+        route['paretoOptimal'] = optimal
+    # Search totals cover every alpha routed, including those the Pareto set drops
+    searches = [route['search'] for route in routes]
+    
+    if pareto:
+        distinct = {}
+        for route in routes:
+            if route['paretoOptimal']:
+                point = (route['stats']['distance'], route['stats']['elevationGain'])
+                distinct.setdefault(point, dict(route, alphas=[]))['alphas'].append(route['alpha'])
+        routes = list(distinct.values())
+    log(f"⚖️ Routed {len(alphas)} alphas into {len(routes)} routes, {bracket.reused} legs reused between alphas")
+    
+    return {
+        'routes': routes,
+        'pathLength': sum(route['pathLength'] for route in routes),
+        'terrainId': graph.terrain_key,
+        'approximate': any(route['approximate'] for route in routes),
+        'search': {
+            'method': searches[0]['method'],
+            'alphas': len(alphas),
+            'legs': sum(search['legs'] for search in searches),
+            'reusedLegs': bracket.reused,
+            'cachedLegs': sum(search['cachedLegs'] for search in searches),
+            'expanded': sum(search['expanded'] for search in searches),
+            'fallbacks': sum(search['fallbacks'] for search in searches),
+            'approximateLegs': sum(search['approximateLegs'] for search in searches)
+        }
+    }
+
+def route_graph(graph, workers=None, search=DEFAULT_SEARCH, landmarks=False, optimize_order=False,
+                simplify=None, path_format='coordinates', deadline=None, progress=None, alpha=DEFAULT_ALPHA,
+                cache=segment_cache):
+    """Route a RoutingGraph and build the response data.
+    
+    With `optimize_order` the intermediate waypoints are visited in the
+    cheapest order instead of the clicked one, and the response lists the
+    point types in visiting order under 'order'. `simplify` (metres) returns
+    a Douglas-Peucker simplified path instead of the densified one; the stats
+    are still measured on the full path. `path_format` is one of
+    PATH_FORMATS (see `path_output`). Legs cut short by `deadline` make the
+    route 'approximate' (see `partial_path`). `alpha` weighs climb against
+    distance; a list of alphas or 'pareto' returns a set of routes instead
+    (see `route_alpha_set`).
+    """
+    alphas = check_alpha(alpha)
+    check_path_options(simplify, path_format)
+    if isinstance(alpha, (list, tuple, str)):
+        return route_alpha_set(graph, alphas, pareto=alpha == 'pareto', cache=cache, workers=workers, search=search,
+                               landmarks=landmarks, optimize_order=optimize_order, simplify=simplify,
+                               path_format=path_format, deadline=deadline, progress=progress)
+    if landmarks:
+        prepare_landmarks(graph.terrain, alpha)
+        if graph.terrain_key is not None:
+            terrain_cache.put(graph.terrain_key, graph.terrain)  # re-measure it with the new tables
+    order = optimize_waypoint_order(graph, alpha) if optimize_order else None
+    leg_stats = []
+    result = astar_full_path(graph, workers=workers, search=search, order=order, leg_stats=leg_stats,
+                             density=1 if simplify else DENSITY, deadline=deadline, progress=progress, alpha=alpha,
+                             cache=cache)
     if result is None or result[0] is None:
         raise ValueError("No valid path found.")
     
     final_path, route_ids = result
 
-    # Convert to coordinates
-    path_coordinates = []
-    for pid in final_path:
-        path_coordinates.append({
-            'lat': points[pid].lat,
-            'lng': points[pid].lon
-        })
-    
     # Calculate stats
-    stats = calculate_route_stats(final_path, points)
+    stats = calculate_route_stats(final_path)
+    
+    if simplify:
+        key_rows = np.flatnonzero(key_point_mask(final_path.point_type))
+        kept = simplify_indices(final_path, float(simplify), keep=np.union1d(key_rows, route_ids))
+        log(f"✂️ Simplified path: {len(final_path)} → {len(kept)} points ({simplify} m tolerance)")
+        route_ids = np.searchsorted(kept, route_ids).tolist()
+        final_path = final_path[kept]
     
+    path_key, path_value = path_output(final_path, path_format)
     result_data = {
-        'path': path_coordinates,
+        path_key: path_value,
         'stats': stats,
         'pathLength': len(final_path),
-        'waypoints': route_ids
+        'waypoints': route_ids,
+        'terrainId': graph.terrain_key,
+        'alpha': alpha,
+        'approximate': any(stats.get('approximate') for stats in leg_stats),
+        'search': {
+            'method': search_name(search),
+            'legs': len(leg_stats),
+            'cachedLegs': sum(bool(stats.get('cached')) for stats in leg_stats),
+            'expanded': sum(stats.get('expanded', 0) for stats in leg_stats),
+            'fallbacks': sum(bool(stats.get('fallback')) for stats in leg_stats),
+            'approximateLegs': sum(bool(stats.get('approximate')) for stats in leg_stats)
+        }
     }
+    if order is not None:
+        result_data['order'] = [graph.point_type[pid] for pid in order]
     
-    print(f"✅ Successfully generated route with {len(path_coordinates)} points")
+    log(f"✅ Successfully generated route with {len(final_path)} points")
     return result_data
 
-def export_path_to_csv(path, points, output_file):
-    data = []
-    for pid in path:
-        p = points[pid]
-        data.append({
-            'lat': p.lat,
-            'lng': p.lon,
-            'elevation': p.elevation,
-            'point_type': p.point_type
-        })
-    pd.DataFrame(data).to_csv(output_file, index=False)
-    print(f"💾 Path exported to {output_file}")
+def encode_polyline(lat, lon, precision=5):
+    """Encoded polyline (Google's format) of coordinate arrays.
+    
+    Coordinates are rounded to `precision` decimals, delta-encoded,
+    zigzagged and split into 5-bit chunks for every vertex at once.
+    """
+    scaled = np.round(np.column_stack((lat, lon)) * 10 ** precision).astype(np.int64)
+    deltas = np.diff(scaled, axis=0, prepend=0).ravel()
+    values = ((deltas << 1) ^ (deltas >> 63)).astype(np.uint64)
+    
+    chunks = (values[:, None] >> (5 * np.arange(7, dtype=np.uint64))) & np.uint64(31)
+    # Chunk k is needed when the value has bits at or above 5 * k (chunk 0 always)
+    needed = np.ones(chunks.shape, dtype=bool)
+    needed[:, 1:] = values[:, None] >= (np.uint64(1) << (5 * np.arange(1, 7, dtype=np.uint64)))
+    follows = np.zeros(chunks.shape, dtype=bool)
+    follows[:, :-1] = needed[:, 1:]
+    chars = chunks + np.where(follows, 0x20, 0) + 63
+    return chars[needed].astype(np.uint8).tobytes().decode('ascii')
+
+@stage_seconds.time(stage='encode')
+def path_output(route, path_format='coordinates'):
+    """`(key, value)` of the path in a response, in one of PATH_FORMATS.
+    
+    'coordinates' is the list of {lat, lng} dicts, 'columns' a {lat, lng}
+    dict of lists and 'polyline' an encoded polyline string.
+    """
+    if path_format == 'polyline':
+        return 'polyline', encode_polyline(route.lat, route.lon)
+    if path_format == 'columns':
+        return 'path', {'lat': route.lat.tolist(), 'lng': route.lon.tolist()}
+    return 'path', [{'lat': lat, 'lng': lon} for lat, lon in zip(route.lat.tolist(), route.lon.tolist())]
+
+def export_path_to_csv(route, output_file):
+    import pandas as pd
+    pd.DataFrame({
+        'lat': route.lat,
+        'lng': route.lon,
+        'elevation': route.elevation,
+        'point_type': route.point_type
+    }).to_csv(output_file, index=False)
+    log(f"💾 Path exported to {output_file}")
 
 if __name__ == "__main__":
     print("🧪 Testing Sequential Route A* algorithm...")
     try:
-        points = load_points_from_csv("elevation_data.csv")
-        build_graph(points)
-        result = astar_full_path(points)
+        graph = load_points_from_csv("elevation_data.csv")
+        result = astar_full_path(graph)
         if result is None or result[0] is None:
             print("❌ No valid path found!")
         else:
             final_path, route_ids = result
-            export_path_to_csv(final_path, points, "sequential_route_path.csv")
+            export_path_to_csv(final_path, "sequential_route_path.csv")
             print("✅ Test completed successfully!")
     except Exception as e:
         print(f"❌ Test failed: {e}")
@@ -0,0 +1,326 @@
+# benchmark.py - Reproducible timings of the routing pipeline on synthetic terrain
+#
+#   python benchmark.py                          # full matrix, results in benchmark_results.json
+#   python benchmark.py --quick                  # 1k and 10k points only
+#   python benchmark.py --compare old.json       # also flag stages that got slower
+#   python benchmark.py --url http://localhost:8080 --clients 1 4 16   # throughput of a running server
+
+import argparse
+import json
+import os
+import platform
+import resource
+import statistics
+import subprocess
+import sys
+import time
+import tracemalloc
+import urllib.error
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import pandas as pd
+
+import AStar
+import metrics
+
+TERRAINS = ('flat', 'rolling', 'mountainous')
+SIZES = (1000, 10000, 100000, 500000)
+QUICK_SIZES = (1000, 10000)
+WAYPOINT_COUNTS = (2, 5, 20)
+GRID_STEP = 0.00027  # the frontend's grid spacing, about 30 m
+ORIGIN = (32.0, 34.8)
+REGRESSION_THRESHOLD = 1.10
+NOISE_SECONDS = 0.002  # slowdowns smaller than this are timer noise, whatever the ratio
+CLIENT_COUNTS = (1, 4, 16)
+
+def synthetic_elevation(rows, cols, terrain, rng):
+    """Elevation grid in metres for one of TERRAINS"""
+    r, c = np.mgrid[0:rows, 0:cols].astype(np.float64)
+    if terrain == 'flat':
+        return 100 + rng.normal(0, 0.5, (rows, cols))
+    if terrain == 'rolling':
+        phase = rng.uniform(0, 2 * np.pi, 4)
+        return (200 + 60 * np.sin(r / 45 + phase[0]) * np.cos(c / 70 + phase[1]) +
+                25 * np.sin(r / 17 + c / 23 + phase[2]) + 10 * np.cos(c / 9 + phase[3]) +
+                rng.normal(0, 1, (rows, cols)))
+    if terrain == 'mountainous':
+        # Value noise: random coarse grids, bilinearly upsampled, halving in amplitude per octave
+        elevation = np.full((rows, cols), 500.0)
+        for octave in range(6):
+            cells = 2 ** (octave + 1) + 1
+            coarse = rng.uniform(-1, 1, (cells, cells))
+            y = r * (cells - 1) / max(rows - 1, 1)
+            x = c * (cells - 1) / max(cols - 1, 1)
+            y0 = np.minimum(y.astype(int), cells - 2)
+            x0 = np.minimum(x.astype(int), cells - 2)
+            fy, fx = y - y0, x - x0
+            top = coarse[y0, x0] * (1 - fx) + coarse[y0, x0 + 1] * fx
+            bottom = coarse[y0 + 1, x0] * (1 - fx) + coarse[y0 + 1, x0 + 1] * fx
+            elevation += 900 * 0.5 ** octave * (top * (1 - fy) + bottom * fy)
+        return elevation + rng.normal(0, 2, (rows, cols))
+    raise ValueError(f"Unknown terrain {terrain!r}, expected one of {TERRAINS}")
+
+def synthetic_request(points, terrain, waypoints, seed, waypoint_seed=None):
+    """DataFrame laid out like a frontend request: row-major grid rows, then the waypoints.
+    
+    The grid is the square closest to `points` cells. Waypoints sit at
+    seeded random positions between grid nodes, with the elevation of the
+    nearest node, and are typed start, w1, ..., end. A `waypoint_seed` moves
+    the waypoints while keeping the grid of `seed`.
+    """
+    rng = np.random.default_rng(seed)
+    rows = cols = max(int(round(np.sqrt(points))), 2)
+    elevation = synthetic_elevation(rows, cols, terrain, rng)
+    r, c = np.divmod(np.arange(rows * cols), cols)
+    grid = pd.DataFrame({
+        'lat': ORIGIN[0] + r * GRID_STEP,
+        'lng': ORIGIN[1] + c * GRID_STEP,
+        'elevation': elevation.ravel(),
+        'point_type': 'grid',
+    })
+    
+    if waypoint_seed is not None:
+        rng = np.random.default_rng([seed, waypoint_seed])
+    cells = rng.uniform(0.05, 0.95, (waypoints, 2)) * [rows - 1, cols - 1]
+    nearest = np.rint(cells).astype(int)
+    last = waypoints - 1
+    key = pd.DataFrame({
+        'lat': ORIGIN[0] + cells[:, 0] * GRID_STEP,
+        'lng': ORIGIN[1] + cells[:, 1] * GRID_STEP,
+        'elevation': elevation[nearest[:, 0], nearest[:, 1]],
+        'point_type': ['start' if i == 0 else 'end' if i == last else f'w{i}' for i in range(waypoints)],
+    })
+    return pd.concat([grid, key], ignore_index=True)
+
+def timed(function, *args, **kwargs):
+    started = time.perf_counter()
+    result = function(*args, **kwargs)
+    return result, time.perf_counter() - started
+
+def clear_caches():
+    AStar.terrain_cache.clear()
+    AStar.segment_cache.clear()
+
+def run_stages(df):
+    """Seconds spent in each pipeline stage for one request, plus search counters"""
+    (lat, lon, elevation), key_points = AStar.split_key_rows(df)
+    seconds = {}
+    
+    explicit, seconds['build_graph'] = timed(AStar.build_terrain, lat, lon, elevation, grid=False)
+    lattice, seconds['build_lattice'] = timed(AStar.build_terrain, lat, lon, elevation)
+    graph = AStar.attach_key_points(lattice, key_points)
+    sequence = AStar.get_sequential_waypoints(graph)
+    legs = list(zip(sequence[:-1], sequence[1:]))
+    explicit_graph = AStar.attach_key_points(explicit, key_points)
+    
+    counters = {'astar': 0, 'bidirectional_astar': 0}
+    paths = []
+    for name, search in (('astar', AStar.astar), ('bidirectional_astar', AStar.bidirectional_astar)):
+        seconds[name] = 0.0
+        for start, goal in legs:
+            stats = {}
+            path, elapsed = timed(search, graph, start, goal, stats=stats)
+            seconds[name] += elapsed
+            counters[name] += stats.get('expanded', 0)
+            if name == 'astar':
+                paths.append(path)
+    seconds['astar_explicit_graph'] = 0.0
+    for start, goal in legs:
+        _, elapsed = timed(AStar.astar, explicit_graph, start, goal)
+        seconds['astar_explicit_graph'] += elapsed
+    
+    seconds['smooth_path'] = 0.0
+    seconds['add_intermediate_points'] = 0.0
+    routes = []
+    for path in paths:
+        smoothed, elapsed = timed(AStar.smooth_path, path, graph)
+        seconds['smooth_path'] += elapsed
+        route, elapsed = timed(AStar.add_intermediate_points, smoothed, graph)
+        seconds['add_intermediate_points'] += elapsed
+        routes.append(route)
+    _, seconds['calculate_route_stats'] = timed(AStar.calculate_route_stats, AStar.Route.concatenate(routes))
+    
+    clear_caches()
+    result, seconds['run_astar'] = timed(AStar.run_astar, df)
+    return seconds, {'expanded': counters, 'pathLength': result['pathLength']}
+
+def peak_memory(df):
+    """Peak bytes allocated (Python and NumPy) by a cold run_astar, traced separately from the timings"""
+    clear_caches()
+    tracemalloc.start()
+    try:
+        AStar.run_astar(df)
+        return tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+def run_case(terrain, points, waypoints, seed, repeat, memory=True):
+    df = synthetic_request(points, terrain, waypoints, seed)
+    runs = []
+    for _ in range(repeat):
+        seconds, info = run_stages(df)
+        runs.append(seconds)
+    case = {
+        'terrain': terrain,
+        'points': points,
+        'gridPoints': len(df) - waypoints,
+        'waypoints': waypoints,
+        'seed': seed,
+        'seconds': {stage: min(run[stage] for run in runs) for stage in runs[0]},
+        'medianSeconds': {stage: statistics.median(run[stage] for run in runs) for stage in runs[0]},
+        'expanded': info['expanded'],
+        'pathLength': info['pathLength'],
+    }
+    if memory:
+        case['peakBytes'] = peak_memory(df)
+    return case
+
+def post_route(url, body):
+    """Seconds taken by one /process_route request, or None if it was refused or failed"""
+    request = urllib.request.Request(url.rstrip('/') + '/process_route', data=body,
+                                     headers={'Content-Type': 'application/json'})
+    started = time.perf_counter()
+    try:
+        with urllib.request.urlopen(request, timeout=600) as response:
+            response.read()
+    except urllib.error.HTTPError:
+        return None
+    return time.perf_counter() - started
+
+def throughput_case(url, terrain, points, waypoints, seed, clients, requests_per_client):
+    """Requests per second of `clients` concurrent clients routing over one grid on a running server.
+    
+    Every request moves the waypoints over the same grid, so the server's
+    terrain cache (or a preloaded terrain) is hit but each search is new.
+    """
+    bodies = [json.dumps({'elevationData': synthetic_request(points, terrain, waypoints, seed, i).to_dict('records')})
+              .encode() for i in range(clients * requests_per_client)]
+    post_route(url, bodies[0])  # warm the server's terrain cache
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=clients) as pool:
+        outcomes = list(pool.map(lambda body: post_route(url, body), bodies))
+    elapsed = time.perf_counter() - started
+    latencies = sorted(seconds for seconds in outcomes if seconds is not None) or [float('nan')]
+    return {
+        'terrain': terrain,
+        'points': points,
+        'waypoints': waypoints,
+        'seed': seed,
+        'clients': clients,
+        'requests': len(bodies),
+        'errors': outcomes.count(None),
+        'requestsPerSecond': (len(bodies) - outcomes.count(None)) / elapsed,
+        'p50Seconds': latencies[len(latencies) // 2],
+        'p95Seconds': latencies[min(int(len(latencies) * 0.95), len(latencies) - 1)],
+    }
+
+def environment():
+    try:
+        commit = subprocess.run(['git', 'rev-parse', 'HEAD'], capture_output=True, text=True,
+                                cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip() or None
+    except OSError:
+        commit = None
+    return {
+        'python': platform.python_version(),
+        'numpy': np.__version__,
+        'pandas': pd.__version__,
+        'platform': platform.platform(),
+        'cpus': os.cpu_count(),
+        'commit': commit,
+        'started': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+    }
+
+def case_key(case):
+    return case['terrain'], case['points'], case['waypoints'], case['seed']
+
+def compare(results, baseline, threshold=REGRESSION_THRESHOLD):
+    """Lines describing every stage that is more than `threshold` times (and NOISE_SECONDS) slower than in `baseline`,
+    and every throughput case that served `threshold` times fewer requests per second"""
+    previous = {case_key(case): case for case in baseline.get('cases', [])}
+    lines = []
+    for case in results['cases']:
+        before = previous.get(case_key(case))
+        if before is None:
+            continue
+        for stage, seconds in case['seconds'].items():
+            old = before['seconds'].get(stage)
+            if old and seconds > old * threshold and seconds - old > NOISE_SECONDS:
+                lines.append(f"{case['terrain']} {case['points']} pts {case['waypoints']} wps {stage}: "
+                             f"{old * 1000:.1f} ms -> {seconds * 1000:.1f} ms ({seconds / old:.2f}x)")
+    previous = {case_key(case) + (case['clients'],): case for case in baseline.get('throughput', [])}
+    for case in results.get('throughput', []):
+        before = previous.get(case_key(case) + (case['clients'],))
+        if before and case['requestsPerSecond'] * threshold < before['requestsPerSecond']:
+            lines.append(f"{case['terrain']} {case['points']} pts {case['waypoints']} wps {case['clients']} clients: "
+                         f"{before['requestsPerSecond']:.2f} -> {case['requestsPerSecond']:.2f} requests/s")
+    return lines
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the routing pipeline on seeded synthetic terrain")
+    parser.add_argument('--terrains', nargs='+', choices=TERRAINS, default=list(TERRAINS))
+    parser.add_argument('--sizes', nargs='+', type=int, help="grid sizes in points (default %s)" % (SIZES,))
+    parser.add_argument('--waypoints', nargs='+', type=int, default=list(WAYPOINT_COUNTS))
+    parser.add_argument('--quick', action='store_true', help="only the %s point grids" % (QUICK_SIZES,))
+    parser.add_argument('--repeat', type=int, default=3, help="runs per case; the fastest is reported")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--no-memory', action='store_true', help="skip the traced peak-memory run")
+    parser.add_argument('--output', default='benchmark_results.json')
+    parser.add_argument('--compare', help="earlier results file to check for regressions")
+    parser.add_argument('--threshold', type=float, default=REGRESSION_THRESHOLD,
+                        help="slowdown ratio reported as a regression (default %(default)s)")
+    parser.add_argument('--url', help="base URL of a running server: measure concurrent-client throughput "
+                                      "of /process_route instead of the in-process stages")
+    parser.add_argument('--clients', nargs='+', type=int, default=list(CLIENT_COUNTS),
+                        help="concurrent clients for --url (default %s)" % (CLIENT_COUNTS,))
+    parser.add_argument('--client-requests', type=int, default=4, help="requests sent by each client for --url")
+    parser.add_argument('--save-grid', help="write the grid of the first case as CSV (e.g. for PRELOAD_TERRAINS) and exit")
+    args = parser.parse_args(argv)
+    
+    metrics.VERBOSE = False
+    sizes = args.sizes or (QUICK_SIZES if args.quick else SIZES)
+    results = {'environment': environment(), 'cases': []}
+    if args.save_grid:
+        df = synthetic_request(sizes[0], args.terrains[0], args.waypoints[0], args.seed)
+        df[df['point_type'] == 'grid'].to_csv(args.save_grid, index=False)
+        print(f"Grid of {args.terrains[0]} {sizes[0]} pts written to {args.save_grid}")
+        return 0
+    if args.url:
+        results['url'] = args.url
+        results['throughput'] = []
+    for terrain in args.terrains:
+        for points in sizes:
+            for waypoints in args.waypoints:
+                if args.url:
+                    for clients in args.clients:
+                        case = throughput_case(args.url, terrain, points, waypoints, args.seed, clients,
+                                               args.client_requests)
+                        results['throughput'].append(case)
+                        print(f"{terrain:>11} {points:>7} pts {waypoints:>2} wps {clients:>3} clients: "
+                              f"{case['requestsPerSecond']:7.2f} requests/s, p50 {case['p50Seconds'] * 1000:8.1f} ms, "
+                              f"p95 {case['p95Seconds'] * 1000:8.1f} ms, {case['errors']} errors", flush=True)
+                    continue
+                case = run_case(terrain, points, waypoints, args.seed, args.repeat, memory=not args.no_memory)
+                results['cases'].append(case)
+                memory = f", peak {case['peakBytes'] / 2 ** 20:.0f} MiB" if 'peakBytes' in case else ''
+                print(f"{terrain:>11} {points:>7} pts {waypoints:>2} wps: "
+                      f"run_astar {case['seconds']['run_astar'] * 1000:8.1f} ms, "
+                      f"astar {case['seconds']['astar'] * 1000:8.1f} ms{memory}", flush=True)
+    
+    results['environment']['maxRssKiB'] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    with open(args.output, 'w') as f:
+        json.dump(results, f, indent=2)
+    print(f"Results written to {args.output}")
+    
+    if args.compare:
+        with open(args.compare) as f:
+            regressions = compare(results, json.load(f), args.threshold)
+        for line in regressions:
+            print(f"Slower: {line}")
+        if regressions:
+            return 1
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,40 @@
+# gunicorn.conf.py - Production serving: gunicorn -c gunicorn.conf.py server:app
+#
+# The app is imported once in the parent process (preload_app), so terrains listed in
+# PRELOAD_TERRAINS are built there and shared copy-on-write by every forked worker.
+
+import gc
+import os
+
+bind = f"0.0.0.0:{os.environ.get('PORT', '8080')}"
+
+# One worker process by default: jobs, cached terrains, segment results and metrics live
+# in the process that created them, so with several workers a poll, a /reroute or a
+# /metrics scrape lands on a process that knows nothing of the earlier request. Scaling
+# out with WEB_CONCURRENCY needs that state moved to a shared store (e.g. Redis, or a
+# separate job process); until then /jobs, and /reroute over terrains that were not
+# preloaded, answer 503 when there is more than one worker. Routing requests per worker
+# can be capped with WORKER_MAX_ROUTES (see server.py); the legs of a route fan out to
+# the segment pool (SEGMENT_WORKERS).
+workers = int(os.environ.get('WEB_CONCURRENCY', '1'))
+worker_class = 'gthread'
+threads = int(os.environ.get('WORKER_THREADS', '16'))
+
+preload_app = True
+
+# Large grids can take minutes to route; ROUTE_DEADLINE_MS is the per-request limit
+timeout = int(os.environ.get('WORKER_TIMEOUT', '300'))
+graceful_timeout = 30
+keepalive = 5
+
+accesslog = '-'
+
+def when_ready(server):
+    # Move the preloaded objects out of the collector's reach: collections in the
+    # workers would otherwise write to their pages and un-share them
+    gc.freeze()
+
+def post_fork(server, worker):
+    # Lets the app see the configured worker count (which -w may override) and turn
+    # /jobs away when its per-process job store would be split across several workers
+    os.environ['ROUTE_WEB_WORKERS'] = str(server.cfg.workers)
@@ -0,0 +1,206 @@
+# ingest.py - Upload formats for elevation grids
+#
+# pandas and pyarrow are heavy to import, so they are only loaded by the CSV and Arrow
+# paths that need them; JSON, .npy/.npz and grid descriptors are read with NumPy alone.
+
+import base64
+import gzip
+import io
+import numpy as np
+
+ARROW_STREAM = 'application/vnd.apache.arrow.stream'
+ARROW_FILE = 'application/vnd.apache.arrow.file'
+NPY = 'application/x-npy'
+NPZ = 'application/x-npz'
+BINARY_TYPES = (ARROW_STREAM, ARROW_FILE, NPY, NPZ)
+EXTENSION_TYPES = {
+    '.arrows': ARROW_STREAM,
+    '.arrow': ARROW_FILE,
+    '.feather': ARROW_FILE,
+    '.npy': NPY,
+    '.npz': NPZ,
+}
+
+def binary_type(content_type, filename=None):
+    """The binary format named by a Content-Type or file extension, or None for CSV/JSON"""
+    media_type = (content_type or '').split(';')[0].strip().lower()
+    if media_type in BINARY_TYPES:
+        return media_type
+    if filename:
+        for extension, file_type in EXTENSION_TYPES.items():
+            if filename.lower().endswith(extension):
+                return file_type
+    return None
+
+def read_points(data, file_type):
+    """Column arrays (lat, lng, elevation, point_type) from a binary upload.
+    
+    Arrow tables and .npy structured arrays carry the same columns as the
+    CSV. A .npz archive holds a `grid` array of lat/lng/elevation and a
+    separate `waypoints` array with the same fields plus an optional
+    point_type (start, w1, w2, ..., end by default). Numeric columns are
+    views of the uploaded bytes where the format allows it, so no per-row
+    objects are created.
+    """
+    if file_type in (ARROW_STREAM, ARROW_FILE):
+        return _read_arrow(data, file_type)
+    if file_type == NPY:
+        return _columns(_read_npy(data))
+    if file_type == NPZ:
+        return _read_npz(data)
+    raise ValueError(f"Unsupported upload type {file_type}")
+
+def read_records(records):
+    """Column arrays (lat, lng, elevation, point_type) from JSON point records, without pandas.
+    
+    As in a DataFrame built from the records, a column is present when any
+    record has the field, and null or missing values are NaN. Values that
+    are not numbers raise ValueError.
+    """
+    if not isinstance(records, list) or not all(isinstance(record, dict) for record in records):
+        raise ValueError("elevationData must be a list of point objects")
+    present = set().union(*records)
+    columns = {}
+    for name in ('lat', 'lng', 'elevation'):
+        if name in present:
+            try:
+                columns[name] = np.array([record.get(name) for record in records], dtype=np.float64)
+            except (TypeError, ValueError):
+                raise ValueError(f"Column {name} must hold numbers")
+    if 'point_type' in present:
+        columns['point_type'] = np.array([str(record.get('point_type')) for record in records])
+    return columns
+
+def read_csv(source):
+    """A CSV file as a DataFrame, its floats parsed so they round-trip.
+    
+    Uploads and PRELOAD_TERRAINS files both go through here, so a grid gets
+    the same terrain key whichever way it arrives, and the same as when sent
+    as JSON.
+    """
+    import pandas as pd
+    return pd.read_csv(source, float_precision='round_trip')
+
+def read_grid(grid):
+    """`(layout, elevation)` from a compact grid descriptor.
+    
+    The descriptor gives the lattice as `origin` (lat, lng of row 0, col 0)
+    and `step` (one value or a (lat_step, lng_step) pair), or as `bbox`
+    ([south, west, north, east], rows running south to north), plus `rows`,
+    `cols` and the row-major `elevation`. The elevation is a list of numbers
+    or a base64 string of little-endian `dtype` values (float32 by default),
+    optionally gzip-compressed (`compression: "gzip"`). `layout` is the
+    {origin, step, rows, cols} dict accepted by `AStar.build_terrain`.
+    """
+    missing = [name for name in ('rows', 'cols', 'elevation') if name not in grid]
+    if 'origin' not in grid and 'bbox' not in grid:
+        missing.append('origin')
+    if 'step' not in grid and 'bbox' not in grid:
+        missing.append('step')
+    if missing:
+        raise ValueError(f"Grid descriptor is missing: {missing}")
+    try:
+        rows, cols = int(grid['rows']), int(grid['cols'])
+    except (TypeError, ValueError):
+        raise ValueError("Grid rows and cols must be whole numbers")
+    if rows < 2 or cols < 2:
+        raise ValueError("Grid needs at least 2 rows and 2 columns")
+    
+    if 'bbox' in grid:
+        south, west, north, east = _numbers(grid['bbox'], 'bbox', 4)
+        origin = (south, west)
+        step = ((north - south) / (rows - 1), (east - west) / (cols - 1))
+    else:
+        origin = _numbers(grid['origin'], 'origin', 2)
+        step = grid['step']
+        step = _numbers([step, step] if np.isscalar(step) else step, 'step', 2)
+    
+    elevation = _grid_elevation(grid)
+    if len(elevation) != rows * cols:
+        raise ValueError(f"Grid of {rows}x{cols} does not match {len(elevation)} elevation points")
+    if not np.isfinite(elevation).all():
+        raise ValueError("Grid elevation contains non-finite values")
+    return {'origin': origin, 'step': step, 'rows': rows, 'cols': cols}, elevation
+
+def _numbers(value, name, count):
+    """`value` as a tuple of `count` floats, or ValueError naming the descriptor field"""
+    try:
+        if not isinstance(value, (list, tuple)) or len(value) != count:
+            raise ValueError
+        return tuple(float(item) for item in value)
+    except (TypeError, ValueError):
+        raise ValueError(f"Grid {name} must be {'a number or ' if name == 'step' else ''}a list of {count} numbers")
+
+def _grid_elevation(grid):
+    elevation = grid['elevation']
+    if not isinstance(elevation, str):
+        return np.asarray(elevation, dtype=np.float64)
+    try:
+        data = base64.b64decode(elevation, validate=True)
+        if grid.get('compression') == 'gzip':
+            data = gzip.decompress(data)
+        elif grid.get('compression'):
+            raise ValueError(f"Unsupported elevation compression {grid['compression']}")
+        dtype = np.dtype(grid.get('dtype', 'float32')).newbyteorder('<')
+    except (ValueError, TypeError, OSError, EOFError) as e:
+        raise ValueError(f"Could not decode grid elevation: {e}")
+    if dtype.kind not in 'fiu' or len(data) % dtype.itemsize:
+        raise ValueError(f"Grid elevation is not a whole number of {dtype.name} values")
+    return np.frombuffer(data, dtype=dtype).astype(np.float64)
+
+def _read_arrow(data, file_type):
+    try:
+        import pyarrow as pa
+    except ImportError:  # Arrow uploads are optional
+        raise ValueError("Arrow uploads need the pyarrow package")
+    source = pa.py_buffer(data)
+    reader = pa.ipc.open_stream(source) if file_type == ARROW_STREAM else pa.ipc.open_file(source)
+    table = reader.read_all()
+    missing = [name for name in ('lat', 'lng', 'elevation', 'point_type') if name not in table.column_names]
+    if missing:
+        raise ValueError(f"Missing required columns: {missing}")
+    # Single-chunk float columns without nulls convert without copying
+    return {name: table.column(name).to_numpy() for name in ('lat', 'lng', 'elevation', 'point_type')}
+
+def _read_npy(data):
+    """A .npy array as a read-only view of `data` (object arrays are refused)"""
+    buffer = io.BytesIO(data)
+    version = np.lib.format.read_magic(buffer)
+    read_header = np.lib.format.read_array_header_1_0 if version == (1, 0) else np.lib.format.read_array_header_2_0
+    shape, fortran_order, dtype = read_header(buffer)
+    if dtype.hasobject:
+        raise ValueError("Object arrays are not accepted")
+    if len(shape) != 1:
+        raise ValueError("Expected a 1-D structured array")
+    return np.frombuffer(data, dtype=dtype, count=shape[0], offset=buffer.tell())
+
+def _read_npz(data):
+    archive = np.load(io.BytesIO(data), allow_pickle=False)
+    if not isinstance(archive, np.lib.npyio.NpzFile):
+        raise ValueError("Expected a .npz archive")
+    with archive:
+        if 'grid' not in archive or 'waypoints' not in archive:
+            raise ValueError("Expected 'grid' and 'waypoints' arrays in the .npz upload")
+        grid, waypoints = archive['grid'], archive['waypoints']
+    if waypoints.dtype.names and 'point_type' in waypoints.dtype.names:
+        waypoint_types = waypoints['point_type'].astype(str)
+    else:
+        last = len(waypoints) - 1
+        waypoint_types = np.array(['start' if i == 0 else 'end' if i == last else f'w{i}'
+                                   for i in range(len(waypoints))])
+    columns = {name: np.concatenate((_field(grid, name), _field(waypoints, name)))
+               for name in ('lat', 'lng', 'elevation')}
+    columns['point_type'] = np.concatenate((np.full(len(grid), 'grid'), waypoint_types))
+    return columns
+
+def _field(array, name):
+    if not array.dtype.names or name not in array.dtype.names:
+        raise ValueError(f"Missing required columns: ['{name}']")
+    return array[name]
+
+def _columns(array):
+    """Column views of a structured array with the CSV fields"""
+    columns = {name: _field(array, name) for name in ('lat', 'lng', 'elevation', 'point_type')}
+    if columns['point_type'].dtype.kind == 'S':
+        columns['point_type'] = columns['point_type'].astype(str)
+    return columns
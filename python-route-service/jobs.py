@@ -0,0 +1,156 @@
+# jobs.py - Bounded in-process queue of routing jobs that clients submit, poll and collect
+
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+class QueueFull(Exception):
+    """Raised by JobQueue.submit when every worker is busy and the queue is at capacity"""
+
+class Job:
+    """A submitted routing request and what is known about it so far.
+    
+    `status` moves from 'queued' to 'running' and then to 'done', 'failed'
+    (with the exception in `error`) or 'cancelled'. `done` and `total` count
+    the route legs finished, as reported through `progress`.
+    """
+    
+    def __init__(self, key):
+        self.id = uuid.uuid4().hex
+        self.key = key
+        self.status = 'queued'
+        self.done = 0
+        self.total = None
+        self.result = None
+        self.error = None
+        self.cancelled = False
+        self.submitted = time.time()
+        self.started = None
+        self.finished = None
+    
+    @property
+    def active(self):
+        return self.status in ('queued', 'running')
+    
+    def progress(self, done, total):
+        self.done, self.total = done, total
+    
+    def to_dict(self):
+        return {
+            'jobId': self.id,
+            'status': self.status,
+            'progress': {'segmentsDone': self.done, 'segmentsTotal': self.total},
+            'submitted': self.submitted,
+            'started': self.started,
+            'finished': self.finished,
+        }
+
+class JobQueue:
+    """Runs jobs on `workers` threads, with at most `max_queued` more waiting.
+    
+    Submitting the same `key` while a job for it is queued, running or has its
+    result retained returns that job instead of starting another. Finished
+    jobs are forgotten `ttl` seconds after they end, and beyond `max_retained`
+    finished jobs the oldest are forgotten first.
+    """
+    
+    def __init__(self, workers, max_queued, ttl, max_retained):
+        self.workers = workers
+        self.max_queued = max_queued
+        self.ttl = ttl
+        self.max_retained = max_retained
+        self.evicted = 0
+        self.rejected = 0
+        self.coalesced = 0
+        self._jobs = {}
+        self._by_key = {}
+        self._lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='route-job')
+    
+    def submit(self, key, run):
+        """Queue `run(job)`, returning (job, coalesced); raises QueueFull when at capacity"""
+        with self._lock:
+            self._purge()
+            job = self._jobs.get(self._by_key.get(key))
+            if job is not None and (job.active or job.status == 'done'):
+                self.coalesced += 1
+                return job, True
+            if sum(job.active for job in self._jobs.values()) >= self.workers + self.max_queued:
+                self.rejected += 1
+                raise QueueFull(f"{self.workers} jobs running and {self.max_queued} queued; try again later")
+            job = Job(key)
+            self._jobs[job.id] = job
+            self._by_key[key] = job.id
+        self._executor.submit(self._run, job, run)
+        return job, False
+    
+    def get(self, job_id):
+        with self._lock:
+            self._purge()
+            return self._jobs.get(job_id)
+    
+    def cancel(self, job_id):
+        """Flag a job as cancelled; a queued job never starts and a running one stops at its next deadline check"""
+        with self._lock:
+            job = self._jobs.get(job_id)
+            if job is not None and job.active:
+                job.cancelled = True
+                if job.status == 'queued':
+                    job.status = 'cancelled'
+                    job.finished = time.time()
+            return job
+    
+    def _run(self, job, run):
+        with self._lock:
+            if job.cancelled:
+                return
+            job.status = 'running'
+            job.started = time.time()
+        try:
+            result = run(job)
+        except Exception as e:
+            job.error = e
+            status = 'cancelled' if job.cancelled else 'failed'
+        else:
+            job.result = result
+            status = 'done'
+        with self._lock:
+            job.status = status
+            job.finished = time.time()
+            self._purge()
+    
+    def _purge(self):
+        # Called with the lock held; expired results are dropped lazily on the next access,
+        # results over max_retained as soon as another job finishes
+        cutoff = time.time() - self.ttl
+        finished = sorted((job for job in self._jobs.values() if job.finished is not None), key=lambda job: job.finished)
+        over = len(finished) - self.max_retained
+        for i, job in enumerate(finished):
+            if job.finished < cutoff:
+                self._forget(job)
+            elif i < over:
+                self._forget(job)
+                self.evicted += 1
+    
+    def _forget(self, job):
+        del self._jobs[job.id]
+        if self._by_key.get(job.key) == job.id:
+            del self._by_key[job.key]
+    
+    def stats(self):
+        with self._lock:
+            self._purge()
+            statuses = [job.status for job in self._jobs.values()]
+            return {
+                'workers': self.workers,
+                'maxQueued': self.max_queued,
+                'ttlSeconds': self.ttl,
+                'maxRetained': self.max_retained,
+                'queued': statuses.count('queued'),
+                'running': statuses.count('running'),
+                'retained': len(statuses) - statuses.count('queued') - statuses.count('running'),
+                'rejected': self.rejected,
+                'coalesced': self.coalesced,
+                'evicted': self.evicted,
+            }
@@ -0,0 +1,126 @@
+# metrics.py - Per-stage timings and search counters, exported in Prometheus text format
+
+import os
+import resource
+import threading
+import time
+from contextlib import contextmanager
+
+# Progress prints can be switched off (ROUTE_VERBOSE=0) to save their cost under load
+VERBOSE = os.environ.get('ROUTE_VERBOSE', '1') not in ('0', 'false', 'no')
+
+TIME_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+COUNT_BUCKETS = (10, 100, 1000, 10000, 100000, 1000000, 10000000)
+
+# Every Histogram and Counter registers itself here for `render`
+REGISTRY = []
+
+def log(*args, **kwargs):
+    """print() that stays quiet when VERBOSE is off"""
+    if VERBOSE:
+        print(*args, **kwargs)
+
+def _label_text(names, values):
+    return ','.join(f'{name}="{value}"' for name, value in zip(names, values))
+
+class Histogram:
+    """Prometheus-style histogram with cumulative buckets, one series per label combination"""
+    
+    def __init__(self, name, documentation, buckets, labels=()):
+        self.name = name
+        self.documentation = documentation
+        self.buckets = tuple(buckets)
+        self.labels = tuple(labels)
+        self._series = {}
+        self._lock = threading.Lock()
+        REGISTRY.append(self)
+    
+    def observe(self, value, **labels):
+        key = tuple(str(labels[name]) for name in self.labels)
+        with self._lock:
+            series = self._series.get(key)
+            if series is None:
+                series = self._series[key] = {'counts': [0] * len(self.buckets), 'sum': 0.0, 'count': 0}
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    series['counts'][i] += 1
+            series['sum'] += value
+            series['count'] += 1
+    
+    @contextmanager
+    def time(self, **labels):
+        """Observe the seconds spent in the `with` block"""
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started, **labels)
+    
+    def render(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            for key, series in sorted(self._series.items()):
+                labels = _label_text(self.labels, key)
+                prefix = labels + ',' if labels else ''
+                for bound, count in zip(self.buckets, series['counts']):
+                    lines.append(f'{self.name}_bucket{{{prefix}le="{bound}"}} {count}')
+                lines.append(f'{self.name}_bucket{{{prefix}le="+Inf"}} {series["count"]}')
+                suffix = f'{{{labels}}}' if labels else ''
+                lines.append(f"{self.name}_sum{suffix} {series['sum']}")
+                lines.append(f"{self.name}_count{suffix} {series['count']}")
+        return lines
+
+class Counter:
+    """Prometheus-style counter, one value per label combination"""
+    
+    def __init__(self, name, documentation, labels=()):
+        self.name = name
+        self.documentation = documentation
+        self.labels = tuple(labels)
+        self._values = {}
+        self._lock = threading.Lock()
+        REGISTRY.append(self)
+    
+    def inc(self, amount=1, **labels):
+        key = tuple(str(labels[name]) for name in self.labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+    
+    def render(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} counter"]
+        with self._lock:
+            for key, value in sorted(self._values.items()):
+                labels = _label_text(self.labels, key)
+                lines.append(f"{self.name}{{{labels}}} {value}" if labels else f"{self.name} {value}")
+        return lines
+
+def resident_bytes():
+    """Current resident memory of this process (the peak where /proc is not available)"""
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError):
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return peak if os.uname().sysname == 'Darwin' else peak * 1024  # bytes on macOS, KiB elsewhere
+
+def sample_lines(name, documentation, metric_type, value):
+    """Exposition lines of a single unlabelled value read at scrape time (e.g. a cache size)"""
+    return [f"# HELP {name} {documentation}", f"# TYPE {name} {metric_type}", f"{name} {value}"]
+
+def render(extra_lines=()):
+    """All registered metrics, plus `extra_lines`, in Prometheus text format"""
+    lines = [line for metric in REGISTRY for line in metric.render()]
+    lines.extend(extra_lines)
+    return '\n'.join(lines) + '\n'
+
+# Pipeline stages: parse, build, search, smooth, densify, simplify, stats, encode, serialize
+stage_seconds = Histogram('route_stage_seconds', 'Time spent in each routing stage', TIME_BUCKETS, labels=('stage',))
+search_expanded = Histogram('route_search_expanded_nodes', 'Nodes expanded per searched leg', COUNT_BUCKETS,
+                            labels=('method',))
+search_pushes = Histogram('route_search_heap_pushes', 'Heap pushes per searched leg', COUNT_BUCKETS, labels=('method',))
+search_iterations = Histogram('route_search_iterations', 'Heap pops per searched leg', COUNT_BUCKETS, labels=('method',))
+legs_total = Counter('route_legs_total', 'Route legs by outcome (searched, cached, approximate, fallback)',
+                     labels=('outcome',))
+request_seconds = Histogram('route_request_seconds', 'Request latency by endpoint', TIME_BUCKETS,
+                            labels=('endpoint',))
+requests_total = Counter('route_requests_total', 'Requests by endpoint and status code', labels=('endpoint', 'status'))
@@ -1,15 +1,72 @@
 # server.py - COMPLETE FIXED VERSION
 
-from flask import Flask, request, jsonify, make_response
+import time
+STARTED = time.perf_counter()  # startup is timed from here, before the heavy imports
+
+from flask import Flask, Response, g, request, jsonify, make_response
 from flask_cors import CORS
-import pandas as pd
+import numpy as np
 import io
-from AStar import run_astar
+import hashlib
+import json
+import os
+import select
+import socket
+import sys
+import threading
+from functools import wraps
+from AStar import (run_astar, run_astar_grid, reroute, route_batch, preload_terrain, warm_up, key_point_mask,
+                   terrain_cache, segment_cache, DEFAULT_ALPHA, DEFAULT_SEARCH, Deadline, DeadlineExceeded,
+                   SearchCancelled)
+from ingest import binary_type, read_csv, read_grid, read_points, read_records
+from jobs import JobQueue, QueueFull
+from metrics import (log, render as render_metrics, resident_bytes, sample_lines, stage_seconds, request_seconds,
+                     requests_total)
 import traceback
 
 app = Flask(__name__)
 CORS(app)  # Allow all cross-origin requests
 
+# Worker processes used to solve the legs of multi-waypoint routes in parallel (0/1 = sequential)
+SEGMENT_WORKERS = int(os.environ.get('SEGMENT_WORKERS', '0'))
+
+# Memory budget for built terrains kept between requests
+terrain_cache.max_bytes = int(os.environ.get('TERRAIN_CACHE_MB', '256')) * 1024 * 1024
+
+# Default time budget for the searches of one request (0 = unlimited); requests can set "deadlineMs"
+ROUTE_DEADLINE_MS = int(os.environ.get('ROUTE_DEADLINE_MS', '0'))
+
+# Paths with more points than this are streamed instead of serialised in one piece
+STREAM_POINTS = int(os.environ.get('STREAM_POINTS', '20000'))
+STREAM_CHUNK_BYTES = 64 * 1024
+CSV_CHUNK_ROWS = 10000
+
+# Routing jobs submitted to /jobs: threads working on them, how many more may wait, and
+# how long and how many finished results are kept for collection
+JOB_WORKERS = int(os.environ.get('JOB_WORKERS', '2'))
+JOB_QUEUE_SIZE = int(os.environ.get('JOB_QUEUE_SIZE', '8'))
+JOB_TTL_SECONDS = int(os.environ.get('JOB_TTL_SECONDS', '600'))
+JOB_MAX_RETAINED = int(os.environ.get('JOB_MAX_RETAINED', '32'))
+jobs = JobQueue(JOB_WORKERS, JOB_QUEUE_SIZE, JOB_TTL_SECONDS, JOB_MAX_RETAINED)
+
+# Routing requests one process works on at once (0 = no limit); further ones wait up to
+# WORKER_ROUTE_WAIT_SECONDS for a slot and are then turned away with 503
+WORKER_MAX_ROUTES = int(os.environ.get('WORKER_MAX_ROUTES', '0'))
+WORKER_ROUTE_WAIT_SECONDS = float(os.environ.get('WORKER_ROUTE_WAIT_SECONDS', '30'))
+route_slots = threading.BoundedSemaphore(WORKER_MAX_ROUTES) if WORKER_MAX_ROUTES > 0 else None
+
+# Grid files (CSV, Arrow, .npy or .npz, separated by commas) built into pinned terrains at
+# startup; under gunicorn's preload_app this happens once, before the workers are forked
+PRELOAD_TERRAINS = [path.strip() for path in os.environ.get('PRELOAD_TERRAINS', '').split(',') if path.strip()]
+PRELOAD_LANDMARKS = os.environ.get('PRELOAD_LANDMARKS', '0') in ('1', 'true')
+preloaded_terrains = {}
+
+# Route a small synthetic grid (and ready the preloaded terrains) before serving the first request
+ROUTE_WARMUP = os.environ.get('ROUTE_WARMUP', '0') in ('1', 'true')
+
+# Filled in once the module has loaded: seconds to start, warm-up seconds and RSS when ready
+startup = {}
+
 @app.route('/health', methods=['GET'])
 def health_check():
     """Health check endpoint"""
@@ -21,11 +78,235 @@ def health_check():
             "Sequential A* pathfinding (FIXED MESH BUG)",
             "Elevation-aware routing", 
             "CSV processing",
-            "Multi-waypoint sequential routing"
-        ]
+            "Multi-waypoint sequential routing",
+            "Terrain cache across requests",
+            "Incremental re-routing of edited waypoints",
+            "Bidirectional A* search",
+            "Landmark (ALT) heuristic for repeated terrains",
+            "Batch routing over one grid",
+            "Waypoint order optimization",
+            "Hierarchical search for large grids",
+            "Binary grid uploads (Arrow, npy, npz)",
+            "Compact grid descriptor requests",
+            "Encoded polyline output, path simplification and streamed responses",
+            "Search deadlines with approximate routes, stopped when the client disconnects",
+            "Per-stage Prometheus metrics",
+            "Asynchronous routing jobs with progress",
+            "Pre-fork serving with preloaded shared terrains"
+        ],
+        "terrainCache": terrain_cache.stats(),
+        "segmentCache": segment_cache.stats(),
+        "jobs": jobs.stats(),
+        "preloadedTerrains": preloaded_terrains,
+        "worker": {
+            "pid": os.getpid(),
+            "maxRoutes": WORKER_MAX_ROUTES or None,
+            "rssBytes": resident_bytes(),
+            "pandasLoaded": 'pandas' in sys.modules
+        },
+        "startup": startup
     })
 
+@app.route('/metrics', methods=['GET'])
+def metrics():
+    """Prometheus metrics: stage timings, search counters, request latency and cache state"""
+    extra = cache_metric_lines('route_terrain_cache', terrain_cache) + cache_metric_lines('route_segment_cache', segment_cache)
+    extra += (sample_lines('process_resident_memory_bytes', 'Resident memory of this process', 'gauge', resident_bytes()) +
+              sample_lines('route_startup_seconds', 'Seconds from import to ready, warm-up included', 'gauge',
+                           startup.get('seconds', 0)))
+    return Response(render_metrics(extra), mimetype='text/plain; version=0.0.4')
+
+def cache_metric_lines(prefix, cache):
+    stats = cache.stats()
+    return (sample_lines(f'{prefix}_hits_total', 'Cache hits', 'counter', stats['hits']) +
+            sample_lines(f'{prefix}_misses_total', 'Cache misses', 'counter', stats['misses']) +
+            sample_lines(f'{prefix}_evictions_total', 'Entries evicted to stay within budget', 'counter', stats['evictions']) +
+            sample_lines(f'{prefix}_entries', 'Entries currently cached', 'gauge', stats['entries']) +
+            sample_lines(f'{prefix}_bytes', 'Bytes currently cached', 'gauge', stats['bytes']))
+
+@app.before_request
+def start_request_timer():
+    g.started = time.perf_counter()
+
+@app.after_request
+def record_request(response):
+    endpoint = request.endpoint or 'unknown'
+    request_seconds.observe(time.perf_counter() - g.started, endpoint=endpoint)
+    requests_total.inc(endpoint=endpoint, status=response.status_code)
+    return response
+
+def is_set(value):
+    """Truthiness of a flag given as a JSON boolean or a form/query string"""
+    return value in (True, 1, '1', 'true')
+
+def elapsed_ms(started):
+    return round((time.perf_counter() - started) * 1000, 1)
+
+def tolerance(value):
+    """A `simplify` tolerance in metres from JSON or a form/query string (None when not given)"""
+    if value in (None, '', False):
+        return None
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        raise ValueError(f"simplify must be a tolerance in metres, got {value!r}")
+
+def path_options(data):
+    """route_graph output options from a request's JSON body or query string"""
+    return {
+        'simplify': tolerance(data.get('simplify')),
+        'path_format': data.get('format') or 'coordinates'
+    }
+
+def alpha_option(data):
+    """The "alpha" of a request: a number, a list of them or "pareto"; form and query strings separate them by commas"""
+    alpha = data.get('alpha', DEFAULT_ALPHA)
+    if not isinstance(alpha, str) or alpha == 'pareto':
+        return alpha
+    try:
+        values = [float(value) for value in alpha.split(',')]
+    except ValueError:
+        raise ValueError(f"alpha must be a number, a list of them or 'pareto', got {alpha!r}")
+    return values[0] if len(values) == 1 else values
+
+def client_disconnected(environ):
+    """Whether the client of a request has closed its connection.
+    
+    The request body has been read by the time routing runs, so a socket that
+    polls readable but has nothing to read was closed by the client. Servers
+    that do not expose the socket are treated as always connected.
+    """
+    sock = environ.get('gunicorn.socket') or environ.get('werkzeug.socket')
+    if sock is None:
+        return False
+    try:
+        readable, _, _ = select.select([sock], [], [], 0)
+        return bool(readable) and sock.recv(1, socket.MSG_PEEK) == b''
+    except (OSError, ValueError):
+        return True
+
+def deadline_seconds(data):
+    """The search time budget of a request: "deadlineMs", or ROUTE_DEADLINE_MS (None = unlimited)"""
+    deadline_ms = data.get('deadlineMs') or ROUTE_DEADLINE_MS
+    try:
+        return float(deadline_ms) / 1000 if deadline_ms else None
+    except (TypeError, ValueError):
+        raise ValueError(f"deadlineMs must be a number of milliseconds, got {deadline_ms!r}")
+
+def request_deadline(data, cancelled=None):
+    """The Deadline of a request: "deadlineMs" (or ROUTE_DEADLINE_MS) and "partial".
+    
+    It is cancelled when `cancelled()` returns True, by default when the
+    client of the current request disconnects.
+    """
+    if cancelled is None:
+        environ = request.environ
+        cancelled = lambda: client_disconnected(environ)
+    partial = data.get('partial')
+    return Deadline(deadline_seconds(data), partial=partial is None or is_set(partial), cancelled=cancelled)
+
+def search_stopped(e):
+    """Response for a search stopped by its deadline (504) or by the client going away"""
+    if isinstance(e, SearchCancelled):
+        log(f"🛑 Search cancelled: {e}")
+        return jsonify({
+            "success": False,
+            "error": str(e),
+            "type": "cancelled"
+        }), 499
+    log(f"⏱️ {e}")
+    return jsonify({
+        "success": False,
+        "error": str(e),
+        "type": "deadline_exceeded"
+    }), 504
+
+def limited(view):
+    """Let at most WORKER_MAX_ROUTES requests of this process into `view` at once (503 when none frees up)"""
+    @wraps(view)
+    def wrapper(*args, **kwargs):
+        if route_slots is None:
+            return view(*args, **kwargs)
+        if not route_slots.acquire(timeout=WORKER_ROUTE_WAIT_SECONDS):
+            log(f"🚦 Worker {os.getpid()} busy: {WORKER_MAX_ROUTES} routes already running")
+            response = jsonify({
+                "success": False,
+                "error": "The server is busy routing other requests; try again later",
+                "type": "busy"
+            })
+            response.headers['Retry-After'] = '5'
+            return response, 503
+        try:
+            return view(*args, **kwargs)
+        finally:
+            route_slots.release()
+    return wrapper
+
+def web_workers():
+    """Worker processes the server runs; gunicorn.conf.py sets ROUTE_WEB_WORKERS in each one it forks"""
+    return int(os.environ.get('ROUTE_WEB_WORKERS', '1'))
+
+def per_process_state(what, kind):
+    """503 for a request that needs state one process holds while the server runs several"""
+    return jsonify({
+        "success": False,
+        "error": f"{what} kept per process and the server runs {web_workers()} workers; "
+                 f"run it with a single worker (WEB_CONCURRENCY=1) to use {request.path}",
+        "type": kind
+    }), 503
+
+def single_worker(view):
+    """Refuse `view` with 503 when the job store, which lives in one process, is split across several"""
+    @wraps(view)
+    def wrapper(*args, **kwargs):
+        if web_workers() > 1:
+            return per_process_state("Jobs are", "jobs_unavailable")
+        return view(*args, **kwargs)
+    return wrapper
+
+def streamed(data, result):
+    return is_set(data.get('stream')) or result['pathLength'] > STREAM_POINTS
+
+def timed_chunks(chunks):
+    """Yield from `chunks`, adding the time spent producing them (not sending them) to the 'serialize' stage"""
+    chunks = iter(chunks)
+    spent = 0.0
+    while True:
+        started = time.perf_counter()
+        chunk = next(chunks, None)
+        spent += time.perf_counter() - started
+        if chunk is None:
+            break
+        yield chunk
+    stage_seconds.observe(spent, stage='serialize')
+
+def json_response(payload, stream=False):
+    """jsonify(payload), or the same JSON sent as a chunked stream for very long paths"""
+    if not stream:
+        with stage_seconds.time(stage='serialize'):
+            return jsonify(payload)
+    
+    def chunks():
+        buffer, size = [], 0
+        for piece in json.JSONEncoder(separators=(',', ':')).iterencode(payload):
+            buffer.append(piece)
+            size += len(piece)
+            if size >= STREAM_CHUNK_BYTES:
+                yield ''.join(buffer)
+                buffer, size = [], 0
+        yield ''.join(buffer)
+    return Response(timed_chunks(chunks()), mimetype='application/json')
+
+def csv_chunks(lat, lng):
+    """The lat,lng CSV of a path in blocks of CSV_CHUNK_ROWS rows, formatted a block at a time"""
+    yield 'lat,lng'
+    for begin in range(0, len(lat), CSV_CHUNK_ROWS):
+        rows = zip(lat[begin:begin + CSV_CHUNK_ROWS], lng[begin:begin + CSV_CHUNK_ROWS])
+        values = tuple(value for row in rows for value in row)
+        yield '\n' + ('%.10f,%.10f\n' * (len(values) // 2) % values)[:-1]
+
 @app.route('/process_csv', methods=['POST'])
+@limited
 def process_csv():
     """FIXED: Process CSV with elevation data and return sequential route as CSV"""
     try:
@@ -42,55 +323,78 @@ def process_csv():
                 "error": "No file selected"
             }), 400
         
-        print(f"📄 Processing uploaded CSV: {file.filename}")
-        
-        df = pd.read_csv(file)
-        print(f"📊 CSV contains {len(df)} rows")
+        # Arrow / .npy / .npz uploads are recognised by content type or extension
+        started = time.perf_counter()
+        file_type = binary_type(file.content_type, file.filename)
+        if file_type:
+            log(f"📄 Processing uploaded {file_type} file: {file.filename}")
+            points = read_points(file.read(), file_type)
+        else:
+            log(f"📄 Processing uploaded CSV: {file.filename}")
+            points = read_csv(file)
+        ingest_ms = elapsed_ms(started)
+        stage_seconds.observe(ingest_ms / 1000, stage='parse')
+        log(f"📊 Upload contains {len(points['lat'])} rows (ingested in {ingest_ms} ms)")
         
         required_columns = ['lat', 'lng', 'elevation', 'point_type']
-        missing_columns = [col for col in required_columns if col not in df.columns]
+        missing_columns = [col for col in required_columns if col not in points]
         if missing_columns:
             return jsonify({
                 "success": False,
                 "error": f"Missing required columns: {missing_columns}"
             }), 400
         
-        print(f"📊 Processing {len(df)} elevation points...")
+        log(f"📊 Processing {len(points['lat'])} elevation points...")
         
         # Count waypoints to determine routing strategy
-        waypoint_types = df['point_type'].unique()
-        waypoint_count = len([t for t in waypoint_types if t in ['start', 'end'] or t.startswith('w')])
+        point_types = np.asarray(points['point_type'], dtype=str)
+        waypoint_types = np.unique(point_types[key_point_mask(point_types)]).tolist()
+        waypoint_count = len(waypoint_types)
         
-        print(f"🎯 Detected {waypoint_count} waypoints: {sorted(waypoint_types)}")
+        log(f"🎯 Detected {waypoint_count} waypoints: {sorted(waypoint_types)}")
         
         if waypoint_count == 2:
-            print("📍 2-waypoint route: Using simple A* (works perfectly)")
+            log("📍 2-waypoint route: Using simple A* (works perfectly)")
         else:
-            print(f"📍 {waypoint_count}-waypoint route: Using FIXED SEQUENTIAL A* (no more mesh!)")
+            log(f"📍 {waypoint_count}-waypoint route: Using FIXED SEQUENTIAL A* (no more mesh!)")
         
         # Run the FIXED A* algorithm (auto-detects 2-point vs multi-point)
-        print("🔄 Running FIXED A* algorithm...")
-        result = run_astar(df)
+        log("🔄 Running FIXED A* algorithm...")
+        search = request.form.get('search') or request.args.get('search') or DEFAULT_SEARCH
+        landmarks = is_set(request.form.get('landmarks') or request.args.get('landmarks'))
+        optimize_order = is_set(request.form.get('optimize_order') or request.args.get('optimize_order'))
+        simplify = tolerance(request.form.get('simplify') or request.args.get('simplify'))
+        options = {**request.args.to_dict(), **request.form.to_dict()}
+        deadline = request_deadline(options)
+        alpha = alpha_option(options)
+        if isinstance(alpha, (list, str)):
+            return jsonify({
+                "success": False,
+                "error": "CSV responses hold a single route; use /process_route for several alphas"
+            }), 400
+        result = run_astar(points, workers=SEGMENT_WORKERS, search=search, landmarks=landmarks,
+                           optimize_order=optimize_order, simplify=simplify, path_format='columns',
+                           deadline=deadline, alpha=alpha)
         
-        print(f"✅ Generated SEQUENTIAL route with {result['pathLength']} points")
+        log(f"✅ Generated SEQUENTIAL route with {result['pathLength']} points")
         
         # Return as CSV format (same as working 2-point version)
-        path_coordinates = result['path']
+        path = result['path']
+        headers = {'Content-Type': 'text/plain', 'X-Ingest-Ms': str(ingest_ms),
+                   'X-Route-Approximate': str(result['approximate']).lower()}
         
-        # Create CSV response
-        csv_lines = ['lat,lng']  # Header
-        for coord in path_coordinates:
-            csv_lines.append(f"{coord['lat']:.10f},{coord['lng']:.10f}")
+        log(f"✅ Returning CSV with {result['pathLength']} sequential path points")
         
-        csv_content = '\n'.join(csv_lines)
-        
-        print(f"✅ Returning CSV with {len(path_coordinates)} sequential path points")
-        
-        # Return as plain text CSV (same format as working version)
-        return csv_content, 200, {'Content-Type': 'text/plain'}
+        # Return as plain text CSV (same format as working version), streamed for very long paths
+        if result['pathLength'] > STREAM_POINTS or is_set(request.form.get('stream') or request.args.get('stream')):
+            return Response(timed_chunks(csv_chunks(path['lat'], path['lng'])), headers=headers)
+        return ''.join(timed_chunks(csv_chunks(path['lat'], path['lng']))), 200, headers
+    
+    except (DeadlineExceeded, SearchCancelled) as e:
+        return search_stopped(e)
         
     except ValueError as e:
-        print(f"❌ Algorithm error: {str(e)}")
+        log(f"❌ Algorithm error: {str(e)}")
         return jsonify({
             "success": False,
             "error": str(e),
@@ -107,61 +411,464 @@ def process_csv():
         }), 500
 
 @app.route('/process_route', methods=['POST'])
+@limited
 def process_route():
-    """Alternative endpoint that accepts JSON data instead of CSV file"""
+    """Alternative endpoint that accepts JSON data instead of CSV file.
+    
+    The grid can also be posted as a binary body (Arrow IPC, .npy or .npz,
+    chosen by Content-Type), with the options below in the query string, or
+    as a compact descriptor: "grid" with origin/step (or bbox), rows, cols
+    and the flat "elevation" (see `ingest.read_grid`), plus "waypoints".
+    """
+    try:
+        started = time.perf_counter()
+        file_type = binary_type(request.content_type)
+        if file_type:
+            log(f"🔄 Processing {file_type} elevation data...")
+            points = read_points(request.get_data(), file_type)
+            data = request.args
+        else:
+            data = request.get_json()
+            
+            if data and 'elevationData' not in data and 'elevation' in (data.get('grid') or {}):
+                return process_grid_descriptor(data, started)
+        
+            if not data or 'elevationData' not in data:
+                return jsonify({
+                    "success": False,
+                    "error": "No elevation data provided"
+                }), 400
+        
+            log("🔄 Processing JSON elevation data...")
+        
+            # Convert the JSON records to column arrays
+            points = read_records(data['elevationData'])
+        ingest_ms = elapsed_ms(started)
+        stage_seconds.observe(ingest_ms / 1000, stage='parse')
+        
+        # Validate required columns
+        required_columns = ['lat', 'lng', 'elevation', 'point_type']
+        missing_columns = [col for col in required_columns if col not in points]
+        if missing_columns:
+            return jsonify({
+                "success": False,
+                "error": f"Missing required columns: {missing_columns}"
+            }), 400
+        
+        log(f"📊 Processing {len(points['lat'])} elevation points (ingested in {ingest_ms} ms)...")
+        
+        # Run A* algorithm (optional "grid": {origin, step, rows, cols} describes a regular lattice)
+        # Optional "search": 'bidirectional' (default), 'astar', 'hierarchical' or
+        # {"method": "hierarchical", "corridor": <coarse cells>}, and "landmarks": true
+        # to precompute landmark tables for a terrain that will be routed over again.
+        # "optimizeOrder": true visits the intermediate waypoints in the cheapest order.
+        # Output: "format" ('coordinates', 'columns' or 'polyline'), "simplify" (metres)
+        # and "stream": true (implied for paths over STREAM_POINTS)
+        route_started = time.perf_counter()
+        result = run_astar(points, grid=None if file_type else data.get('grid'), workers=SEGMENT_WORKERS,
+                           search=data.get('search') or DEFAULT_SEARCH,
+                           landmarks=is_set(data.get('landmarks')),
+                           optimize_order=is_set(data.get('optimizeOrder')),
+                           deadline=request_deadline(data), alpha=alpha_option(data),
+                           **path_options(data))
+        result['timings'] = {'ingestMs': ingest_ms, 'routeMs': elapsed_ms(route_started)}
+        
+        log(f"✅ Generated route with {result['pathLength']} points")
+        
+        return json_response({
+            "success": True,
+            "data": result
+        }, stream=streamed(data, result))
+    
+    except (DeadlineExceeded, SearchCancelled) as e:
+        return search_stopped(e)
+        
+    except ValueError as e:
+        log(f"❌ Algorithm error: {str(e)}")
+        return jsonify({
+            "success": False,
+            "error": str(e),
+            "type": "algorithm_error"
+        }), 422
+        
+    except Exception as e:
+        print(f"❌ Error processing route: {str(e)}")
+        print(traceback.format_exc())
+        return jsonify({
+            "success": False,
+            "error": "Internal server error occurred while processing route",
+            "type": "server_error"
+        }), 500
+
+def process_grid_descriptor(data, started):
+    """/process_route for a compact grid descriptor: the lattice is built straight from the elevations"""
+    if 'waypoints' not in data:
+        return jsonify({
+            "success": False,
+            "error": "waypoints are required with a grid descriptor"
+        }), 400
+    
+    waypoints = data['waypoints']
+    missing = [i for i, wp in enumerate(waypoints) if any(k not in wp for k in ('lat', 'lng'))]
+    if missing:
+        return jsonify({
+            "success": False,
+            "error": f"Waypoints missing lat/lng: {missing}"
+        }), 400
+    
+    grid, elevation = read_grid(data['grid'])
+    ingest_ms = elapsed_ms(started)
+    stage_seconds.observe(ingest_ms / 1000, stage='parse')
+    log(f"📊 Processing {len(elevation)} grid elevations (ingested in {ingest_ms} ms)...")
+    
+    route_started = time.perf_counter()
+    result = run_astar_grid(grid, elevation, waypoints, workers=SEGMENT_WORKERS,
+                            search=data.get('search') or DEFAULT_SEARCH,
+                            landmarks=is_set(data.get('landmarks')),
+                            optimize_order=is_set(data.get('optimizeOrder')),
+                            deadline=request_deadline(data), alpha=alpha_option(data),
+                            **path_options(data))
+    result['timings'] = {'ingestMs': ingest_ms, 'routeMs': elapsed_ms(route_started)}
+    
+    log(f"✅ Generated route with {result['pathLength']} points")
+    
+    return json_response({
+        "success": True,
+        "data": result
+    }, stream=streamed(data, result))
+
+@app.route('/reroute', methods=['POST'])
+@limited
+def reroute_route():
+    """Re-route an edited waypoint list over a terrain cached by an earlier request"""
     try:
         data = request.get_json()
         
-        if not data or 'elevationData' not in data:
+        if not data or 'terrainId' not in data or 'waypoints' not in data:
             return jsonify({
                 "success": False,
-                "error": "No elevation data provided"
+                "error": "terrainId and waypoints are required"
             }), 400
         
-        print("🔄 Processing JSON elevation data...")
+        waypoints = data['waypoints']
+        missing = [i for i, wp in enumerate(waypoints) if any(k not in wp for k in ('lat', 'lng', 'elevation'))]
+        if missing:
+            return jsonify({
+                "success": False,
+                "error": f"Waypoints missing lat/lng/elevation: {missing}"
+            }), 400
         
-        # Convert JSON to DataFrame
-        df = pd.DataFrame(data['elevationData'])
+        # Preloaded terrains are built before the workers fork, so every worker has them; any
+        # other terrain is only in the worker that built it, which this request may not reach
+        if web_workers() > 1 and data['terrainId'] not in preloaded_terrains.values():
+            return per_process_state("Terrains sent in requests are", "reroute_unavailable")
         
-        # Validate required columns
+        result = reroute(data['terrainId'], waypoints, workers=SEGMENT_WORKERS,
+                         search=data.get('search') or DEFAULT_SEARCH,
+                         landmarks=is_set(data.get('landmarks')),
+                         optimize_order=is_set(data.get('optimizeOrder')),
+                         deadline=request_deadline(data), alpha=alpha_option(data),
+                         **path_options(data))
+        
+        log(f"✅ Re-routed with {result['pathLength']} points")
+        
+        return json_response({
+            "success": True,
+            "data": result
+        }, stream=streamed(data, result))
+    
+    except LookupError as e:
+        # The terrain was evicted (or never sent): the client must resend the full grid
+        return jsonify({
+            "success": False,
+            "error": str(e),
+            "type": "terrain_not_cached"
+        }), 404
+    
+    except (DeadlineExceeded, SearchCancelled) as e:
+        return search_stopped(e)
+    
+    except ValueError as e:
+        log(f"❌ Algorithm error: {str(e)}")
+        return jsonify({
+            "success": False,
+            "error": str(e),
+            "type": "algorithm_error"
+        }), 422
+    
+    except Exception as e:
+        print(f"❌ Error re-routing: {str(e)}")
+        print(traceback.format_exc())
+        return jsonify({
+            "success": False,
+            "error": "Internal server error occurred while processing route",
+            "type": "server_error"
+        }), 500
+
+@app.route('/process_batch', methods=['POST'])
+@limited
+def process_batch():
+    """Route many waypoint lists over one elevation grid sent once"""
+    try:
+        data = request.get_json()
+        
+        if not data or 'elevationData' not in data or 'routes' not in data:
+            return jsonify({
+                "success": False,
+                "error": "elevationData and routes are required"
+            }), 400
+        
+        with stage_seconds.time(stage='parse'):
+            df = read_records(data['elevationData'])
         required_columns = ['lat', 'lng', 'elevation', 'point_type']
-        missing_columns = [col for col in required_columns if col not in df.columns]
+        missing_columns = [col for col in required_columns if col not in df]
         if missing_columns:
             return jsonify({
                 "success": False,
                 "error": f"Missing required columns: {missing_columns}"
             }), 400
         
-        print(f"📊 Processing {len(df)} elevation points...")
+        # Routes are [{"id": ..., "waypoints": [...]}, ...]; ids default to the list position
+        if not isinstance(data['routes'], list):
+            return jsonify({
+                "success": False,
+                "error": "routes must be a list of route objects",
+                "type": "invalid_request"
+            }), 400
+        routes = {}
+        for i, route in enumerate(data['routes']):
+            if not isinstance(route, dict):
+                return jsonify({
+                    "success": False,
+                    "error": f"Route {i}: expected an object with waypoints",
+                    "type": "invalid_request"
+                }), 400
+            waypoints = route.get('waypoints', [])
+            if not isinstance(waypoints, list) or any(not isinstance(wp, dict) or any(k not in wp for k in
+                                                      ('lat', 'lng', 'elevation')) for wp in waypoints):
+                return jsonify({
+                    "success": False,
+                    "error": f"Route {i}: waypoints need lat/lng/elevation"
+                }), 400
+            route_id = str(route.get('id', i))
+            if route_id in routes:
+                return jsonify({
+                    "success": False,
+                    "error": f"Route {i}: id {route_id!r} is used by another route; ids must be unique",
+                    "type": "invalid_request"
+                }), 400
+            routes[route_id] = waypoints
+        
+        started = time.perf_counter()
+        terrain_id, results = route_batch(df, routes, grid=data.get('grid'), workers=SEGMENT_WORKERS,
+                                          search=data.get('search') or DEFAULT_SEARCH,
+                                          landmarks=is_set(data.get('landmarks')),
+                                          optimize_order=is_set(data.get('optimizeOrder')),
+                                          deadline=request_deadline(data), alpha=alpha_option(data),
+                                          **path_options(data))
+        total_ms = elapsed_ms(started)
+        
+        log(f"✅ Routed batch of {len(results)} routes in {total_ms} ms")
+        
+        total_points = sum(result.get('pathLength', 0) for result in results.values())
+        return json_response({
+            "success": True,
+            "data": {
+                "terrainId": terrain_id,
+                "totalMs": total_ms,
+                "routes": results
+            }
+        }, stream=is_set(data.get('stream')) or total_points > STREAM_POINTS)
+    
+    except (DeadlineExceeded, SearchCancelled) as e:
+        return search_stopped(e)
+    
+    except ValueError as e:
+        log(f"❌ Algorithm error: {str(e)}")
+        return jsonify({
+            "success": False,
+            "error": str(e),
+            "type": "algorithm_error"
+        }), 422
+    
+    except Exception as e:
+        print(f"❌ Error processing batch: {str(e)}")
+        print(traceback.format_exc())
+        return jsonify({
+            "success": False,
+            "error": "Internal server error occurred while processing route",
+            "type": "server_error"
+        }), 500
+
+@app.route('/jobs', methods=['POST'])
+@single_worker
+def submit_job():
+    """Queue a /process_route request and answer at once with a job id to poll.
+    
+    The JSON body is that of /process_route: "elevationData" or a compact
+    "grid" descriptor with "waypoints", and the same options. The input is
+    checked before the job is queued. A body identical to one whose job is
+    still pending, or whose result is still kept, gets that job back.
+    """
+    try:
+        started = time.perf_counter()
+        data = request.get_json()
         
-        # Run A* algorithm
-        result = run_astar(df)
+        if not data or ('elevationData' not in data and 'elevation' not in (data.get('grid') or {})):
+            return jsonify({
+                "success": False,
+                "error": "No elevation data provided"
+            }), 400
         
-        print(f"✅ Generated route with {result['pathLength']} points")
+        if 'elevationData' in data:
+            points = read_records(data['elevationData'])
+            required_columns = ['lat', 'lng', 'elevation', 'point_type']
+            missing_columns = [col for col in required_columns if col not in points]
+            if missing_columns:
+                return jsonify({
+                    "success": False,
+                    "error": f"Missing required columns: {missing_columns}"
+                }), 400
+            route = lambda **options: run_astar(points, grid=data.get('grid'), **options)
+        else:
+            waypoints = data.get('waypoints')
+            if not waypoints or any(k not in wp for wp in waypoints for k in ('lat', 'lng')):
+                return jsonify({
+                    "success": False,
+                    "error": "waypoints with lat/lng are required with a grid descriptor"
+                }), 400
+            grid, elevation = read_grid(data['grid'])
+            route = lambda **options: run_astar_grid(grid, elevation, waypoints, **options)
+        ingest_ms = elapsed_ms(started)
+        stage_seconds.observe(ingest_ms / 1000, stage='parse')
+        
+        options = dict(workers=SEGMENT_WORKERS, search=data.get('search') or DEFAULT_SEARCH,
+                       landmarks=is_set(data.get('landmarks')), optimize_order=is_set(data.get('optimizeOrder')),
+                       alpha=alpha_option(data), **path_options(data))
+        deadline_seconds(data)  # reject a bad deadlineMs now instead of failing the job
+        
+        def run(job):
+            route_started = time.perf_counter()
+            result = route(deadline=request_deadline(data, cancelled=lambda: job.cancelled), progress=job.progress,
+                           **options)
+            result['timings'] = {'ingestMs': ingest_ms, 'queuedMs': round((job.started - job.submitted) * 1000, 1),
+                                 'routeMs': elapsed_ms(route_started)}
+            log(f"✅ Job {job.id} generated route with {result['pathLength']} points")
+            return result
+        
+        job, coalesced = jobs.submit(hashlib.blake2b(request.get_data(), digest_size=16).hexdigest(), run)
+        log(f"📥 Job {job.id} {'joined' if coalesced else 'queued'}")
         
         return jsonify({
             "success": True,
-            "data": result
+            "data": job_status(job, coalesced=coalesced)
+        }), 202
+    
+    except QueueFull as e:
+        log(f"🚦 Job rejected: {e}")
+        response = jsonify({
+            "success": False,
+            "error": str(e),
+            "type": "queue_full"
         })
-        
+        response.headers['Retry-After'] = '5'
+        return response, 429
+    
     except ValueError as e:
-        print(f"❌ Algorithm error: {str(e)}")
+        log(f"❌ Algorithm error: {str(e)}")
         return jsonify({
             "success": False,
             "error": str(e),
             "type": "algorithm_error"
         }), 422
-        
+    
     except Exception as e:
-        print(f"❌ Error processing route: {str(e)}")
+        print(f"❌ Error submitting job: {str(e)}")
         print(traceback.format_exc())
+        return jsonify({
+            "success": False,
+            "error": "Internal server error occurred while submitting job",
+            "type": "server_error"
+        }), 500
+
+def job_status(job, **extra):
+    """A job's state and progress, with the URLs to poll and collect it"""
+    return dict(job.to_dict(), statusUrl=f"/jobs/{job.id}", resultUrl=f"/jobs/{job.id}/result", **extra)
+
+def unknown_job(job_id):
+    return jsonify({
+        "success": False,
+        "error": f"Job {job_id} is unknown or its result has expired"
+    }), 404
+
+@app.route('/jobs/<job_id>', methods=['GET'])
+@single_worker
+def get_job(job_id):
+    """Status and progress (route segments done out of total) of a submitted job"""
+    job = jobs.get(job_id)
+    if job is None:
+        return unknown_job(job_id)
+    return jsonify({
+        "success": True,
+        "data": job_status(job)
+    })
+
+@app.route('/jobs/<job_id>', methods=['DELETE'])
+@single_worker
+def cancel_job(job_id):
+    """Cancel a queued or running job; its search stops at the next deadline check"""
+    job = jobs.cancel(job_id)
+    if job is None:
+        return unknown_job(job_id)
+    log(f"🛑 Job {job_id} cancelled")
+    return jsonify({
+        "success": True,
+        "data": job_status(job)
+    })
+
+@app.route('/jobs/<job_id>/result', methods=['GET'])
+@single_worker
+def job_result(job_id):
+    """The route of a finished job, answered like /process_route; 202 with the status while it is pending"""
+    job = jobs.get(job_id)
+    if job is None:
+        return unknown_job(job_id)
+    if job.active:
+        return jsonify({
+            "success": True,
+            "data": job_status(job)
+        }), 202
+    if job.status == 'cancelled':
+        return jsonify({
+            "success": False,
+            "error": f"Job {job_id} was cancelled",
+            "type": "cancelled"
+        }), 410
+    if job.status == 'failed':
+        e = job.error
+        if isinstance(e, (DeadlineExceeded, SearchCancelled)):
+            return search_stopped(e)
+        if isinstance(e, ValueError):
+            return jsonify({
+                "success": False,
+                "error": str(e),
+                "type": "algorithm_error"
+            }), 422
+        print(f"❌ Error in job {job_id}: {str(e)}")
+        print(''.join(traceback.format_exception(type(e), e, e.__traceback__)))
         return jsonify({
             "success": False,
             "error": "Internal server error occurred while processing route",
             "type": "server_error"
         }), 500
+    
+    return json_response({
+        "success": True,
+        "data": job.result
+    }, stream=streamed(request.args, job.result))
 
 @app.route('/optimize_route', methods=['POST'])
+@limited
 def optimize_route():
     """Simplified endpoint for quick route optimization with waypoints"""
     try:
@@ -174,7 +881,7 @@ def optimize_route():
                 "error": "At least 2 waypoints required"
             }), 400
         
-        print(f"🔄 Quick optimization for {len(waypoints)} waypoints")
+        log(f"🔄 Quick optimization for {len(waypoints)} waypoints")
         
         # Create a simple elevation dataset without dense grid
         elevation_data = []
@@ -187,8 +894,7 @@ def optimize_route():
                 'point_type': point_type
             })
         
-        df = pd.DataFrame(elevation_data)
-        result = run_astar(df)
+        result = run_astar(read_records(elevation_data))
         
         return jsonify({
             "success": True,
@@ -205,24 +911,52 @@ def optimize_route():
             "type": "optimization_error"
         }), 500
 
+def preload_terrains(paths, landmarks=False):
+    """Build the terrains of PRELOAD_TERRAINS files and pin them, recording their ids in `preloaded_terrains`"""
+    for path in paths:
+        started = time.perf_counter()
+        file_type = binary_type(None, path)
+        if file_type:
+            with open(path, 'rb') as f:
+                points = read_points(f.read(), file_type)
+        else:
+            points = read_csv(path)
+        preloaded_terrains[os.path.basename(path)] = preload_terrain(points, landmarks=landmarks)
+        print(f"📦 Preloaded terrain {path} ({len(points['lat'])} points) in {elapsed_ms(started)} ms")
+
+# Under `python server.py`, segment pool processes import this file again as __mp_main__;
+# they get their terrain through shared memory and must not preload or warm up their own
+if __name__ != '__mp_main__':
+    preload_terrains(PRELOAD_TERRAINS, landmarks=PRELOAD_LANDMARKS)
+    if ROUTE_WARMUP:
+        startup['warmUpSeconds'] = round(warm_up([terrain_cache.get(key) for key in preloaded_terrains.values()]), 3)
+    startup['seconds'] = round(time.perf_counter() - STARTED, 3)
+    startup['rssBytes'] = resident_bytes()
+    print(f"🚀 Ready in {startup['seconds']} s, {startup['rssBytes'] / 2 ** 20:.0f} MiB resident"
+          f"{', warmed up' if ROUTE_WARMUP else ''}")
+
 if __name__ == '__main__':
     print("🚀 Starting ORP Route Optimization Service - PRODUCTION")
     print("🔧 MESH BUG FIXED: Sequential waypoint routing implemented")
     
     # Railway will set the PORT environment variable
-    import os
     port = int(os.environ.get('PORT', 8080))
     
     print(f"📡 Server starting on port {port}")
     print("🗺️  Production Endpoints:")
     print("   - GET  /health - Service health check")
+    print("   - GET  /metrics - Prometheus metrics")
     print("   - POST /process_csv - Process uploaded CSV with elevation data")
     print("   - POST /process_route - Process JSON elevation data")
+    print("   - POST /reroute - Re-route edited waypoints over a cached terrain")
+    print("   - POST /process_batch - Route many waypoint lists over one grid")
+    print("   - POST /jobs - Queue a route; GET /jobs/<id> for progress, /jobs/<id>/result for the route")
     print("   - POST /optimize_route - Quick route optimization")
     print("🔧 Configuration:")
     print("   - ✅ 2-waypoint routes: Simple A*")
     print("   - ✅ 3+ waypoint routes: Sequential A*")
     print("   - ✅ Production mode: debug=False")
+    print("   - 💡 Production serving: gunicorn -c gunicorn.conf.py server:app")
     
     # Production configuration
     app.run(
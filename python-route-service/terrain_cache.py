@@ -0,0 +1,95 @@
+# terrain_cache.py - Process-level LRU caches for built terrains and segment results
+
+import threading
+from collections import OrderedDict
+
+class TerrainCache:
+    """LRU cache bounded by the total size in bytes of its values.
+    
+    `sizeof(value)` defaults to `value.nbytes()`. Sizes are re-read whenever
+    eviction runs because cached terrains grow as they memoise per-alpha edge
+    costs.
+    
+    Entries added with `pin` are never evicted and do not count against
+    `max_bytes`.
+    """
+    
+    def __init__(self, max_bytes, sizeof=None):
+        self.max_bytes = max_bytes
+        self.sizeof = sizeof or (lambda value: value.nbytes())
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries = OrderedDict()
+        self._pinned = {}
+        self._lock = threading.Lock()
+    
+    def __len__(self):
+        return len(self._entries) + len(self._pinned)
+    
+    def get(self, key):
+        with self._lock:
+            value = self._pinned.get(key)
+            if value is not None:
+                self.hits += 1
+                return value
+            value = self._entries.get(key)
+            if value is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return value
+    
+    def put(self, key, value):
+        with self._lock:
+            if key in self._pinned:
+                self._pinned[key] = value
+                return
+            self._entries[key] = value
+            self._entries.move_to_end(key)
+            self._evict()
+    
+    def pin(self, key, value):
+        """Keep `value` for as long as the process lives, e.g. a terrain preloaded before forking workers"""
+        with self._lock:
+            self._entries.pop(key, None)
+            self._pinned[key] = value
+    
+    def get_or_build(self, key, build):
+        """Return the cached value for `key`, building and caching it on a miss"""
+        value = self.get(key)
+        if value is None:
+            value = build()
+            self.put(key, value)
+        return value
+    
+    def clear(self):
+        """Drop the cached entries; pinned ones stay"""
+        with self._lock:
+            self._entries.clear()
+    
+    def nbytes(self):
+        return sum(self.sizeof(value) for value in self._entries.values())
+    
+    def _evict(self):
+        # Least recently used first; the newest entry is always kept, even if it
+        # alone exceeds the budget, so the current request can still use it
+        total = self.nbytes()
+        while total > self.max_bytes and len(self._entries) > 1:
+            _, value = self._entries.popitem(last=False)
+            total -= self.sizeof(value)
+            self.evictions += 1
+    
+    def stats(self):
+        with self._lock:
+            return {
+                'entries': len(self._entries),
+                'bytes': self.nbytes(),
+                'maxBytes': self.max_bytes,
+                'pinned': len(self._pinned),
+                'pinnedBytes': sum(self.sizeof(value) for value in self._pinned.values()),
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+            }
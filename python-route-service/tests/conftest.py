@@ -0,0 +1,6 @@
+# conftest.py - Lets the tests import the service modules from the directory above
+
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -0,0 +1,231 @@
+# test_astar.py - Searches, route statistics and alpha sets of AStar
+
+import math
+import warnings
+
+import numpy as np
+import pandas as pd
+import pytest
+
+import AStar
+from AStar import (EDGE_COST_CACHE_SIZE, PARETO_ALPHAS, Deadline, DeadlineExceeded, LatticeTerrain, Route,
+                   RoutingGraph, SearchCancelled, TerrainGraph, astar, bidirectional_astar, calculate_route_stats, detect_lattice, dijkstra_costs, encode_polyline,
+                   hierarchical_astar, prepare_landmarks, route_graph, routing_graph_from_dataframe,
+                   simplify_indices)
+from benchmark import synthetic_request
+
+def path_cost(graph, path, alpha):
+    """Search cost of `path`, summed edge by edge"""
+    return sum(dict(graph.expand(a, alpha))[b] for a, b in zip(path, path[1:]))
+
+def two_patches():
+    """Graph over two 20x20 grid patches too far apart to connect, with start and end in the first"""
+    rows = [(32 + r * 0.00027, 34.8 + c * 0.00027, 100 + 20 * math.sin(r / 3) + c, 'grid')
+            for r in [*range(20), *range(30, 50)] for c in range(20)]
+    rows += [(32.0003, 34.8003, 100, 'start'), (32.0045, 34.8045, 100, 'end')]
+    return routing_graph_from_dataframe(pd.DataFrame(rows, columns=['lat', 'lng', 'elevation', 'point_type']),
+                                        cache=None)
+
+@pytest.mark.parametrize('elevation', [[100, 100, 100], [100, 105, 110]])
+def test_no_descent_reports_positive_zero_loss(elevation):
+    route = Route([32.0, 32.0003, 32.0006], [34.8, 34.8, 34.8], elevation, ['start', 'grid', 'end'])
+    stats = calculate_route_stats(route)
+    assert stats['elevationLoss'] == 0.0
+    assert math.copysign(1, stats['elevationLoss']) == 1
+    assert math.copysign(1, stats['netElevationChange']) == 1
+
+def test_pareto_search_totals_count_every_alpha():
+    graph = routing_graph_from_dataframe(synthetic_request(2500, 'mountainous', 3, seed=2), cache=None)
+    result = route_graph(graph, alpha='pareto')
+    assert len(result['routes']) < len(PARETO_ALPHAS)
+    assert result['search']['legs'] == 2 * len(PARETO_ALPHAS)
+
+@pytest.mark.parametrize('terrain', ['rolling', 'mountainous'])
+def test_landmark_search_costs_match_dijkstra(terrain):
+    graph = routing_graph_from_dataframe(synthetic_request(2500, terrain, 2, seed=4), cache=None)
+    start, goal = graph.waypoint_ids.tolist()
+    prepare_landmarks(graph.terrain, 25)
+    path = bidirectional_astar(graph, start, goal, alpha=25)
+    assert path_cost(graph, path, 25) == pytest.approx(dijkstra_costs(graph, start, 25)[goal])
+
+def test_landmarks_on_disconnected_terrain_bound_nothing_across_parts():
+    graph = two_patches()
+    start, goal = graph.waypoint_ids.tolist()
+    prepare_landmarks(graph.terrain, 25)
+    with warnings.catch_warnings():
+        warnings.simplefilter('error')  # no inf - inf RuntimeWarning
+        h = [graph.heuristic(goal, 25)[node] for node in range(len(graph))]
+        path = bidirectional_astar(graph, start, goal, alpha=25)
+    assert np.isfinite(h).all()
+    assert path_cost(graph, path, 25) == pytest.approx(dijkstra_costs(graph, start, 25)[goal])
+
+def test_edge_cost_cache_keeps_the_latest_alphas():
+    graph = two_patches()
+    terrain = graph.terrain
+    for alpha in range(EDGE_COST_CACHE_SIZE + 3):
+        terrain.edge_costs(alpha)
+    terrain.edge_costs(3)  # used again, so it outlives older alphas
+    terrain.edge_costs(100)
+    assert len(terrain._edge_cost_cache) == EDGE_COST_CACHE_SIZE
+    assert 3 in terrain._edge_cost_cache and 4 not in terrain._edge_cost_cache
+    assert terrain.edge_costs(4) == pytest.approx(terrain.edge_distance + 4 * terrain.edge_elev_diff)
+
+def test_terrain_graph_search_costs_match_dijkstra():
+    graph = two_patches()
+    start, goal = graph.waypoint_ids.tolist()
+    for alpha in (0, 25):
+        path = bidirectional_astar(graph, start, goal, alpha=alpha)
+        assert path_cost(graph, path, alpha) == pytest.approx(dijkstra_costs(graph, start, alpha)[goal])
+
+def test_hierarchical_search_stays_close_to_the_cheapest_route():
+    graph = routing_graph_from_dataframe(synthetic_request(10000, 'mountainous', 2, seed=3), cache=None)
+    start, goal = graph.waypoint_ids.tolist()
+    stats = {}
+    path = hierarchical_astar(graph, start, goal, alpha=25, stats=stats, corridor=1)
+    cheapest = dijkstra_costs(graph, start, 25)[goal]
+    assert path[0] == start and path[-1] == goal
+    assert cheapest - 1e-6 <= path_cost(graph, path, 25) <= 1.05 * cheapest
+    assert stats['fallback'] is False
+    assert 0 < stats['corridorNodes'] < len(graph.terrain)
+
+def test_hierarchical_fallback_keeps_the_corridor_stats(monkeypatch):
+    graph = routing_graph_from_dataframe(synthetic_request(2500, 'rolling', 2, seed=5), cache=None)
+    start, goal = graph.waypoint_ids.tolist()
+    # A corridor of the extra nodes alone cannot join start and end
+    monkeypatch.setattr(AStar, 'corridor_nodes',
+                        lambda graph, coarse, cells, factor: (set(range(graph.terrain_size, len(graph))), 0))
+    stats = {}
+    path = hierarchical_astar(graph, start, goal, alpha=25, stats=stats)
+    assert path_cost(graph, path, 25) == pytest.approx(dijkstra_costs(graph, start, 25)[goal])
+    assert stats['fallback'] is True
+    assert stats['corridorNodes'] == 0
+    assert stats['corridor']['expanded'] > 0
+    assert stats['expanded'] > stats['corridor']['expanded']
+
+def test_lattice_has_the_edges_of_the_explicit_graph():
+    df = synthetic_request(2500, 'mountainous', 3, seed=6)
+    lattice = routing_graph_from_dataframe(df, cache=None)
+    explicit = routing_graph_from_dataframe(df, grid=False, cache=None)
+    assert isinstance(lattice.terrain, LatticeTerrain) and isinstance(explicit.terrain, TerrainGraph)
+    assert len(lattice) == len(explicit)
+    for node in [*range(0, len(lattice), 37), *lattice.waypoint_ids.tolist()]:
+        assert dict(lattice.expand(node, 25)) == pytest.approx(dict(explicit.expand(node, 25)))
+
+@pytest.mark.parametrize('search', [astar, bidirectional_astar])
+def test_lattice_search_costs_match_dijkstra(search):
+    df = synthetic_request(2500, 'rolling', 2, seed=8)
+    lattice = routing_graph_from_dataframe(df, cache=None)
+    explicit = routing_graph_from_dataframe(df, grid=False, cache=None)
+    start, goal = lattice.waypoint_ids.tolist()
+    for alpha in (0, 25):
+        path = search(lattice, start, goal, alpha=alpha)
+        assert path_cost(lattice, path, alpha) == pytest.approx(dijkstra_costs(explicit, start, alpha)[goal])
+
+def test_irregular_points_are_not_a_lattice():
+    rows, cols = np.mgrid[0:10, 0:10]
+    lat, lon = 32 + rows.ravel() * 0.00027, 34.8 + cols.ravel() * 0.00027
+    assert detect_lattice(lat, lon) == (32, 34.8, pytest.approx(0.00027), pytest.approx(0.00027), 10, 10)
+    lon[55] += 0.0001
+    assert detect_lattice(lat, lon) is None
+    assert detect_lattice(lat[:-1], lon[:-1]) is None  # a ragged last row
+
+def decode_polyline(text, precision=5):
+    """Coordinate pairs of an encoded polyline, decoded one character at a time"""
+    values, value, shift = [], 0, 0
+    for char in text:
+        chunk = ord(char) - 63
+        value |= (chunk & 0x1f) << shift
+        shift += 5
+        if chunk < 0x20:
+            values.append(~(value >> 1) if value & 1 else value >> 1)
+            value, shift = 0, 0
+    return np.cumsum(np.reshape(values, (-1, 2)), axis=0) / 10 ** precision
+
+def test_polyline_matches_the_reference_encoding():
+    lat, lon = [38.5, 40.7, 43.252], [-120.2, -120.95, -126.453]
+    assert encode_polyline(lat, lon) == '_p~iF~ps|U_ulLnnqC_mqNvxq`@'
+
+def test_polyline_round_trips_rounded_coordinates():
+    rng = np.random.default_rng(3)
+    lat = np.cumsum(rng.normal(0, 0.5, 200)).clip(-89, 89)
+    lon = np.cumsum(rng.normal(0, 2, 200)).clip(-179, 179)
+    lat[:3], lon[:3] = 0.0, [0.0, -0.00001, 179.99999]
+    decoded = decode_polyline(encode_polyline(lat, lon))
+    np.testing.assert_allclose(decoded, np.column_stack((lat, lon)).round(5), rtol=0, atol=1e-9)
+
+def test_polyline_response_decodes_to_the_path():
+    graph = routing_graph_from_dataframe(synthetic_request(2500, 'rolling', 3, seed=2), cache=None)
+    columns = route_graph(graph, path_format='columns')['path']
+    polyline = route_graph(graph, path_format='polyline')['polyline']
+    expected = np.column_stack((columns['lat'], columns['lng'])).round(5)
+    np.testing.assert_allclose(decode_polyline(polyline), expected, rtol=0, atol=1e-9)
+
+def test_simplify_drops_only_vertices_within_tolerance():
+    x = np.linspace(0, 0.01, 101)
+    wiggle = 0.00001 * np.sin(np.arange(101))  # about a metre
+    lat = 32 + wiggle
+    lat[60] += 0.0005  # a 55 m spike
+    route = Route(lat, 34.8 + x, np.zeros(101), ['grid'] * 101)
+    assert simplify_indices(route, 5.0).tolist() == [0, 59, 60, 61, 100]
+    assert simplify_indices(route, 5.0, keep=[30]).tolist() == [0, 30, 59, 60, 61, 100]
+    assert len(simplify_indices(route, 0.1)) > 50
+
+def test_simplified_route_keeps_its_waypoints():
+    df = synthetic_request(2500, 'mountainous', 4, seed=3)
+    graph = routing_graph_from_dataframe(df, cache=None)
+    full = route_graph(graph, path_format='columns')
+    simplified = route_graph(graph, path_format='columns', simplify=5.0)
+    assert simplified['pathLength'] < full['pathLength']
+    keys = list(zip(*(df.loc[df['point_type'] != 'grid', name] for name in ('lat', 'lng'))))
+    points = list(zip(simplified['path']['lat'], simplified['path']['lng']))
+    assert [point for point in points if point in keys] == keys
+    assert [points[i] for i in simplified['waypoints']] == [keys[0], keys[-1]]
+
+class CountdownDeadline(Deadline):
+    """Deadline that expires at its `checks`-th check instead of on the clock"""
+    
+    def __init__(self, checks, **kwargs):
+        super().__init__(**kwargs)
+        self.checks = checks
+    
+    def check(self):
+        self.checks -= 1
+        self.exceeded = self.exceeded or self.checks < 0
+        return super().check()
+
+def corner_to_corner():
+    """`(graph, start, goal)` of a leg across a 150x150 hilly lattice, long enough for several deadline checks"""
+    rows, cols = np.mgrid[0:150, 0:150]
+    graph = RoutingGraph(LatticeTerrain(32.0, 34.8, 0.00027, 0.00027, 100 + 40 * np.sin(rows / 9) * np.cos(cols / 7)))
+    return graph, 0, len(graph) - 1
+
+@pytest.mark.parametrize('search', [astar, bidirectional_astar])
+def test_expired_deadline_returns_an_approximate_route(search):
+    graph, start, goal = corner_to_corner()
+    stats = {}
+    path = search(graph, start, goal, alpha=25, stats=stats, deadline=CountdownDeadline(2))
+    assert stats['approximate'] is True
+    assert path[0] == start and path[-1] == goal
+    jumps = [(a, b) for a, b in zip(path, path[1:]) if b not in dict(graph.expand(a, 25))]
+    assert len(jumps) == 1  # the terrain is followed up to a single straight jump
+    assert 2 < len(path) < len(search(graph, start, goal, alpha=25))
+
+def test_expired_deadline_without_partial_routes_raises():
+    graph, start, goal = corner_to_corner()
+    with pytest.raises(DeadlineExceeded):
+        bidirectional_astar(graph, start, goal, deadline=CountdownDeadline(1, partial=False))
+
+def test_cancelled_search_raises():
+    graph, start, goal = corner_to_corner()
+    calls = []
+    deadline = Deadline(cancelled=lambda: calls.append(1) or len(calls) > 1)
+    with pytest.raises(SearchCancelled):
+        bidirectional_astar(graph, start, goal, deadline=deadline)
+    assert len(calls) == 2
+
+def test_route_graph_flags_approximate_legs():
+    graph = routing_graph_from_dataframe(synthetic_request(2500, 'rolling', 3, seed=2), cache=None)
+    result = route_graph(graph, deadline=Deadline(0), cache=None)
+    assert result['approximate'] is True
+    assert result['search']['approximateLegs'] == result['search']['legs'] == 2
+    assert result['pathLength'] >= 3
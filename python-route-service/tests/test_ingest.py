@@ -0,0 +1,113 @@
+# test_ingest.py - Upload formats and grid descriptors read by ingest
+
+import base64
+import gzip
+import io
+
+import numpy as np
+import pytest
+
+from benchmark import synthetic_request
+from ingest import ARROW_FILE, ARROW_STREAM, NPY, NPZ, read_grid, read_points
+
+GRID = {'origin': [32.0, 34.8], 'step': 0.00027, 'rows': 2, 'cols': 3, 'elevation': [1, 2, 3, 4, 5, 6]}
+
+def test_grid_descriptor_layout():
+    layout, elevation = read_grid(GRID)
+    assert layout == {'origin': (32.0, 34.8), 'step': (0.00027, 0.00027), 'rows': 2, 'cols': 3}
+    assert elevation.tolist() == [1, 2, 3, 4, 5, 6]
+
+def test_grid_descriptor_bbox_and_gzip_base64_elevation():
+    values = np.arange(6, dtype='<f4')
+    grid = {'bbox': [32.0, 34.8, 32.001, 34.802], 'rows': 2, 'cols': 3, 'compression': 'gzip',
+            'elevation': base64.b64encode(gzip.compress(values.tobytes())).decode()}
+    layout, elevation = read_grid(grid)
+    assert layout['origin'] == (32.0, 34.8)
+    assert layout['step'] == pytest.approx((0.001, 0.001))
+    assert elevation.tolist() == values.tolist()
+
+@pytest.mark.parametrize('change', [
+    {'step': [0.00027]},
+    {'step': 'wide'},
+    {'origin': 32},
+    {'origin': [32.0, 'east']},
+    {'rows': None},
+    {'rows': 1},
+    {'elevation': [1, 2, 3]},
+    {'elevation': [1, 2, 3, 4, 5, float('nan')]},
+    {'elevation': 'not base64!'},
+])
+def test_malformed_grid_descriptor_is_a_value_error(change):
+    with pytest.raises(ValueError):
+        read_grid(dict(GRID, **change))
+
+def structured(df, names=('lat', 'lng', 'elevation', 'point_type')):
+    """`df` as a NumPy structured array with the given CSV fields"""
+    dtypes = {'lat': 'f8', 'lng': 'f8', 'elevation': 'f8', 'point_type': 'U8'}
+    array = np.zeros(len(df), dtype=[(name, dtypes[name]) for name in names])
+    for name in names:
+        array[name] = df[name]
+    return array
+
+def npy_bytes(array):
+    buffer = io.BytesIO()
+    np.save(buffer, array)
+    return buffer.getvalue()
+
+def npz_bytes(**arrays):
+    buffer = io.BytesIO()
+    np.savez(buffer, **arrays)
+    return buffer.getvalue()
+
+def arrow_bytes(df, file_type):
+    pa = pytest.importorskip('pyarrow')
+    table = pa.Table.from_pandas(df, preserve_index=False)
+    sink = pa.BufferOutputStream()
+    writer = pa.ipc.new_stream if file_type == ARROW_STREAM else pa.ipc.new_file
+    with writer(sink, table.schema) as out:
+        out.write_table(table)
+    return sink.getvalue().to_pybytes()
+
+def assert_columns(columns, df):
+    for name in ('lat', 'lng', 'elevation'):
+        assert np.array_equal(columns[name], df[name].to_numpy())
+    assert [str(value) for value in columns['point_type']] == df['point_type'].tolist()
+
+def test_npy_upload_reads_the_csv_columns():
+    df = synthetic_request(100, 'rolling', 3, seed=2)
+    assert_columns(read_points(npy_bytes(structured(df)), NPY), df)
+
+def test_npz_upload_names_unlabelled_waypoints_in_order():
+    df = synthetic_request(100, 'rolling', 3, seed=2)
+    grid, waypoints = df[df['point_type'] == 'grid'], df[df['point_type'] != 'grid']
+    columns = read_points(npz_bytes(grid=structured(grid, ('lat', 'lng', 'elevation')),
+                                    waypoints=structured(waypoints, ('lat', 'lng', 'elevation'))), NPZ)
+    assert_columns(columns, df.assign(point_type=['grid'] * len(grid) + ['start', 'w1', 'end']))
+
+@pytest.mark.parametrize('file_type', [ARROW_STREAM, ARROW_FILE])
+def test_arrow_upload_reads_the_csv_columns(file_type):
+    df = synthetic_request(100, 'rolling', 3, seed=2)
+    assert_columns(read_points(arrow_bytes(df, file_type), file_type), df)
+
+def malformed_uploads():
+    df = synthetic_request(100, 'rolling', 3, seed=2)
+    npy = npy_bytes(structured(df))
+    return [
+        (b'not a numpy file', NPY),
+        (npy[:-10], NPY),
+        (npy_bytes(np.array([{'lat': 1}, None])), NPY),
+        (npy_bytes(np.zeros((2, 2))), NPY),
+        (npy_bytes(structured(df, ('lat', 'lng', 'elevation'))), NPY),
+        (b'not a numpy file', NPZ),
+        (npy, NPZ),
+        (npz_bytes(grid=structured(df)), NPZ),
+        (b'not an arrow file', ARROW_STREAM),
+        (b'not an arrow file', ARROW_FILE),
+    ]
+
+@pytest.mark.parametrize('data, file_type', malformed_uploads())
+def test_malformed_upload_is_a_value_error(data, file_type):
+    if file_type in (ARROW_STREAM, ARROW_FILE):
+        pytest.importorskip('pyarrow')
+    with pytest.raises(ValueError):
+        read_points(data, file_type)
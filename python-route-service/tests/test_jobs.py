@@ -0,0 +1,43 @@
+# test_jobs.py - JobQueue admission, retention and eviction
+
+import threading
+
+import pytest
+
+from jobs import JobQueue, QueueFull
+
+def finish(queue, key, result=None):
+    job, _ = queue.submit(key, lambda job: result)
+    queue._executor.submit(lambda: None).result()  # one worker: the job has run once this returns
+    return job
+
+def test_finished_results_are_capped_oldest_first():
+    queue = JobQueue(workers=1, max_queued=1, ttl=600, max_retained=3)
+    finished = [finish(queue, f"route-{i}", i) for i in range(5)]
+    
+    assert [queue.get(job.id) for job in finished[:2]] == [None, None]
+    assert [queue.get(job.id).result for job in finished[2:]] == [2, 3, 4]
+    stats = queue.stats()
+    assert stats['retained'] == 3
+    assert stats['evicted'] == 2
+
+def test_evicted_result_is_routed_again():
+    queue = JobQueue(workers=1, max_queued=1, ttl=600, max_retained=1)
+    first = finish(queue, 'route-a', 'a')
+    finish(queue, 'route-b', 'b')
+    
+    again, coalesced = queue.submit('route-a', lambda job: 'a')
+    assert not coalesced
+    assert again.id != first.id
+
+def test_pending_jobs_are_not_evicted():
+    queue = JobQueue(workers=1, max_queued=1, ttl=600, max_retained=0)
+    release = threading.Event()
+    running, _ = queue.submit('slow', lambda job: release.wait(5))
+    queued, _ = queue.submit('queued', lambda job: 'queued')
+    with pytest.raises(QueueFull):
+        queue.submit('one-too-many', lambda job: None)
+    
+    assert queue.get(running.id) is running
+    assert queue.get(queued.id) is queued
+    release.set()
@@ -0,0 +1,147 @@
+# test_server.py - HTTP behaviour of the routing endpoints through Flask's test client
+
+import io
+
+import numpy as np
+import pytest
+
+import server
+from AStar import terrain_cache
+from benchmark import synthetic_request
+
+@pytest.fixture
+def client():
+    return server.app.test_client()
+
+def test_jobs_refused_with_several_workers(client, monkeypatch):
+    monkeypatch.setenv('ROUTE_WEB_WORKERS', '4')
+    response = client.get('/jobs/0123')
+    assert response.status_code == 503
+    assert response.get_json()['type'] == 'jobs_unavailable'
+
+def test_jobs_served_with_one_worker(client, monkeypatch):
+    monkeypatch.setenv('ROUTE_WEB_WORKERS', '1')
+    assert client.get('/jobs/0123').status_code == 404
+
+def preload(tmp_path, monkeypatch, seed=7):
+    """Preload a synthetic CSV grid as PRELOAD_TERRAINS would, returning its path and terrain id"""
+    monkeypatch.setattr(server, 'preloaded_terrains', {})
+    path = tmp_path / 'grid.csv'
+    synthetic_request(900, 'rolling', 2, seed=seed).to_csv(path, index=False)
+    server.preload_terrains([str(path)])
+    return path, server.preloaded_terrains['grid.csv']
+
+def test_uploaded_copy_of_preloaded_csv_hits_cache(client, tmp_path, monkeypatch):
+    path, _ = preload(tmp_path, monkeypatch)
+    
+    before = terrain_cache.stats()
+    with open(path, 'rb') as f:
+        response = client.post('/process_csv', data={'file': (f, 'grid.csv')})
+    after = terrain_cache.stats()
+    assert response.status_code == 200
+    assert after['hits'] == before['hits'] + 1
+    assert after['misses'] == before['misses']
+
+@pytest.mark.parametrize('routes', [
+    [1],
+    {'a': []},
+    [{'id': 'a', 'waypoints': []}, {'id': 'a', 'waypoints': []}],
+    [{'waypoints': []}, {'id': '0', 'waypoints': []}],  # an explicit id colliding with a default one
+])
+def test_batch_rejects_malformed_or_duplicate_routes(client, routes):
+    elevation = synthetic_request(100, 'flat', 2, seed=1).to_dict('records')
+    response = client.post('/process_batch', json={'elevationData': elevation, 'routes': routes})
+    assert response.status_code == 400
+    assert response.get_json()['type'] == 'invalid_request'
+
+@pytest.mark.parametrize('waypoints', [[1, 2], 'start'])
+def test_batch_rejects_waypoints_that_are_not_objects(client, waypoints):
+    elevation = synthetic_request(100, 'flat', 2, seed=1).to_dict('records')
+    response = client.post('/process_batch', json={'elevationData': elevation, 'routes': [{'waypoints': waypoints}]})
+    assert response.status_code == 400
+
+@pytest.mark.parametrize('change', [{'step': [0.00027]}, {'origin': 32}])
+def test_malformed_grid_descriptor_gets_422(client, change):
+    grid = dict({'origin': [32.0, 34.8], 'step': 0.00027, 'rows': 2, 'cols': 2, 'elevation': [1, 2, 3, 4]}, **change)
+    waypoints = [{'lat': 32.0, 'lng': 34.8}, {'lat': 32.00027, 'lng': 34.80027}]
+    response = client.post('/process_route', json={'grid': grid, 'waypoints': waypoints})
+    assert response.status_code == 422
+    assert response.get_json()['type'] == 'algorithm_error'
+
+REROUTE_WAYPOINTS = [{'lat': 32.0012, 'lng': 34.8012, 'elevation': 200}, {'lat': 32.006, 'lng': 34.806, 'elevation': 200}]
+
+def test_reroute_refuses_request_terrains_with_several_workers(client, monkeypatch):
+    monkeypatch.setenv('ROUTE_WEB_WORKERS', '4')
+    response = client.post('/reroute', json={'terrainId': 'sent-earlier', 'waypoints': REROUTE_WAYPOINTS})
+    assert response.status_code == 503
+    assert response.get_json()['type'] == 'reroute_unavailable'
+
+def test_reroute_serves_preloaded_terrains_with_several_workers(client, tmp_path, monkeypatch):
+    _, terrain_id = preload(tmp_path, monkeypatch, seed=8)
+    monkeypatch.setenv('ROUTE_WEB_WORKERS', '4')
+    response = client.post('/reroute', json={'terrainId': terrain_id, 'waypoints': REROUTE_WAYPOINTS})
+    assert response.status_code == 200
+    assert response.get_json()['data']['pathLength'] > 2
+
+def npy_upload(df):
+    """`df` saved as a .npy structured array, as an upload would send it"""
+    array = np.zeros(len(df), dtype=[('lat', 'f8'), ('lng', 'f8'), ('elevation', 'f8'), ('point_type', 'U8')])
+    for name in array.dtype.names:
+        array[name] = df[name]
+    buffer = io.BytesIO()
+    np.save(buffer, array)
+    return buffer.getvalue()
+
+def test_npy_upload_routes_like_the_csv(client):
+    df = synthetic_request(900, 'rolling', 3, seed=9)
+    csv = client.post('/process_csv', data={'file': (io.BytesIO(df.to_csv(index=False).encode()), 'grid.csv')})
+    npy = client.post('/process_csv', data={'file': (io.BytesIO(npy_upload(df)), 'grid.npy')})
+    body = client.post('/process_route', data=npy_upload(df), content_type='application/x-npy')
+    assert csv.status_code == npy.status_code == body.status_code == 200
+    assert npy.get_data() == csv.get_data()
+    assert body.get_json()['data']['pathLength'] == len(csv.get_data().splitlines()) - 1
+
+@pytest.mark.parametrize('data, filename', [
+    (b'not a numpy file', 'grid.npy'),
+    (None, 'grid.npz'),  # a .npy file under a .npz name
+])
+def test_malformed_upload_gets_422(client, data, filename):
+    data = npy_upload(synthetic_request(100, 'flat', 2, seed=1)) if data is None else data
+    response = client.post('/process_csv', data={'file': (io.BytesIO(data), filename)})
+    assert response.status_code == 422
+    assert response.get_json()['type'] == 'algorithm_error'
+
+def test_expired_deadline_returns_an_approximate_route(client):
+    elevation = synthetic_request(2500, 'rolling', 2, seed=3).to_dict('records')
+    response = client.post('/process_route', json={'elevationData': elevation, 'deadlineMs': 0.001})
+    assert response.status_code == 200
+    assert response.get_json()['data']['approximate'] is True
+
+def test_expired_deadline_without_partial_routes_gets_504(client):
+    elevation = synthetic_request(2500, 'rolling', 2, seed=3).to_dict('records')
+    response = client.post('/process_route', json={'elevationData': elevation, 'deadlineMs': 0.001, 'partial': False})
+    assert response.status_code == 504
+    assert response.get_json()['type'] == 'deadline_exceeded'
+
+def test_malformed_deadline_gets_422(client):
+    elevation = synthetic_request(100, 'flat', 2, seed=1).to_dict('records')
+    response = client.post('/process_route', json={'elevationData': elevation, 'deadlineMs': 'soon'})
+    assert response.status_code == 422
+
+def metric_samples(client):
+    """Sample name (with labels) -> value of every line /metrics exposes"""
+    text = client.get('/metrics').get_data(as_text=True)
+    return {name: float(value) for name, value in
+            (line.rsplit(' ', 1) for line in text.splitlines() if line and not line.startswith('#'))}
+
+def test_metrics_count_searched_and_approximate_legs(client):
+    elevation = synthetic_request(2500, 'rolling', 3, seed=11).to_dict('records')
+    before = metric_samples(client)
+    response = client.post('/process_route', json={'elevationData': elevation, 'deadlineMs': 0.001})
+    after = metric_samples(client)
+    assert response.status_code == 200
+    added = {name: value - before.get(name, 0) for name, value in after.items()}
+    assert added['route_legs_total{outcome="searched"}'] == 2
+    assert added['route_legs_total{outcome="approximate"}'] == 2
+    assert added['route_search_expanded_nodes_count{method="bidirectional"}'] == 2
+    assert added['route_request_seconds_count{endpoint="process_route"}'] == 1